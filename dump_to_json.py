@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Converts a mysqldump of an OpenMRS database straight to OCL JSON, without a MySQL server.
+
+The concept dictionary tables of the dump are streamed into an embedded SQLite database and then
+exported by extract_db, so the JSON is the same as when the dump is loaded into MySQL first. All
+arguments after the dump filename that this script does not recognize are passed to extract_db.
+
+Example usage:
+
+    python dump_to_json.py local/openmrs.sql.zip --org_id=CIEL --source_id=CIEL --concepts
+        --mappings --format=bulk --output=local/openmrs.json
+
+The dump may be a .sql file, a .zip archive containing it, or gzip or zstd compressed. By default
+the tables are loaded into an in-memory database. Pass --sqlite_db to keep them in a file, e.g. to
+run extract_db with --workers, or to export again later with OMRS_SQLITE_DB set to that file.
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Convert a mysqldump of an OpenMRS database to OCL JSON using extract_db.',
+        epilog='Any other arguments are passed to extract_db.')
+    parser.add_argument('dump_filename', help='mysqldump file (.sql, .zip, .gz or .zst)')
+    parser.add_argument('--sqlite_db', default=None,
+                        help='Load the tables into this SQLite database file instead of memory')
+    args, extract_db_argv = parser.parse_known_args(argv)
+    if not args.sqlite_db and any(arg.startswith('--workers') for arg in extract_db_argv):
+        parser.error('--workers requires --sqlite_db, as worker processes cannot share an in-memory database')
+    if args.sqlite_db and os.path.exists(args.sqlite_db):
+        os.remove(args.sqlite_db)
+
+    # Django has to be configured for the SQLite database before it is imported
+    os.environ['OMRS_SQLITE_DB'] = args.sqlite_db or ':memory:'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'omrs.settings')
+    from django.core.management import execute_from_command_line
+    from django.db import connection, transaction
+    from omrs.mysqldump import open_dump, load_dictionary_tables
+
+    # Progress is written to stderr, as extract_db may write the export to stdout
+    start_time = time.time()
+    dump_file = open_dump(args.dump_filename)
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA synchronous = OFF')
+    cursor.execute('PRAGMA journal_mode = OFF')
+    cursor.fetchall()
+    with transaction.atomic():
+        row_counts = load_dictionary_tables(dump_file, connection, progress_callback=ProgressReporter())
+    dump_file.close()
+    sys.stderr.write('\nLoaded %d rows from "%s" in %.1f seconds\n' % (
+        sum(row_counts.values()), args.dump_filename, time.time() - start_time))
+    for table in sorted(row_counts):
+        sys.stderr.write('  %s: %d\n' % (table, row_counts[table]))
+
+    execute_from_command_line(['manage.py', 'extract_db'] + extract_db_argv)
+
+
+class ProgressReporter(object):
+    """ Writes the number of megabytes of the dump read so far to stderr, at most once a second """
+
+    def __init__(self):
+        self.last_report_time = 0
+
+    def __call__(self, bytes_read):
+        now = time.time()
+        if now - self.last_report_time >= 1:
+            self.last_report_time = now
+            sys.stderr.write('\rRead %.1f MB of dump' % (bytes_read / 1048576.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,10 +3,106 @@ import time
 import sys
 import re
 import os
+import shutil
 from subprocess import Popen, PIPE
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings")
+from omrs.mysqldump import MysqldumpReader, open_dump, get_dump_size
+
 DATABASE_NAME = 'openmrs'
 
+# extract_db and validate_export only read the concept dictionary tables, so by default only the
+# tables whose names start with this prefix are loaded. Set FULL_SQL_IMPORT=1 to load all tables.
+DICTIONARY_TABLE_PREFIX = 'concept'
+
+# Statements without a table that are loaded: the session settings of the dump
+SET_STATEMENT_RE = re.compile(r'(?:/\*!\d*\s*)?SET\s', re.IGNORECASE)
+LOCK_TABLES_RE = re.compile(r'LOCK\s+TABLES\s', re.IGNORECASE)
+
+# The dictionary tables are loaded in transactions of about this many bytes of the dump
+TRANSACTION_BYTES = 256 * 1024 * 1024
+
+# Seconds between progress updates
+PROGRESS_INTERVAL = 10
+
+
+def is_dictionary_table(table):
+    return table.startswith(DICTIONARY_TABLE_PREFIX)
+
+
+def is_loaded_statement(table, statement):
+    """
+    Returns whether a statement of the dump is loaded: the statements for the dictionary tables,
+    except LOCK TABLES, which would make the other tables inaccessible, and the session settings
+    """
+    statement = statement.lstrip()
+    if table is None:
+        return SET_STATEMENT_RE.match(statement) is not None
+    return is_dictionary_table(table) and not LOCK_TABLES_RE.match(statement)
+
+
+def print_progress(bytes_read, dump_size):
+    if dump_size:
+        print("Loaded %.1f of %.1f MB (%d%%)" % (
+            bytes_read / 1048576.0, dump_size / 1048576.0, 100 * bytes_read / dump_size))
+    else:
+        print("Loaded %.1f MB" % (bytes_read / 1048576.0))
+    sys.stdout.flush()
+
+
+def start_mysql_client():
+    return Popen(["mysql", "-u", "root", "-popenmrs", "-h", "db", DATABASE_NAME], stdin=PIPE)
+
+
+def finish_mysql_client(mysql_client):
+    mysql_client.stdin.close()
+    if mysql_client.wait() != 0:
+        print("Import failed")
+        sys.exit(1)
+
+
+def load_all_tables(source_file):
+    """ Streams the entire dump, decompressed if needed, to the mysql client """
+    mysql_client = start_mysql_client()
+    dump_file = open_dump(source_file)
+    shutil.copyfileobj(dump_file, mysql_client.stdin, 1024 * 1024)
+    dump_file.close()
+    finish_mysql_client(mysql_client)
+
+
+def load_dictionary_tables(source_file):
+    """
+    Streams the statements for the dictionary tables to the mysql client, skipping all other
+    tables without loading the dump into memory. Foreign key and unique checks are disabled
+    and rows are committed in large transactions rather than one at a time.
+    """
+    start_time = time.time()
+    dump_size = get_dump_size(source_file)
+    reader = MysqldumpReader(open_dump(source_file))
+    mysql_client = start_mysql_client()
+    mysql_client.stdin.write("SET foreign_key_checks=0;\nSET unique_checks=0;\nSET autocommit=0;\n")
+    tables = set()
+    transaction_start = 0
+    last_progress_time = start_time
+    for table, statement in reader.iter_statements(include_table=is_dictionary_table):
+        if not is_loaded_statement(table, statement):
+            continue
+        if table:
+            tables.add(table)
+        mysql_client.stdin.write(statement + ";\n")
+        if reader.bytes_read - transaction_start >= TRANSACTION_BYTES:
+            mysql_client.stdin.write("COMMIT;\n")
+            transaction_start = reader.bytes_read
+        if time.time() - last_progress_time >= PROGRESS_INTERVAL:
+            last_progress_time = time.time()
+            print_progress(reader.bytes_read, dump_size)
+    mysql_client.stdin.write("COMMIT;\n")
+    finish_mysql_client(mysql_client)
+    print_progress(reader.bytes_read, dump_size)
+    print("Loaded %d tables in %.1f seconds: %s" % (
+        len(tables), time.time() - start_time, ", ".join(sorted(tables))))
+
+
 db = None
 num_attempts = 0
 while True:
@@ -26,12 +122,19 @@ print("Creating database")
 cursor.execute("CREATE DATABASE %s" % DATABASE_NAME)
 cursor.execute("USE %s" % DATABASE_NAME)
 
-filename = os.environ.get("SQL_FILE") + '.sql'
+# The dump may be a .sql file, a .zip archive containing it or gzip compressed. It is read from
+# the path given on the command line, or else from $SQL_FILE.sql.
+if len(sys.argv) > 1:
+    filename = sys.argv[1]
+else:
+    filename = os.environ.get("SQL_FILE") + '.sql'
 
 print("Processing file %s" % filename)
 source_file = os.path.abspath(filename)
-os.system("mysql -u %s -p%s -h db %s < %s" %
-          ("root", "openmrs", "openmrs", source_file))
+if os.environ.get("FULL_SQL_IMPORT") == "1":
+    load_all_tables(source_file)
+else:
+    load_dictionary_tables(source_file)
 
 
 db.commit()
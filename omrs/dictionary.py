@@ -0,0 +1,310 @@
+"""
+Compact in-memory model of an OpenMRS concept dictionary, shared by extract_db and validate_export.
+
+A ConceptDictionary is loaded with one bulk query per table -- about ten in all -- rather than by
+instantiating Django models, which each carry a __dict__ and _state. Each concept is a
+ConceptRecord with __slots__, the names of classes, datatypes, map types and sources are shared
+string objects, locales and name types are interned, and answers and set members are stored in int
+arrays. The whole dictionary, or one range of concepts at a time, may be loaded:
+
+    dictionary = ConceptDictionary(mappings=False)
+    dictionary.load()
+    for concept in dictionary:
+        print concept.concept_id, concept.concept_class, [name.name for name in concept.names]
+"""
+from array import array
+from omrs.models import (
+    Concept, ConceptAnswer, ConceptClass, ConceptComplex, ConceptDatatype, ConceptDescription,
+    ConceptMapType, ConceptName, ConceptNumeric, ConceptReferenceMap, ConceptReferenceSource,
+    ConceptSet)
+
+
+class ConceptRecord(object):
+    """
+    A concept with its names, descriptions, numeric and complex metadata, reference maps,
+    answers and set members. Related rows are in primary key order. Fields of a part of the
+    dictionary that was not loaded are left empty.
+    """
+
+    __slots__ = ('concept_id', 'concept_class', 'datatype', 'retired', 'is_set', 'uuid', 'names',
+                 'descriptions', 'numeric', 'handler', 'reference_maps', 'answers', 'set_members')
+
+    def __init__(self, concept_id, concept_class, datatype, retired, is_set, uuid):
+        self.concept_id = concept_id
+        self.concept_class = concept_class
+        self.datatype = datatype
+        self.retired = retired
+        self.is_set = is_set
+        self.uuid = uuid
+        self.names = ()
+        self.descriptions = ()
+        self.numeric = None
+        self.handler = None
+        self.reference_maps = ()
+        self.answers = NO_RELATIONS
+        self.set_members = NO_RELATIONS
+
+
+class NameRecord(object):
+    """ A concept name that is not voided """
+
+    __slots__ = ('name', 'locale', 'name_type', 'locale_preferred', 'uuid')
+
+    def __init__(self, name, locale, name_type, locale_preferred, uuid):
+        self.name = name
+        self.locale = locale
+        self.name_type = name_type
+        self.locale_preferred = locale_preferred
+        self.uuid = uuid
+
+
+class DescriptionRecord(object):
+
+    __slots__ = ('description', 'locale', 'uuid')
+
+    def __init__(self, description, locale, uuid):
+        self.description = description
+        self.locale = locale
+        self.uuid = uuid
+
+
+class NumericRecord(object):
+    """ The concept_numeric metadata of a concept, with a slot for each field """
+
+    FIELDS = ('hi_absolute', 'hi_critical', 'hi_normal', 'low_absolute', 'low_critical',
+              'low_normal', 'units', 'allow_decimal', 'display_precision')
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
+
+
+class ReferenceMapRecord(object):
+    """ A concept reference map with the map type, source, code and name of its reference term """
+
+    __slots__ = ('concept_map_id', 'map_type', 'source', 'code', 'term_name', 'uuid')
+
+    def __init__(self, concept_map_id, map_type, source, code, term_name, uuid):
+        self.concept_map_id = concept_map_id
+        self.map_type = map_type
+        self.source = source
+        self.code = code
+        self.term_name = term_name
+        self.uuid = uuid
+
+
+class ConceptRelations(object):
+    """
+    The answers or set members of a concept, stored column-wise: the row IDs and related concept
+    IDs in int arrays and the sort weights in a double array, with NaN for NULL. Iterating yields
+    a tuple of (row ID, related concept ID, sort weight, uuid) for each row.
+    """
+
+    __slots__ = ('ids', 'concept_ids', 'sort_weights', 'uuids')
+
+    # Stored in concept_ids for a NULL concept, e.g. an answer that is a drug
+    NULL_CONCEPT_ID = -1
+
+    def __init__(self):
+        self.ids = array('i')
+        self.concept_ids = array('i')
+        self.sort_weights = array('d')
+        self.uuids = []
+
+    def append(self, row_id, concept_id, sort_weight, uuid):
+        self.ids.append(row_id)
+        self.concept_ids.append(self.NULL_CONCEPT_ID if concept_id is None else concept_id)
+        self.sort_weights.append(float('nan') if sort_weight is None else sort_weight)
+        self.uuids.append(uuid)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for row_id, concept_id, sort_weight, uuid in zip(
+                self.ids, self.concept_ids, self.sort_weights, self.uuids):
+            yield (row_id, None if concept_id == self.NULL_CONCEPT_ID else concept_id,
+                   None if sort_weight != sort_weight else sort_weight, uuid)
+
+
+# Shared by every concept without answers or set members; never appended to
+NO_RELATIONS = ConceptRelations()
+
+
+class ConceptDictionary(object):
+    """
+    The concepts of an OpenMRS dictionary as ConceptRecords, loaded with one query per table.
+    The concept fields (class, datatype, names, descriptions, numeric and complex metadata) and
+    the mappings (reference maps, answers and set members) are only loaded if requested.
+    Calling load() again replaces the loaded concepts, e.g. to load the next range of concepts;
+    the classes, datatypes, map types and sources are only queried the first time.
+    """
+
+    # Related rows are selected by the range of the loaded concept IDs, unless that range is this
+    # many times larger than the number of concepts loaded, e.g. for a subset of the dictionary,
+    # in which case they are selected by the concept IDs themselves
+    SPARSE_RANGE_FACTOR = 10
+
+    # Maximum number of concept IDs listed in a single IN query, as SQLite builds before 3.32
+    # allow at most 999 parameters in a query
+    MAX_QUERY_CONCEPT_IDS = 900
+
+    def __init__(self, concepts=True, mappings=True):
+        self.load_concept_fields = concepts
+        self.load_mappings = mappings
+        self.concepts = {}
+        self.strings = {}
+        self.concept_classes = None
+        self.datatypes = None
+        self.map_types = None
+        self.sources = None
+
+    def load(self, concept_results=None):
+        """
+        Loads the concepts in concept_results, a Concept queryset, or all concepts. Related rows
+        are selected by the range of the loaded concept IDs, so loading a contiguous range of
+        concepts does not need a long list of IDs in each query, or by a list of the IDs if
+        they are sparse and few enough to list. Returns the dictionary.
+        """
+        if self.concept_classes is None:
+            self.load_lookup_tables()
+        self.concepts = {}
+        concept_queryset = Concept.objects.all() if concept_results is None else concept_results
+        for concept_id, class_id, datatype_id, retired, is_set, uuid in concept_queryset.values_list(
+                'concept_id', 'concept_class', 'datatype', 'retired', 'is_set', 'uuid').iterator():
+            self.concepts[concept_id] = ConceptRecord(
+                concept_id, self.concept_classes.get(class_id), self.datatypes.get(datatype_id),
+                retired, is_set, uuid)
+        if not self.concepts:
+            return self
+
+        # Related rows are limited to the range of loaded concepts unless all concepts are loaded
+        concept_range = None
+        if concept_results is not None:
+            concept_range = (min(self.concepts), max(self.concepts))
+            if (len(self.concepts) <= self.MAX_QUERY_CONCEPT_IDS and
+                    concept_range[1] - concept_range[0] >= len(self.concepts) * self.SPARSE_RANGE_FACTOR):
+                concept_range = sorted(self.concepts)
+        if self.load_concept_fields:
+            self.load_names(concept_range)
+            self.load_descriptions(concept_range)
+            self.load_numerics(concept_range)
+            self.load_complex_handlers(concept_range)
+        if self.load_mappings:
+            self.load_reference_maps(concept_range)
+            self.load_relations(ConceptAnswer, 'question_concept', 'answer_concept', 'answers',
+                                concept_range)
+            self.load_relations(ConceptSet, 'concept_set_owner', 'concept', 'set_members',
+                                concept_range)
+        return self
+
+    def load_lookup_tables(self):
+        """ Loads the names of the concept classes, datatypes, map types and reference sources """
+        self.concept_classes = self.load_names_by_id(ConceptClass)
+        self.datatypes = self.load_names_by_id(ConceptDatatype)
+        self.map_types = self.load_names_by_id(ConceptMapType)
+        self.sources = self.load_names_by_id(ConceptReferenceSource)
+
+    @staticmethod
+    def load_names_by_id(model):
+        return dict(model.objects.values_list(model._meta.pk.name, 'name'))
+
+    def intern(self, value):
+        """ Returns a shared copy of a string that is repeated across the dictionary, e.g. a locale """
+        return self.strings.setdefault(value, value)
+
+    @staticmethod
+    def filter_concept_range(queryset, concept_field, concept_range):
+        """
+        Limits a queryset of related rows to a range of concept IDs, as a tuple of the first and
+        last ID, or to a list of concept IDs, if specified
+        """
+        if concept_range is None:
+            return queryset
+        if isinstance(concept_range, list):
+            return queryset.filter(**{'%s__in' % concept_field: concept_range})
+        return queryset.filter(**{
+            '%s__gte' % concept_field: concept_range[0],
+            '%s__lte' % concept_field: concept_range[1],
+        })
+
+    def iter_related_rows(self, queryset, concept_field, concept_range, *fields):
+        """
+        Generator that yields (ConceptRecord, row) for each row of a related table, as a tuple of
+        fields, in primary key order. Rows of concepts that are not loaded are skipped.
+        """
+        queryset = self.filter_concept_range(queryset, concept_field, concept_range)
+        concepts = self.concepts
+        for row in queryset.order_by('pk').values_list(concept_field, *fields).iterator():
+            concept = concepts.get(row[0])
+            if concept is not None:
+                yield concept, row
+
+    def load_names(self, concept_range):
+        intern = self.intern
+        for concept, row in self.iter_related_rows(
+                ConceptName.objects.filter(voided=False), 'concept', concept_range,
+                'name', 'locale', 'concept_name_type', 'locale_preferred', 'uuid'):
+            if not concept.names:
+                concept.names = []
+            concept.names.append(NameRecord(
+                row[1], intern(row[2]), intern(row[3]), row[4], row[5]))
+
+    def load_descriptions(self, concept_range):
+        intern = self.intern
+        for concept, row in self.iter_related_rows(
+                ConceptDescription.objects.all(), 'concept', concept_range,
+                'description', 'locale', 'uuid'):
+            if not concept.descriptions:
+                concept.descriptions = []
+            concept.descriptions.append(DescriptionRecord(row[1], intern(row[2]), row[3]))
+
+    def load_numerics(self, concept_range):
+        for concept, row in self.iter_related_rows(
+                ConceptNumeric.objects.all(), 'concept', concept_range, *NumericRecord.FIELDS):
+            concept.numeric = NumericRecord(*row[1:])
+
+    def load_complex_handlers(self, concept_range):
+        for concept, row in self.iter_related_rows(
+                ConceptComplex.objects.all(), 'concept', concept_range, 'handler'):
+            concept.handler = row[1]
+
+    def load_reference_maps(self, concept_range):
+        map_types = self.map_types
+        sources = self.sources
+        for concept, row in self.iter_related_rows(
+                ConceptReferenceMap.objects.all(), 'concept', concept_range,
+                'concept_map_id', 'map_type', 'concept_reference_term__concept_source',
+                'concept_reference_term__code', 'concept_reference_term__name', 'uuid'):
+            if not concept.reference_maps:
+                concept.reference_maps = []
+            concept.reference_maps.append(ReferenceMapRecord(
+                row[1], map_types.get(row[2]), sources.get(row[3]), row[4], row[5], row[6]))
+
+    def load_relations(self, model, owner_field, concept_field, attribute, concept_range):
+        """ Loads the answers or set members of the concepts into ConceptRelations """
+        for concept, row in self.iter_related_rows(
+                model.objects.all(), owner_field, concept_range,
+                model._meta.pk.name, concept_field, 'sort_weight', 'uuid'):
+            relations = getattr(concept, attribute)
+            if relations is NO_RELATIONS:
+                relations = ConceptRelations()
+                setattr(concept, attribute, relations)
+            relations.append(*row[1:])
+
+    def __len__(self):
+        return len(self.concepts)
+
+    def __iter__(self):
+        """ Yields the loaded ConceptRecords in concept_id order """
+        concepts = self.concepts
+        for concept_id in sorted(concepts):
+            yield concepts[concept_id]
+
+    def __contains__(self, concept_id):
+        return concept_id in self.concepts
+
+    def get(self, concept_id):
+        """ Returns the ConceptRecord of a loaded concept, or None """
+        return self.concepts.get(concept_id)
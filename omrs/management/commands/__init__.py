@@ -1,4 +1,11 @@
 """ Init for commands """
+import csv
+import gzip
+import io
+import json
+import sys
+import zlib
+from django.core.management import CommandError
 
 
 class UnrecognizedSourceException(Exception):
@@ -6,6 +13,113 @@ class UnrecognizedSourceException(Exception):
     pass
 
 
+# Supported compression formats, inferred from the file extension when writing and detected
+# from the magic number when reading. zstd requires the optional zstandard package.
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_NONE = 'none'
+COMPRESSION_EXTENSIONS = {'.gz': COMPRESSION_GZIP, '.zst': COMPRESSION_ZSTD}
+COMPRESSION_MAGIC_NUMBERS = {'\x1f\x8b': COMPRESSION_GZIP, '\x28\xb5\x2f\xfd': COMPRESSION_ZSTD}
+GZIP_COMPRESSION_LEVEL = 6
+ZSTD_COMPRESSION_LEVEL = 3
+
+
+def import_zstandard():
+    """ Returns the optional zstandard module, raising an exception if it is not installed """
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd compression requires the zstandard package: pip install zstandard')
+    return zstandard
+
+
+def get_output_compression(filename, compression=None):
+    """
+    Returns the compression format for an output file: compression if specified, otherwise
+    the format matching the file extension, or COMPRESSION_NONE
+    """
+    if compression:
+        return compression
+    for extension, extension_compression in COMPRESSION_EXTENSIONS.items():
+        if filename and filename.lower().endswith(extension):
+            return extension_compression
+    return COMPRESSION_NONE
+
+
+def get_input_compression(filename):
+    """ Returns the compression format of a file based on its magic number, or COMPRESSION_NONE """
+    with open(filename, 'rb') as input_file:
+        header = input_file.read(4)
+    for magic_number, compression in COMPRESSION_MAGIC_NUMBERS.items():
+        if header.startswith(magic_number):
+            return compression
+    return COMPRESSION_NONE
+
+
+def open_output_file(filename, compression=None):
+    """
+    Returns a file opened for writing, or stdout if no filename specified, that compresses its
+    output with gzip or zstd if requested or if the filename ends with .gz or .zst
+    """
+    output_file = open(filename, 'wb') if filename else sys.stdout
+    compression = get_output_compression(filename, compression=compression)
+    if compression == COMPRESSION_GZIP:
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        return CompressedOutputFile(output_file, zlib.compressobj(
+            GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+    elif compression == COMPRESSION_ZSTD:
+        return CompressedOutputFile(output_file, import_zstandard().ZstdCompressor(
+            level=ZSTD_COMPRESSION_LEVEL).compressobj())
+    elif compression != COMPRESSION_NONE:
+        raise Exception('Unrecognized compression "%s"' % compression)
+    return output_file
+
+
+def open_input_file(filename):
+    """
+    Returns a file opened for reading that transparently decompresses gzip or zstd files,
+    detected by their magic number. Uncompressed files are opened as is.
+    """
+    compression = get_input_compression(filename)
+    if compression == COMPRESSION_GZIP:
+        return io.BufferedReader(gzip.open(filename, 'rb'))
+    elif compression == COMPRESSION_ZSTD:
+        return io.BufferedReader(import_zstandard().ZstdDecompressor().stream_reader(
+            open(filename, 'rb')))
+    return open(filename, 'rb')
+
+
+class CompressedOutputFile(object):
+    """
+    Write-only file object that compresses data with a streaming compressor (e.g. a zlib or
+    zstandard compressobj) as it is written. flush() only flushes the compressed data produced
+    so far, without flushing the compressor, so that flushing after every resource does not
+    degrade compression. The compressed stream is completed when the file is closed.
+    """
+
+    def __init__(self, raw_file, compressor):
+        self.raw_file = raw_file
+        self.compressor = compressor
+
+    def write(self, data):
+        """ Compresses data and writes any compressed output to the underlying file """
+        compressed_data = self.compressor.compress(data)
+        if compressed_data:
+            self.raw_file.write(compressed_data)
+
+    def flush(self):
+        """ Flushes the underlying file """
+        self.raw_file.flush()
+
+    def close(self):
+        """ Completes the compressed stream and closes the underlying file, unless it is stdout """
+        self.raw_file.write(self.compressor.flush())
+        if self.raw_file is sys.stdout:
+            self.raw_file.flush()
+        else:
+            self.raw_file.close()
+
+
 class OclOpenmrsHelper(object):
     """ Helper class for OpenMRS exporter and validator """
 
@@ -136,10 +250,6 @@ class OclOpenmrsHelper(object):
             'owner_type': 'org', 'owner_id': 'WHO'},
         {'omrs_id': 'WHO-HIV-DAK', 'ocl_id': 'WHO-HIV-DAK', 
             'owner_type': 'org', 'owner_id': 'WHO'},
-        {'omrs_id': 'org.openmrs.module.mirebalaisreports', 'ocl_id': 'org.openmrs.module.mirebalaisreports',
-         'owner_type': 'org', 'owner_id': 'PIH'},
-        {'omrs_id': 'Liberia MoH', 'ocl_id': 'LiberiaMOH',
-         'owner_type': 'org', 'owner_id': 'PIH'},
         {'omrs_id': 'OMOP RxNORM Extension', 'ocl_id': 'OMOP-RxNORM',
             'owner_type': 'org', 'owner_id': 'OHDSI'},
         {'omrs_id': 'OMOP Extension', 'ocl_id': 'OMOP-Extension',
@@ -155,6 +265,75 @@ class OclOpenmrsHelper(object):
         # {'omrs_id': 'NHDD', 'ocl_id': 'KenyaEMR', 'owner_type': 'org', 'owner_id': 'KenyaMOH'},
     ]
 
+    # Required fields for each source in the SOURCE_DIRECTORY
+    SOURCE_DIRECTORY_FIELDS = ['owner_type', 'owner_id', 'omrs_id', 'ocl_id']
+
+    # Memoized indexes of the SOURCE_DIRECTORY keyed by 'omrs_id' and 'ocl_id'
+    _source_index = None
+    _source_index_directory = None
+
+    @classmethod
+    def load_source_directory(cls, filename):
+        """
+        Replaces the SOURCE_DIRECTORY with the sources defined in a JSON file (a list of source
+        dictionaries) or a CSV file (with owner_type, owner_id, omrs_id and ocl_id columns).
+        Returns a list of warnings for duplicate or conflicting entries in the file. Raises a
+        CommandError if the file cannot be read or is not a valid source directory.
+        """
+        try:
+            with open(filename, 'rb') as input_file:
+                if filename.lower().endswith('.csv'):
+                    source_directory = [dict(row) for row in csv.DictReader(input_file)]
+                else:
+                    source_directory = json.load(input_file)
+        except (IOError, ValueError, csv.Error) as e:
+            raise CommandError('Unable to load source directory "%s": %s' % (filename, e))
+        if not isinstance(source_directory, list):
+            raise CommandError('Source directory "%s" must contain a list of sources.' % filename)
+        for num, src in enumerate(source_directory):
+            if not isinstance(src, dict):
+                raise CommandError('Source %s in source directory "%s" is not an object' % (
+                    num + 1, filename))
+            missing_fields = [field for field in cls.SOURCE_DIRECTORY_FIELDS if not src.get(field)]
+            if missing_fields:
+                raise CommandError('Source %s in source directory "%s" is missing: %s' % (
+                    num + 1, filename, ', '.join(missing_fields)))
+        cls.SOURCE_DIRECTORY = source_directory
+        return cls.get_source_index()['warnings']
+
+    @classmethod
+    def get_source_index(cls):
+        """
+        Returns indexes of the SOURCE_DIRECTORY keyed by 'omrs_id' and by 'ocl_id', along with
+        warnings for any duplicate or conflicting entries. The indexes are built once and rebuilt
+        only if the SOURCE_DIRECTORY is replaced. As with a linear search of the directory, the
+        first entry wins if an ID appears more than once.
+        """
+        if cls._source_index is not None and cls._source_index_directory is cls.SOURCE_DIRECTORY:
+            return cls._source_index
+        source_index = {'omrs_id': {}, 'ocl_id': {}, 'warnings': []}
+        for src in cls.SOURCE_DIRECTORY:
+            existing_src = source_index['omrs_id'].get(src['omrs_id'])
+            if existing_src is None:
+                source_index['omrs_id'][src['omrs_id']] = src
+            elif existing_src == src:
+                source_index['warnings'].append(
+                    'Duplicate source directory entry for omrs_id "%s"' % src['omrs_id'])
+            else:
+                source_index['warnings'].append(
+                    'Conflicting source directory entries for omrs_id "%s": %s and %s' % (
+                        src['omrs_id'], json.dumps(existing_src), json.dumps(src)))
+            existing_src = source_index['ocl_id'].get(src['ocl_id'])
+            if existing_src is None:
+                source_index['ocl_id'][src['ocl_id']] = src
+            elif existing_src['owner_id'] != src['owner_id']:
+                source_index['warnings'].append(
+                    'Conflicting owners for ocl_id "%s": "%s" and "%s"' % (
+                        src['ocl_id'], existing_src['owner_id'], src['owner_id']))
+        cls._source_index = source_index
+        cls._source_index_directory = cls.SOURCE_DIRECTORY
+        return source_index
+
     @classmethod
     def get_source_owner_id(cls, omrs_source_id=None, ocl_source_id=None):
         """ Returns the owner ID for the specified source """
@@ -170,24 +349,24 @@ class OclOpenmrsHelper(object):
         else:
             raise Exception(
                 'Must pass omrs_source_id or ocl_source_id. Neither provided.')
-        for src in cls.SOURCE_DIRECTORY:
-            if src[source_id_type] == source_id:
-                return src['owner_id']
+        src = cls.get_source_index()[source_id_type].get(source_id)
+        if src is not None:
+            return src['owner_id']
         raise UnrecognizedSourceException(
             'Source %s not found in source directory.' % source_id)
 
     @classmethod
     def get_ocl_source_id_from_omrs_id(cls, omrs_source_id):
-        for src in cls.SOURCE_DIRECTORY:
-            if src['omrs_id'] == omrs_source_id:
-                return src['ocl_id']
+        src = cls.get_source_index()['omrs_id'].get(omrs_source_id)
+        if src is not None:
+            return src['ocl_id']
         raise UnrecognizedSourceException(
             'Source %s not found in source directory.' % omrs_source_id)
 
     @classmethod
     def get_omrs_source_id_from_ocl_id(cls, ocl_source_id):
-        for src in cls.SOURCE_DIRECTORY:
-            if src['ocl_id'] == ocl_source_id:
-                return src['omrs_id']
+        src = cls.get_source_index()['ocl_id'].get(ocl_source_id)
+        if src is not None:
+            return src['omrs_id']
         raise UnrecognizedSourceException(
             'Source %s not found in source directory.' % ocl_source_id)
@@ -0,0 +1,293 @@
+"""
+Command to benchmark extract_db and validate_export against the configured concept dictionary,
+typically a synthetic dictionary created with generate_dictionary.
+
+Example usage:
+
+    OMRS_SQLITE_DB=local/synthetic.db python manage.py generate_dictionary --create_tables
+    OMRS_SQLITE_DB=local/synthetic.db python manage.py benchmark --results=local/benchmarks.jsonl
+        --compare=local/benchmarks.jsonl
+
+extract_db exports the dictionary to a JSON lines file, which validate_export then validates. Each
+command runs in its own process and is measured for:
+- concepts per second
+- SQL queries per concept (queries run by extract_db --workers processes are not counted)
+- peak resident set size of the process and any worker processes it starts, which includes the
+  memory already used by Django when the process starts
+- output bytes: the size of the export for extract_db and of the report printed by validate_export
+
+Results are appended as a JSON line to --results. Pass --compare to compare them with the last
+run recorded in a results file; the command fails if a metric regressed by more than --threshold.
+
+"""
+from optparse import make_option
+import datetime
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from django.core.management import BaseCommand, CommandError, load_command_class
+from django.db import connection
+from omrs.profiling import QueryCounter, get_peak_rss_bytes
+
+
+class Command(BaseCommand):
+    """ Benchmark extract_db and validate_export """
+
+    COMMANDS = ['extract_db', 'validate_export']
+
+    # Metrics compared between runs, with whether a higher value is better
+    METRICS = [
+        ('concepts_per_second', True),
+        ('queries_per_concept', False),
+        ('peak_rss_bytes', False),
+        ('output_bytes', False),
+    ]
+    DEFAULT_THRESHOLD = 0.1
+
+    help = 'Benchmark extract_db and validate_export against the configured concept dictionary.'
+    option_list = BaseCommand.option_list + (
+        make_option('--org_id',
+                    action='store',
+                    dest='org_id',
+                    default='CIEL',
+                    help='Owner of the exported source. Default is CIEL.'),
+        make_option('--source_id',
+                    action='store',
+                    dest='source_id',
+                    default='CIEL',
+                    help='ID of the exported source. Default is CIEL.'),
+        make_option('--commands',
+                    action='store',
+                    dest='commands',
+                    default=','.join(COMMANDS),
+                    help='Comma-separated commands to benchmark. Default is %s.' % ','.join(COMMANDS)),
+        make_option('--extract_db_options',
+                    action='store',
+                    dest='extract_db_options',
+                    default='',
+                    help='Additional options passed to extract_db, e.g. "--chunk_size=500".'),
+        make_option('--validate_export_options',
+                    action='store',
+                    dest='validate_export_options',
+                    default='',
+                    help='Additional options passed to validate_export.'),
+        make_option('--repeat',
+                    action='store',
+                    dest='repeat',
+                    default=1,
+                    help='Number of times each command is run; the fastest run is kept. Default is 1.'),
+        make_option('--label',
+                    action='store',
+                    dest='label',
+                    default='',
+                    help='Label recorded with the results, e.g. a git commit.'),
+        make_option('--results',
+                    action='store',
+                    dest='results_filename',
+                    default=None,
+                    help='Append the results as a JSON line to this file.'),
+        make_option('--compare',
+                    action='store',
+                    dest='compare_filename',
+                    default=None,
+                    help='Compare the results with the last run recorded in this results file.'),
+        make_option('--threshold',
+                    action='store',
+                    dest='threshold',
+                    default=DEFAULT_THRESHOLD,
+                    help=('Relative change of a metric that is reported as a regression. '
+                          'Default is %s.' % DEFAULT_THRESHOLD)),
+        make_option('--work_dir',
+                    action='store',
+                    dest='work_dir',
+                    default=None,
+                    help=('Directory for the export and the output of each command; default is a '
+                          'temporary directory that is deleted afterwards.')),
+    )
+
+    def handle(self, *args, **options):
+        # Handle command line arguments
+        self.org_id = options['org_id']
+        self.source_id = options['source_id']
+        self.commands = [name.strip() for name in options['commands'].split(',') if name.strip()]
+        self.command_options = {
+            'extract_db': shlex.split(options['extract_db_options']),
+            'validate_export': shlex.split(options['validate_export_options']),
+        }
+        self.repeat = int(options['repeat'])
+        self.threshold = float(options['threshold'])
+        self.verbosity = int(options['verbosity'])
+        for name in self.commands:
+            if name not in self.COMMANDS:
+                raise CommandError('Unrecognized command "%s"; must be one of: %s' % (
+                    name, ', '.join(self.COMMANDS)))
+        if 'validate_export' in self.commands and 'extract_db' not in self.commands:
+            raise CommandError('validate_export is benchmarked on the output of extract_db')
+
+        # Load the previous run before the results file is appended to, as it may be the same file
+        previous_results = None
+        if options['compare_filename']:
+            previous_results = self.load_last_results(options['compare_filename'])
+
+        work_dir = options['work_dir'] or tempfile.mkdtemp(prefix='ocl-omrs-benchmark-')
+        try:
+            results = self.run_benchmarks(work_dir, options['label'])
+        finally:
+            if not options['work_dir']:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.print_results(results)
+        if options['results_filename']:
+            with open(options['results_filename'], 'ab') as results_file:
+                results_file.write(json.dumps(results, sort_keys=True) + '\n')
+            print 'Results appended to "%s"' % options['results_filename']
+        if previous_results:
+            regressions = self.compare_results(previous_results, results)
+            if regressions:
+                raise CommandError('%d metric(s) regressed by more than %d%%: %s' % (
+                    len(regressions), self.threshold * 100, ', '.join(regressions)))
+
+    def run_benchmarks(self, work_dir, label):
+        """ Runs each command and returns the results of the run """
+        export_filename = os.path.join(work_dir, 'export.json')
+        argvs = {
+            'extract_db': [
+                '--org_id=%s' % self.org_id, '--source_id=%s' % self.source_id, '--concepts',
+                '--mappings', '--format=bulk', '--output=%s' % export_filename],
+            'validate_export': ['--export=%s' % export_filename],
+        }
+        results = {
+            'label': label,
+            'date': datetime.datetime.now().isoformat(),
+            'database': {
+                'engine': connection.settings_dict['ENGINE'],
+                'name': connection.settings_dict['NAME'],
+            },
+            'commands': {},
+        }
+        num_concepts = None
+        for name in self.commands:
+            argv = argvs[name] + self.command_options[name]
+            best_run = None
+            for num in range(self.repeat):
+                if self.verbosity:
+                    print 'Running %s %s (run %d of %d)...' % (name, ' '.join(argv), num + 1, self.repeat)
+                command_run = self.run_command(name, argv, os.path.join(work_dir, '%s.log' % name))
+                if best_run is None or command_run['seconds'] < best_run['seconds']:
+                    best_run = command_run
+            if name == 'extract_db':
+                num_concepts = best_run['concepts']
+                best_run['output_bytes'] = os.path.getsize(export_filename)
+            else:
+                # validate_export checks the concepts exported by extract_db
+                best_run['concepts'] = num_concepts
+            best_run['concepts_per_second'] = round(
+                best_run['concepts'] / best_run['seconds'], 1) if best_run['seconds'] else None
+            best_run['queries_per_concept'] = round(
+                best_run['queries'] / float(best_run['concepts']), 3) if best_run['concepts'] else None
+            results['commands'][name] = best_run
+        return results
+
+    def run_command(self, name, argv, log_filename):
+        """
+        Runs a management command in a child process with its output written to log_filename, and
+        returns its measurements. The database connection is closed first so that the child opens
+        its own.
+        """
+        connection.close()
+        result_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run_measured_command, args=(name, argv, log_filename, result_queue))
+        process.start()
+        command_run, error = result_queue.get()
+        process.join()
+        if error:
+            raise CommandError('%s failed (see "%s"):\n%s' % (name, log_filename, error))
+        return command_run
+
+    def print_results(self, results):
+        """ Displays the measurements of each command """
+        for name in self.commands:
+            command_run = results['commands'][name]
+            print '\n%s:' % name
+            print '  Concepts: %s in %.2f seconds (%s concepts/sec)' % (
+                command_run['concepts'], command_run['seconds'], command_run['concepts_per_second'])
+            print '  SQL queries: %d in %.2f seconds (%s per concept)' % (
+                command_run['queries'], command_run['query_seconds'], command_run['queries_per_concept'])
+            print '  Peak RSS: %.1f MB' % (command_run['peak_rss_bytes'] / 1048576.0)
+            print '  Output: %d bytes' % command_run['output_bytes']
+
+    @staticmethod
+    def load_last_results(filename):
+        """ Returns the last results recorded in a results file, or None if there are none """
+        if not os.path.exists(filename):
+            return None
+        last_results = None
+        with open(filename, 'rb') as results_file:
+            for line in results_file:
+                if line.strip():
+                    last_results = json.loads(line)
+        return last_results
+
+    def compare_results(self, previous_results, results):
+        """
+        Displays the change of each metric since the previous run and returns a list of the metrics
+        that regressed by more than the threshold
+        """
+        print '\nComparison with the run of %s%s:' % (
+            previous_results['date'], ' (%s)' % previous_results['label'] if previous_results['label'] else '')
+        regressions = []
+        for name in self.commands:
+            previous_run = previous_results['commands'].get(name)
+            if not previous_run:
+                continue
+            for metric, higher_is_better in self.METRICS:
+                previous_value = previous_run.get(metric)
+                value = results['commands'][name].get(metric)
+                if not previous_value or value is None:
+                    continue
+                change = (value - previous_value) / float(previous_value)
+                regressed = (-change if higher_is_better else change) > self.threshold
+                print '  %s %s: %s -> %s (%+.1f%%)%s' % (
+                    name, metric, previous_value, value, change * 100,
+                    ' REGRESSION' if regressed else '')
+                if regressed:
+                    regressions.append('%s %s' % (name, metric))
+        return regressions
+
+
+def run_measured_command(name, argv, log_filename, result_queue):
+    """
+    Runs a management command with its output redirected to log_filename and puts a tuple of its
+    measurements and an error message, if it failed, on result_queue. Runs in a child process.
+    """
+    with open(log_filename, 'wb') as log_file:
+        sys.stdout.flush()
+        os.dup2(log_file.fileno(), sys.stdout.fileno())
+        command = load_command_class('omrs', name)
+        options, args = command.create_parser('manage.py', name).parse_args(argv)
+        query_counter = QueryCounter()
+        start_time = time.time()
+        error = None
+        try:
+            with query_counter:
+                command.execute(*args, **vars(options))
+        except BaseException:
+            error = traceback.format_exc()
+        seconds = time.time() - start_time
+        sys.stdout.flush()
+    command_run = {
+        'seconds': round(seconds, 3),
+        'concepts': getattr(command, 'cnt_total_concepts_processed', None),
+        'queries': query_counter.count,
+        'query_seconds': round(query_counter.seconds, 3),
+        'peak_rss_bytes': max(get_peak_rss_bytes(), get_peak_rss_bytes(children=True)),
+        'output_bytes': os.path.getsize(log_filename),
+    }
+    result_queue.put((command_run, error))
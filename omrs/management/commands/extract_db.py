@@ -38,6 +38,10 @@ Commands to create JSON for importing OpenMRS v1.11 concept dictionary into OCL.
    If a source is missing in the SOURCE_DIRECTORY, simply update or add a source mapping to reflect
    the missing omrs_id.
 
+   Alternatively, keep a separate source directory for each dictionary in a JSON file (a list of
+   source definitions like the one above) or a CSV file (with owner_type, owner_id, omrs_id and
+   ocl_id columns) and pass it to extract_db and validate_export with --source_directory=FILE.
+
    If a source is missing in OCL, you may either add that source directly or contact an OCL
    administrator.
 
@@ -52,23 +56,76 @@ Commands to create JSON for importing OpenMRS v1.11 concept dictionary into OCL.
     python manage.py extract_db --org_id=MyOrg --source_id=MySource -v0 --concepts --mappings
         --format=bulk > my_ocl_bulk_import_file.json
 
+   Or write directly to a file instead of stdout:
+
+    python manage.py extract_db --org_id=MyOrg --source_id=MySource -v0 --concepts --mappings
+        --format=bulk --output=my_ocl_bulk_import_file.json
+
 6. Alternatively, create "old-style" OCL import scripts (separate for concept and mappings)
     designed to be run directly on OCL server:
 
     python manage.py extract_db --org_id=MyOrg --source_id=MySource -v0 --concepts > concepts.json
     python manage.py extract_db --org_id=MyOrg --source_id=MySource -v0 --mappings > mappings.json
 
+   Or write both files from a single pass through the database:
+
+    python manage.py extract_db --org_id=MyOrg --source_id=MySource -v0
+        --concepts-output=concepts.json --mappings-output=mappings.json
+
 NOTES:
 - OCL does not handle the OpenMRS drug table -- it is ignored for now
+- Resources are written as JSON lines as soon as they are generated. Mappings are spooled to a
+  temporary file and appended after the last concept, so memory use does not grow with the size
+  of the dictionary
+- Concepts are loaded in chunks together with their names, descriptions, mappings, answers and
+  set members into a compact in-memory model (see omrs/dictionary.py and --chunk_size), with one
+  query per table per chunk; use --in_memory to load the whole dictionary at once instead.
+  Chunks are paged through by concept_id, so memory use does not depend on the number of concepts
+- Use --concept_ids_file=FILE to export the concepts listed in FILE and all of the set members
+  and answers they reference, transitively; the references are followed breadth first with one
+  IN query per table for each level
+- Use --manifest=FILE for incremental exports: the first run exports everything and records a
+  watermark in FILE, and later runs only export concepts whose own dates, or the dates of their
+  names, descriptions, answers, set members or reference maps, are on or after that watermark
+- Use --workers=N to split the export across N processes that each export a range of concept
+  IDs from the same database snapshot; the output is identical to a single-process export
+- Output files ending in .gz or .zst are compressed with gzip or zstd as they are written (zstd
+  requires the zstandard package); use --compression to compress stdout
+- Use --profile to display the wall time and SQL queries of each phase of the export and the peak
+  memory use, and --profile_output=FILE to also write cProfile stats to FILE
 
 """
 from optparse import make_option
 import requests
 import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import bisect
+import datetime
+import operator
+import re
+import time
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from django.conf import settings
 from django.core.management import BaseCommand, CommandError
-from omrs.models import Concept, ConceptReferenceSource, ConceptReferenceMap
-from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import ocldev.oclresourcelist
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import dateparse, timezone
+from omrs.models import (
+    Concept, ConceptAnswer, ConceptDescription, ConceptName, ConceptReferenceMap,
+    ConceptReferenceSource, ConceptSet)
+from omrs.management.commands import (
+    OclOpenmrsHelper, UnrecognizedSourceException, open_output_file,
+    COMPRESSION_GZIP, COMPRESSION_ZSTD, COMPRESSION_NONE)
+from omrs.dictionary import ConceptDictionary
+from omrs.profiling import CommandProfiler
 import urllib
 
 
@@ -80,6 +137,46 @@ class Command(BaseCommand):
     OCL_IMPORT_FILE_FORMATS = [
         OCL_IMPORT_FILE_FORMAT_STANDARD, OCL_IMPORT_FILE_FORMAT_BULK]
 
+    # Settings for fetching reference sources from OCL in check_sources
+    DEFAULT_SOURCE_CHECK_WORKERS = 8
+    DEFAULT_SOURCE_CACHE_TTL = 24 * 60 * 60
+    SOURCE_CHECK_RETRIES = 3
+    SOURCE_CHECK_TIMEOUT_SECONDS = 30
+
+    # Seconds between checks that parallel export workers that have not reported yet are alive
+    WORKER_POLL_SECONDS = 1
+
+    # Number of concepts whose related rows are fetched together in a single batch of queries
+    DEFAULT_CHUNK_SIZE = 2000
+
+    # Export counters, which are added up across worker processes for parallel exports
+    EXPORT_COUNTERS = [
+        'cnt_total_concepts_processed',
+        'cnt_concepts_exported',
+        'cnt_internal_mappings_exported',
+        'cnt_external_mappings_exported',
+        'cnt_ignored_self_mappings',
+        'cnt_questions_exported',
+        'cnt_answers_exported',
+        'cnt_skipped_drug_answers',
+        'cnt_concept_sets_exported',
+        'cnt_set_members_exported',
+        'cnt_retired_concepts_exported',
+    ]
+
+    # Date fields checked by an incremental export, by model, with the field that links a changed
+    # row to the concept that must be exported again
+    INCREMENTAL_DATE_FIELDS = [
+        (Concept, 'concept_id', ['date_created', 'date_changed', 'date_retired']),
+        (ConceptName, 'concept_id', ['date_created', 'date_voided']),
+        (ConceptDescription, 'concept_id', ['date_created', 'date_changed']),
+        (ConceptAnswer, 'question_concept_id', ['date_created']),
+        (ConceptSet, 'concept_set_owner_id', ['date_created']),
+        (ConceptReferenceMap, 'concept_id', [
+            'date_created', 'date_changed', 'concept_reference_term__date_changed',
+            'concept_reference_term__date_retired']),
+    ]
+
     # Command attributes
     help = 'Extract concepts from OpenMRS database in the form of json'
     option_list = BaseCommand.option_list + (
@@ -88,11 +185,39 @@ class Command(BaseCommand):
                     dest='concept_id',
                     default=None,
                     help='ID for concept to export, if specified only export this one. e.g. 5839'),
+        make_option('--concept_ids_file',
+                    action='store',
+                    dest='concept_ids_filename',
+                    default=None,
+                    help=('File of concept IDs to export, separated by whitespace or commas, '
+                          'together with all of the set members and answers they reference, '
+                          'transitively. Lines starting with "#" are ignored.')),
         make_option('--concept_limit',
                     action='store',
                     dest='concept_limit',
                     default=None,
-                    help='Use to limit the number of concepts exported. Useful for testing.'),
+                    help=('Use to limit the number of concepts exported to the first N concepts '
+                          'in concept_id order. Useful for testing.')),
+        make_option('--chunk_size',
+                    action='store',
+                    dest='chunk_size',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help=('Number of concepts whose names, descriptions, mappings, answers and set '
+                          'members are loaded together in bulk, i.e. the page size when paging '
+                          'through concepts by concept_id; set to 0 to load each concept '
+                          'individually. Default is %s.' % DEFAULT_CHUNK_SIZE)),
+        make_option('--in_memory',
+                    action='store_true',
+                    dest='in_memory',
+                    default=False,
+                    help=('Load all of the exported concepts into memory at once, with one query '
+                          'per table, instead of in chunks')),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=1,
+                    help=('Number of worker processes that each export a range of concept IDs; '
+                          'shard outputs are merged in concept_id order. Default is 1.')),
         make_option('--mappings',
                     action='store_true',
                     dest='mapping',
@@ -108,6 +233,30 @@ class Command(BaseCommand):
                     dest='indent',
                     default=None,
                     help='Indent JSON output for human-readability; default is 0.'),
+        make_option('--output',
+                    action='store',
+                    dest='output_filename',
+                    default=None,
+                    help='File to write the JSON export to; default is stdout.'),
+        make_option('--concepts-output',
+                    action='store',
+                    dest='concepts_output_filename',
+                    default=None,
+                    help='Export concepts to this file; may be combined with --mappings-output '
+                         'to write concepts and mappings to separate files in a single pass.'),
+        make_option('--mappings-output',
+                    action='store',
+                    dest='mappings_output_filename',
+                    default=None,
+                    help='Export mappings to this file; may be combined with --concepts-output '
+                         'to write concepts and mappings to separate files in a single pass.'),
+        make_option('--compression',
+                    action='store',
+                    dest='compression',
+                    choices=[COMPRESSION_GZIP, COMPRESSION_ZSTD, COMPRESSION_NONE],
+                    default=None,
+                    help='Compress the output with gzip or zstd; default is based on the output '
+                         'file extension (.gz or .zst), or no compression for stdout.'),
         make_option('--org_id',
                     action='store',
                     dest='org_id',
@@ -123,6 +272,23 @@ class Command(BaseCommand):
                     dest='check_sources',
                     default=False,
                     help='Validates that all reference sources in OpenMRS have been defined in OCL.'),
+        make_option('--source_check_workers',
+                    action='store',
+                    dest='source_check_workers',
+                    default=DEFAULT_SOURCE_CHECK_WORKERS,
+                    help=('Maximum number of concurrent requests to OCL when checking sources. '
+                          'Default is %s.' % DEFAULT_SOURCE_CHECK_WORKERS)),
+        make_option('--source_cache',
+                    action='store',
+                    dest='source_cache_filename',
+                    default=None,
+                    help='File used to cache OCL org and source lookups between runs'),
+        make_option('--source_cache_ttl',
+                    action='store',
+                    dest='source_cache_ttl',
+                    default=DEFAULT_SOURCE_CACHE_TTL,
+                    help=('Number of seconds cached OCL org and source lookups remain valid. '
+                          'Default is %s.' % DEFAULT_SOURCE_CACHE_TTL)),
         make_option('--format',
                     action='store',
                     dest='ocl_import_file_format',
@@ -138,12 +304,42 @@ class Command(BaseCommand):
                     dest='token',
                     default='',
                     help='OCL API token to validate OpenMRS reference sources'),
+        make_option('--manifest',
+                    action='store',
+                    dest='manifest_filename',
+                    default=None,
+                    help=('Manifest file for incremental exports. If the file exists, only '
+                          'concepts changed since the watermark it records are exported. The '
+                          'manifest is updated with a new watermark after each export.')),
+        make_option('--since',
+                    action='store',
+                    dest='since',
+                    default=None,
+                    help=('Only export concepts changed since this date and time, e.g. '
+                          '"2020-08-22 00:00:00"; overrides the watermark in --manifest')),
+        make_option('--source_directory',
+                    action='store',
+                    dest='source_directory_filename',
+                    default=None,
+                    help=('JSON or CSV file of OpenMRS-to-OCL source definitions to use instead '
+                          'of the built-in SOURCE_DIRECTORY')),
         make_option('--use_gold_mappings',
                     action='store',
                     choices=['0','1'],
                     dest='use_gold_mappings',
                     default='0',
                     help='Set to "1" if gold mappings should be used'),
+        make_option('--profile',
+                    action='store_true',
+                    dest='profile',
+                    default=False,
+                    help=('Display the wall time and SQL queries of each phase of the export and '
+                          'the peak memory use. Written to stderr if the export is written to stdout.')),
+        make_option('--profile_output',
+                    action='store',
+                    dest='profile_output_filename',
+                    default=None,
+                    help='Also profile the export with cProfile and write the stats to this file.'),
     )
 
     def handle(self, *args, **options):
@@ -156,18 +352,33 @@ class Command(BaseCommand):
         self.source_id = options['source_id']
         self.concept_id = options['concept_id']
         self.concept_limit = options['concept_limit']
+        self.concept_ids_filename = options['concept_ids_filename']
         self.indent = options['indent']
-        self.do_mapping = options['mapping']
-        self.do_concept = options['concept']
+        self.output_filename = options['output_filename']
+        self.concepts_output_filename = options['concepts_output_filename']
+        self.mappings_output_filename = options['mappings_output_filename']
+        self.compression = options['compression']
+        self.do_mapping = options['mapping'] or bool(self.mappings_output_filename)
+        self.do_concept = options['concept'] or bool(self.concepts_output_filename)
         if self.concept_limit is not None:
             self.concept_limit = int(self.concept_limit)
+        self.chunk_size = int(options['chunk_size'])
+        self.in_memory = options['in_memory']
+        self.workers = int(options['workers'])
         self.verbosity = int(options['verbosity'])
         self.ocl_api_token = options['token']
         self.ocl_api_env = ''
         if options['ocl_api_env']:
             self.ocl_api_env = options['ocl_api_env'].lower()
         self.ocl_import_file_format = options['ocl_import_file_format']
+        self.source_check_workers = int(options['source_check_workers'])
+        self.source_cache_filename = options['source_cache_filename']
+        self.source_cache_ttl = int(options['source_cache_ttl'])
         self.use_gold_mappings = options['use_gold_mappings'] == '1'
+        self.manifest_filename = options['manifest_filename']
+        self.since = self.parse_datetime_option('since', options['since'])
+        self.profiler = CommandProfiler(
+            enabled=options['profile'], cprofile_filename=options['profile_output_filename'])
 
         # Option debug output
         if self.verbosity >= 2:
@@ -175,35 +386,56 @@ class Command(BaseCommand):
 
         # Validate the options
         self.validate_options()
+        self.profiler.start()
+
+        # Load the source directory, if specified, and flag duplicate entries
+        if options['source_directory_filename']:
+            for warning in OclOpenmrsHelper.load_source_directory(
+                    options['source_directory_filename']):
+                print >> sys.stderr, 'WARNING: %s' % warning
 
         # Validate reference sources
         if options['check_sources']:
             if self.verbosity:
                 print 'CHECKING REFERENCE SOURCES ON "%s"...' % self.ocl_api_env
-            if not self.check_sources():
+            with self.profiler.phase('check sources'):
+                sources_ok = self.check_sources()
+            if not sources_ok:
                 print '\nERROR: Missing required reference sources. Please correct and try again.'
                 exit(1)
 
         # Initialize counters
-        self.cnt_total_concepts_processed = 0
-        self.cnt_concepts_exported = 0
-        self.cnt_internal_mappings_exported = 0
-        self.cnt_external_mappings_exported = 0
-        self.cnt_ignored_self_mappings = 0
-        self.cnt_questions_exported = 0
-        self.cnt_answers_exported = 0
-        self.cnt_concept_sets_exported = 0
-        self.cnt_set_members_exported = 0
-        self.cnt_retired_concepts_exported = 0
+        for counter_name in self.EXPORT_COUNTERS:
+            setattr(self, counter_name, 0)
 
         # Prepare for gold mappings
-        self.gold_mappings_dict = None
+        self.gold_mapping_index = None
+
+        # Precompute the URL prefix of the source's concepts and prepare the URL caches
+        self.concept_url_prefix = '/orgs/%s/sources/%s/concepts/' % (
+            q(self.org_id), q(self.source_id))
+        self.concept_urls = {}
+        self.source_urls = {}
+        self.from_concept_url = (None, None)
+
+        # Prepare for an incremental export
+        self.export_watermark = None
+        if self.manifest_filename and self.since is None:
+            self.since = self.read_manifest()
 
         # Process concepts and mappings script
         if self.do_mapping or self.do_concept:
             self.export()
+            if self.manifest_filename:
+                self.write_manifest()
             if self.verbosity:
                 self.print_export_summary()
+        self.profiler.print_summary(sys.stderr if self.exports_to_stdout() else sys.stdout)
+
+    def exports_to_stdout(self):
+        """ Returns True if concepts or mappings are exported to stdout """
+        return ((self.do_concept and not (self.concepts_output_filename or self.output_filename)) or
+                (self.do_mapping and not (self.mappings_output_filename or self.output_filename)))
 
     def validate_options(self):
         """
@@ -223,8 +455,98 @@ class Command(BaseCommand):
         if self.ocl_import_file_format not in self.OCL_IMPORT_FILE_FORMATS:
             raise CommandError(
                 'Invalid "format" option provided: %s' % self.ocl_import_file_format)
+        if self.concept_id is not None and self.concept_ids_filename:
+            raise CommandError('"concept_id" and "concept_ids_file" cannot be used together')
+        if self.concept_limit is not None and self.concept_limit < 0:
+            raise CommandError(
+                'Invalid "concept_limit" option provided: %s' % self.concept_limit)
+        if self.manifest_filename and (self.concept_id is not None or self.concept_ids_filename or
+                                       self.concept_limit is not None):
+            # The watermark would otherwise skip the concepts left out of a partial export
+            raise CommandError(
+                '"manifest" cannot be used with "concept_id", "concept_ids_file" or '
+                '"concept_limit", which only export part of the dictionary')
+        if self.chunk_size < 0:
+            raise CommandError(
+                'Invalid "chunk_size" option provided: %s' % self.chunk_size)
+        if self.workers < 1:
+            raise CommandError(
+                'Invalid "workers" option provided: %s' % self.workers)
+        if self.source_check_workers < 1:
+            raise CommandError(
+                'Invalid "source_check_workers" option provided: %s' % self.source_check_workers)
         return True
 
+    def parse_datetime_option(self, option_name, value):
+        """ Returns value parsed as a datetime, using UTC if no timezone is specified """
+        if not value:
+            return None
+        try:
+            parsed_value = dateparse.parse_datetime(value)
+            if parsed_value is None:
+                parsed_value = datetime.datetime.combine(
+                    dateparse.parse_date(value), datetime.time())
+        except (ValueError, TypeError):
+            raise CommandError('Invalid "%s" option provided: %s' % (option_name, value))
+        if settings.USE_TZ and timezone.is_naive(parsed_value):
+            parsed_value = timezone.make_aware(parsed_value, timezone.utc)
+        return parsed_value
+
+    def read_manifest(self):
+        """
+        Returns the watermark recorded in the manifest file by the previous export, or None if
+        the manifest file does not exist yet.
+        """
+        if not os.path.exists(self.manifest_filename):
+            return None
+        with open(self.manifest_filename, 'rb') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('org_id') != self.org_id or manifest.get('source_id') != self.source_id:
+            raise CommandError('Manifest "%s" was written for %s/%s, not %s/%s' % (
+                self.manifest_filename, manifest.get('org_id'), manifest.get('source_id'),
+                self.org_id, self.source_id))
+        return self.parse_datetime_option('watermark', manifest.get('watermark'))
+
+    def write_manifest(self):
+        """ Records the watermark of this export in the manifest file for the next export """
+        manifest = {
+            'org_id': self.org_id,
+            'source_id': self.source_id,
+            'since': self.since.isoformat() if self.since else None,
+            'watermark': self.export_watermark.isoformat() if self.export_watermark else None,
+            'concepts_processed': self.cnt_total_concepts_processed,
+        }
+        temp_filename = '%s.tmp' % self.manifest_filename
+        with open(temp_filename, 'wb') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.rename(temp_filename, self.manifest_filename)
+
+    def get_watermark(self):
+        """ Returns the most recent creation, change, retirement or voided date in the dictionary """
+        dates = []
+        for model, concept_field, date_fields in self.INCREMENTAL_DATE_FIELDS:
+            latest_dates = model.objects.aggregate(*[Max(date_field) for date_field in date_fields])
+            dates += [date for date in latest_dates.values() if date is not None]
+        return max(dates) if dates else None
+
+    def get_changed_concept_ids(self, since):
+        """
+        Returns the IDs of concepts that were created, changed or retired at or after since, or
+        whose names, descriptions, answers, set members or reference maps were. Note that
+        OpenMRS deletes answers, set members and reference maps without recording a date, so
+        their removal is not detected.
+        """
+        changed_concept_ids = set()
+        for model, concept_field, date_fields in self.INCREMENTAL_DATE_FIELDS:
+            changed_filter = reduce(operator.or_, [
+                Q(**{'%s__gte' % date_field: since}) for date_field in date_fields])
+            changed_concept_ids.update(model.objects.filter(changed_filter).values_list(
+                concept_field, flat=True))
+        if self.verbosity >= 2:
+            print >> sys.stderr, '%s concepts changed since %s' % (
+                len(changed_concept_ids), since.isoformat())
+        return changed_concept_ids
+
     def print_export_summary(self):
         """ Outputs a summary of the results """
         print '------------------------------------------------------'
@@ -245,6 +567,8 @@ class Command(BaseCommand):
             print 'Questions Processed: %d' % self.cnt_questions_exported
             print 'Concept Sets Processed: %d' % self.cnt_concept_sets_exported
             print 'Ignored Self Mappings: %d' % self.cnt_ignored_self_mappings
+            if self.cnt_skipped_drug_answers:
+                print 'Skipped Drug Answers: %d' % self.cnt_skipped_drug_answers
         print '------------------------------------------------------'
 
     def check_sources(self):
@@ -261,14 +585,10 @@ class Command(BaseCommand):
         reference_sources = reference_sources.filter(retired=0)
         enum_reference_sources = enumerate(reference_sources)
 
-        # Check if each reference source exists in the specified OCL environment
-        matching_sources = []
+        # Check if each reference source is defined in the local source directory
+        defined_sources = []
         missing_source_in_ocl = []
         missing_source_definition = []
-        org_fields_to_remove = ['collections_url', 'members_url', 'uuid', 'public_sources', 'url',
-                                'public_collections', 'created_by', 'created_on', 'updated_by', 'members', 'updated_on', 'sources_url']
-        source_fields_to_remove = ['versions_url', 'created_on', 'updated_by', 'uuid', 'created_by', 'mappings_url',
-                                   'owner_url', 'concepts_url', 'versions', 'active_mappings', 'url', 'active_concepts', 'updated_on']
         for num, source in enum_reference_sources:
             if self.verbosity >= 2:
                 print 'Checking OpenMRS Reference source: "%s"' % source.name
@@ -290,17 +610,38 @@ class Command(BaseCommand):
             if self.verbosity >= 2:
                 print '  ...Corresponding source "%s" and owner "%s" found in source directory' % (
                     ocl_source_id, ocl_org_id)
-
-            # Check that org:source exists in OCL
-            ocl_org_url = ocl_env_url + 'orgs/%s/' % (q(ocl_org_id))
-            ocl_source_url = ocl_env_url + \
-                'orgs/%s/sources/%s/' % (q(ocl_org_id), q(ocl_source_id))
-            ocl_org_response = requests.get(ocl_org_url, headers=headers)
-            ocl_source_response = requests.get(ocl_source_url, headers=headers)
+            defined_sources.append({
+                'omrs_source': source,
+                'omrs_ref_source_name': source.name,
+                'ocl_org_id': ocl_org_id,
+                'ocl_source_id': ocl_source_id,
+                'ocl_source_url': ocl_env_url + 'orgs/%s/sources/%s/' % (
+                    q(ocl_org_id), q(ocl_source_id)),
+            })
+
+        # Fetch each org and source from OCL only once, concurrently or from the cache
+        ocl_urls = []
+        for source in defined_sources:
+            ocl_org_url = ocl_env_url + 'orgs/%s/' % (q(source['ocl_org_id']))
+            for ocl_url in (ocl_org_url, source['ocl_source_url']):
+                if ocl_url not in ocl_urls:
+                    ocl_urls.append(ocl_url)
+        ocl_responses = self.fetch_ocl_resources(ocl_urls, headers)
+
+        # Check that org:source exists in OCL
+        matching_sources = []
+        org_fields_to_remove = ['collections_url', 'members_url', 'uuid', 'public_sources', 'url',
+                                'public_collections', 'created_by', 'created_on', 'updated_by', 'members', 'updated_on', 'sources_url']
+        source_fields_to_remove = ['versions_url', 'created_on', 'updated_by', 'uuid', 'created_by', 'mappings_url',
+                                   'owner_url', 'concepts_url', 'versions', 'active_mappings', 'url', 'active_concepts', 'updated_on']
+        for current_source in defined_sources:
+            ocl_org_url = ocl_env_url + 'orgs/%s/' % (q(current_source['ocl_org_id']))
+            ocl_source_url = current_source['ocl_source_url']
+            ocl_source_status_code, ocl_source_json = ocl_responses[ocl_source_url]
             if self.verbosity >= 2:
                 try:
-                    ocl_org_json = ocl_org_response.json()
-                    ocl_source_json = ocl_source_response.json()
+                    ocl_org_json = dict(ocl_responses[ocl_org_url][1])
+                    ocl_source_json = dict(ocl_source_json)
                     [ocl_org_json.pop(key) for key in org_fields_to_remove]
                     [ocl_source_json.pop(key)
                      for key in source_fields_to_remove]
@@ -308,15 +649,8 @@ class Command(BaseCommand):
                     print json.dumps(ocl_source_json)
                 except Exception:
                     pass
-            current_source = {
-                'omrs_source': source,
-                'omrs_ref_source_name': source.name,
-                'ocl_org_id': ocl_org_id,
-                'ocl_source_id': ocl_source_id,
-                'ocl_source_url': ocl_source_url,
-                'response_code': ocl_source_response.status_code
-            }
-            if ocl_source_response.status_code != requests.codes.OK:
+            current_source['response_code'] = ocl_source_status_code
+            if ocl_source_status_code != requests.codes.OK:
                 missing_source_in_ocl.append(current_source)
                 if self.verbosity >= 2:
                     print '  ...Org or source not found in OCL: %s' % ocl_source_url
@@ -355,6 +689,84 @@ class Command(BaseCommand):
             return False
         return True
 
+    def fetch_ocl_resources(self, ocl_urls, headers):
+        """
+        Returns a dictionary of (status_code, json) tuples for each OCL API URL. Successful
+        responses are read from the source cache file if they are newer than the cache TTL.
+        Other URLs are fetched concurrently on a pooled session that retries failed requests
+        with exponential backoff, and successful responses are saved to the cache.
+        """
+        ocl_responses = {}
+        source_cache = self.load_source_cache()
+        urls_to_fetch = []
+        for ocl_url in ocl_urls:
+            cached_response = source_cache.get('%s %s' % (self.ocl_api_env, ocl_url))
+            if cached_response and time.time() - cached_response['fetched'] < self.source_cache_ttl:
+                ocl_responses[ocl_url] = (cached_response['status_code'], cached_response['json'])
+            else:
+                urls_to_fetch.append(ocl_url)
+        if self.verbosity >= 2:
+            print '%s OCL resources cached, %s to fetch' % (
+                len(ocl_responses), len(urls_to_fetch))
+        if not urls_to_fetch:
+            return ocl_responses
+
+        # Fetch the remaining resources with bounded parallelism
+        session = requests.Session()
+        session.headers.update(headers)
+        retries = Retry(total=self.SOURCE_CHECK_RETRIES, backoff_factor=0.5,
+                        status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_maxsize=self.source_check_workers, max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        pool = ThreadPool(min(self.source_check_workers, len(urls_to_fetch)))
+        try:
+            for ocl_url, status_code, response_json in pool.imap_unordered(
+                    lambda ocl_url: self.fetch_ocl_resource(session, ocl_url), urls_to_fetch):
+                ocl_responses[ocl_url] = (status_code, response_json)
+                if status_code == requests.codes.OK:
+                    source_cache['%s %s' % (self.ocl_api_env, ocl_url)] = {
+                        'status_code': status_code, 'json': response_json, 'fetched': time.time()}
+        finally:
+            pool.close()
+            pool.join()
+            session.close()
+        self.save_source_cache(source_cache)
+        return ocl_responses
+
+    def fetch_ocl_resource(self, session, ocl_url):
+        """ Returns a tuple of (ocl_url, status_code, json) for a GET request to an OCL URL """
+        try:
+            response = session.get(ocl_url, timeout=self.SOURCE_CHECK_TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            if self.verbosity >= 2:
+                print 'Request to %s failed: %s' % (ocl_url, e)
+            return ocl_url, None, None
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = None
+        return ocl_url, response.status_code, response_json
+
+    def load_source_cache(self):
+        """ Returns the contents of the source cache file, or an empty cache if none """
+        if not self.source_cache_filename or not os.path.exists(self.source_cache_filename):
+            return {}
+        try:
+            with open(self.source_cache_filename, 'rb') as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            return {}
+
+    def save_source_cache(self, source_cache):
+        """ Saves the source cache file, if one is configured """
+        if not self.source_cache_filename:
+            return
+        temp_filename = '%s.tmp' % self.source_cache_filename
+        with open(temp_filename, 'wb') as cache_file:
+            json.dump(source_cache, cache_file)
+        os.rename(temp_filename, self.source_cache_filename)
+
     def export(self):
         """
         Main loop to export all concepts and/or their mappings.
@@ -362,51 +774,402 @@ class Command(BaseCommand):
         Note that the retired status of concepts is not handled here.
         """
 
-        # Create the concept enumerator, applying 'concept_id' and 'concept_limit' options
+        # Create the concept queryset, applying the 'concept_id' and 'concept_ids_file' options.
+        # A subset of concepts selected in Python is kept as a sorted list of concept_ids that
+        # the export pages through, rather than as a queryset filtered by a long IN list.
+        concept_ids = None
         if self.concept_id is not None:
-            # If 'concept_id' option set, fetch a single concept and convert to enumerator
-            concept = Concept.objects.get(concept_id=self.concept_id)
-            concept_enumerator = enumerate([concept])
+            # If 'concept_id' option set, fetch a single concept
+            concept_results = Concept.objects.filter(concept_id=self.concept_id)
+            if not concept_results.exists():
+                raise CommandError('Concept %s not found' % self.concept_id)
+        elif self.concept_ids_filename:
+            # Fetch the listed concepts and the concepts they reference
+            with self.profiler.phase('expand concept IDs'):
+                concept_ids = self.get_concept_closure(
+                    self.read_concept_ids_file(self.concept_ids_filename))
+            concept_results = Concept.objects.all()
         else:
-            # Fetch all concepts and filter with 'concept_limit' if set
-            # TODO: 'concept_limit' is based on numeric value of concept_id not on actual count
             concept_results = Concept.objects.all()
-            if self.concept_limit is not None:
-                concept_results = concept_results.filter(
-                    concept_id__lte=self.concept_limit)
-            concept_enumerator = enumerate(concept_results)
 
-        # Iterate concept enumerator and process the export
-        resource_list_concepts = ocldev.oclresourcelist.OclJsonResourceList()
-        resource_list_mappings = ocldev.oclresourcelist.OclJsonResourceList()
-        for num, concept in concept_enumerator:
+        # Record the watermark for the next incremental export, and restrict this export to the
+        # concepts changed since the previous watermark, if any
+        if self.manifest_filename:
+            with self.profiler.phase('find changed concepts'):
+                self.export_watermark = self.get_watermark()
+        if self.since is not None and self.concept_id is None:
+            with self.profiler.phase('find changed concepts'):
+                changed_concept_ids = self.get_changed_concept_ids(self.since)
+                if concept_ids is None:
+                    concept_ids = changed_concept_ids
+                else:
+                    concept_ids = set(concept_ids) & changed_concept_ids
+        if concept_ids is not None:
+            concept_ids = sorted(self.get_existing_concept_ids(concept_ids))
+
+        # Limit the export to the first 'concept_limit' concepts, if set
+        if self.concept_limit is not None and self.concept_id is None:
+            if concept_ids is not None:
+                concept_ids = concept_ids[:self.concept_limit]
+            else:
+                concept_results = self.limit_concepts(concept_results, self.concept_limit)
+
+        # Build the gold mapping index up front so that all gold mapping errors are reported at once
+        if self.use_gold_mappings:
+            with self.profiler.phase('gold mappings'):
+                self.load_gold_mappings(concept_results, concept_ids)
+
+        # Open the output files -- concepts and mappings are written to the same file, with
+        # mappings spooled until all concepts are written, unless separate files are specified
+        concept_filename = self.concepts_output_filename or self.output_filename
+        mapping_filename = self.mappings_output_filename or self.output_filename
+        output_file = self.open_output_file(concept_filename)
+        if mapping_filename == concept_filename:
+            mapping_file = None if self.do_concept else output_file
+        else:
+            mapping_file = self.open_output_file(mapping_filename)
+
+        # Stream the export to the output files, splitting it across worker processes if requested
+        try:
+            if self.workers > 1 and self.concept_id is None:
+                with self.profiler.phase('parallel export'):
+                    self.export_in_parallel(
+                        concept_results, concept_ids, output_file, mapping_file=mapping_file)
+            else:
+                writer = OclJsonLinesWriter(
+                    output_file, mapping_file=mapping_file, indent=self.indent)
+                self.export_concepts(self.iter_concept_records(concept_results, concept_ids), writer)
+                with self.profiler.phase('write JSON'):
+                    writer.close()
+        finally:
+            for export_file in set([output_file, mapping_file]):
+                if export_file not in (None, sys.stdout):
+                    export_file.close()
+
+    def read_concept_ids_file(self, filename):
+        """
+        Returns the set of concept IDs listed in a file, separated by whitespace or commas.
+        Raises CommandError if an ID is invalid or is not the ID of a concept.
+        """
+        concept_ids = set()
+        try:
+            with open(filename, 'rb') as concept_ids_file:
+                for line_num, line in enumerate(concept_ids_file, 1):
+                    if line.lstrip().startswith('#'):
+                        continue
+                    for value in re.split(r'[\s,]+', line.strip()):
+                        if not value:
+                            continue
+                        if not value.isdigit():
+                            raise CommandError('Invalid concept ID on line %s of "%s": %s' % (
+                                line_num, filename, value))
+                        concept_ids.add(int(value))
+        except IOError as e:
+            raise CommandError('Unable to read "%s": %s' % (filename, e))
+        missing_concept_ids = concept_ids - self.get_existing_concept_ids(concept_ids)
+        if missing_concept_ids:
+            raise CommandError('Concepts not found: %s' % ', '.join(
+                str(concept_id) for concept_id in sorted(missing_concept_ids)))
+        return concept_ids
+
+    def iter_concept_id_batches(self, concept_ids):
+        """
+        Generator that yields sorted lists of concept_ids short enough to be listed in an IN
+        query, at most ConceptDictionary.MAX_QUERY_CONCEPT_IDS each
+        """
+        concept_ids = sorted(concept_ids)
+        batch_size = ConceptDictionary.MAX_QUERY_CONCEPT_IDS
+        for start in xrange(0, len(concept_ids), batch_size):
+            yield concept_ids[start:start + batch_size]
+
+    def get_existing_concept_ids(self, concept_ids):
+        """ Returns the subset of concept_ids that are IDs of concepts in the dictionary """
+        existing_concept_ids = set()
+        for batch in self.iter_concept_id_batches(concept_ids):
+            existing_concept_ids.update(Concept.objects.filter(
+                concept_id__in=batch).values_list('concept_id', flat=True))
+        return existing_concept_ids
+
+    def get_concept_closure(self, concept_ids):
+        """
+        Returns concept_ids together with every concept that they reference as a set member or
+        answer, transitively. The references are followed breadth first, with one IN query on
+        concept_set and one on concept_answer for each level of the traversal (per batch of
+        concept IDs from iter_concept_id_batches), so that only the exported concepts are read.
+        """
+        closure = set(concept_ids)
+        frontier = closure
+        level = 0
+        while frontier:
+            referenced_concept_ids = set()
+            for batch in self.iter_concept_id_batches(frontier):
+                referenced_concept_ids.update(ConceptSet.objects.filter(
+                    concept_set_owner_id__in=batch).values_list('concept_id', flat=True))
+                referenced_concept_ids.update(ConceptAnswer.objects.filter(
+                    question_concept_id__in=batch).values_list('answer_concept_id', flat=True))
+            referenced_concept_ids.discard(None)
+            frontier = referenced_concept_ids - closure
+            closure |= frontier
+            level += 1
+            if self.verbosity >= 2:
+                print >> sys.stderr, 'Level %s: %s referenced concepts added, %s in total' % (
+                    level, len(frontier), len(closure))
+        return closure
+
+    @staticmethod
+    def limit_concepts(concept_results, limit):
+        """
+        Returns concept_results limited to its first 'limit' concepts in concept_id order. Rather
+        than slicing the queryset, which could then no longer be filtered or paginated, it is
+        filtered up to the concept_id of the last of those concepts.
+        """
+        last_concept_ids = list(concept_results.order_by('concept_id').values_list(
+            'concept_id', flat=True)[max(limit - 1, 0):limit])
+        if not last_concept_ids:
+            return concept_results if limit else concept_results.none()
+        return concept_results.filter(concept_id__lte=last_concept_ids[0])
+
+    def export_concepts(self, concepts, writer):
+        """
+        Export each of concepts, an iterable of ConceptRecords, and/or its mappings using the
+        writer. When profiling, loading concepts (including their related rows), building the
+        concept and mapping dictionaries and writing the JSON are recorded as separate phases.
+        """
+        profiler = self.profiler
+        for concept in profiler.iter_phase('fetch concepts', concepts):
             self.cnt_total_concepts_processed += 1
             export_data = ''
             if self.do_concept:
-                export_data = self.export_concept(concept)
+                with profiler.phase('build concepts'):
+                    export_data = self.export_concept(concept)
                 if export_data:
-                    resource_list_concepts.append(export_data)
-                    # print json.dumps(export_data, indent=self.indent)
+                    with profiler.phase('write JSON'):
+                        writer.write_concept(export_data)
             if self.do_mapping:
-                export_data = self.export_all_mappings_for_concept(concept)
+                with profiler.phase('build mappings'):
+                    export_data = self.export_all_mappings_for_concept(concept)
                 if export_data:
-                    resource_list_mappings.append(export_data)
-                    # for map_dict in export_data:
-                    #     print json.dumps(map_dict, indent=self.indent)
-
-        # Output
-        if len(resource_list_concepts):
-            for resource in resource_list_concepts:
-                print json.dumps(resource, indent=self.indent)
-        if len(resource_list_mappings):
-            for resource in resource_list_mappings:
-                print json.dumps(resource, indent=self.indent)
+                    with profiler.phase('write JSON'):
+                        writer.write_mappings(export_data)
+
+    def export_in_parallel(self, concept_results, concept_ids, output_file, mapping_file=None):
+        """
+        Split the concept_id space into one contiguous range per worker and export each range in
+        its own process with its own database connection. On MySQL, tables are locked until every
+        worker has started a transaction with a consistent snapshot, so that all workers read the
+        same data. Shard outputs are then merged in concept_id order and worker counters are
+        added to this command's counters, so the result matches a serial export. If a worker
+        exits without reporting, e.g. because it was killed, the tables are unlocked and
+        CommandError is raised rather than waiting for it forever.
+        """
+        # Find the first and last concept_id of each shard. Unless the concepts are a list of
+        # concept_ids, every concept_id is not listed: a query for each boundary skips (OFFSET)
+        # the concepts of the preceding shards instead.
+        if concept_ids is not None:
+            boundary_ids = concept_ids
+            num_concepts = len(concept_ids)
+        else:
+            boundary_ids = concept_results.order_by('concept_id').values_list('concept_id', flat=True)
+            num_concepts = concept_results.count()
+        shard_size = max(1, (num_concepts + self.workers - 1) // self.workers)
+        shard_ranges = []
+        for start in xrange(0, num_concepts, shard_size):
+            end = min(start + shard_size, num_concepts) - 1
+            shard_ranges.append((boundary_ids[start], boundary_ids[end]))
+        if self.verbosity >= 2:
+            print 'Exporting %s concepts in %s shards: %s' % (
+                num_concepts, len(shard_ranges), shard_ranges)
+
+        shard_dir = tempfile.mkdtemp(prefix='extract_db_')
+        shard_filenames = [(os.path.join(shard_dir, '%s-concepts.json' % num),
+                            os.path.join(shard_dir, '%s-mappings.json' % num))
+                           for num in range(len(shard_ranges))]
+        ready_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        use_snapshot = connection.vendor == 'mysql'
+        workers = []
+        try:
+            # Block writes until every worker has opened its snapshot
+            if use_snapshot:
+                connection.cursor().execute('FLUSH TABLES WITH READ LOCK')
+            try:
+                for num, shard_range in enumerate(shard_ranges):
+                    worker = multiprocessing.Process(
+                        target=self.export_shard,
+                        args=(num, concept_results, concept_ids, shard_range, shard_filenames[num],
+                              use_snapshot, ready_queue, result_queue))
+                    worker.start()
+                    workers.append(worker)
+                ready_shards = set()
+                for num in range(len(workers)):
+                    shard_num, ready = self.get_worker_message(ready_queue, workers, ready_shards)
+                    ready_shards.add(shard_num)
+                    if not ready:
+                        break
+            finally:
+                if use_snapshot:
+                    connection.cursor().execute('UNLOCK TABLES')
+
+            # Collect results, adding each worker's counters to this command's counters
+            errors = []
+            finished_shards = set()
+            for num in range(len(workers)):
+                shard_num, counters, error = self.get_worker_message(
+                    result_queue, workers, finished_shards)
+                finished_shards.add(shard_num)
+                if error:
+                    errors.append('Shard %s %s failed:\n%s' % (
+                        shard_num, shard_ranges[shard_num], error))
+                    continue
+                for counter_name in self.EXPORT_COUNTERS:
+                    setattr(self, counter_name, getattr(self, counter_name) + counters[counter_name])
+            for worker in workers:
+                worker.join()
+            if errors:
+                raise CommandError('\n'.join(errors))
+
+            # Merge the shards in concept_id order
+            for concept_filename, mapping_filename in shard_filenames:
+                with open(concept_filename, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, output_file)
+            for concept_filename, mapping_filename in shard_filenames:
+                with open(mapping_filename, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, mapping_file or output_file)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def get_worker_message(self, message_queue, workers, reported_shards):
+        """
+        Returns the next message put on message_queue by a worker, checking every
+        WORKER_POLL_SECONDS that the workers whose shard number is not in reported_shards are
+        still running. Raises CommandError if one of them has exited without putting a message.
+        """
+        while True:
+            try:
+                return message_queue.get(timeout=self.WORKER_POLL_SECONDS)
+            except Empty:
+                pass
+            exited_shards = [num for num, worker in enumerate(workers)
+                             if num not in reported_shards and worker.exitcode is not None]
+            if exited_shards:
+                # A message put just before the worker exited may still be in transit
+                try:
+                    return message_queue.get(timeout=self.WORKER_POLL_SECONDS)
+                except Empty:
+                    raise CommandError('Shard %s worker exited with code %s without reporting' % (
+                        exited_shards[0], workers[exited_shards[0]].exitcode))
+
+    def export_shard(self, shard_num, concept_results, concept_ids, shard_range, shard_filenames,
+                     use_snapshot, ready_queue, result_queue):
+        """
+        Worker process entry point to export the concepts in concept_results (and concept_ids, if
+        not None) with IDs in shard_range to the shard's concept and mapping files. Puts (shard_num, True) on
+        ready_queue once its snapshot is open, or (shard_num, False) if that fails, and puts a
+        tuple of (shard_num, counters, error) on result_queue when done.
+        """
+        # The database connection inherited from the parent process must not be used or closed
+        # here, so keep a reference to it and let Django open a new one for this process
+        self.inherited_db_connection = connection.connection
+        connection.connection = None
+        # Worker processes are not profiled; their time is the parent's parallel export phase
+        self.profiler.cancel()
+        self.profiler = CommandProfiler()
+        for counter_name in self.EXPORT_COUNTERS:
+            setattr(self, counter_name, 0)
+
+        ready = False
+        try:
+            with transaction.atomic():
+                if use_snapshot:
+                    connection.cursor().execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+                ready_queue.put((shard_num, True))
+                ready = True
+                concept_results = concept_results.filter(
+                    concept_id__gte=shard_range[0], concept_id__lte=shard_range[1])
+                if concept_ids is not None:
+                    concept_ids = concept_ids[bisect.bisect_left(concept_ids, shard_range[0]):
+                                              bisect.bisect_right(concept_ids, shard_range[1])]
+                with open(shard_filenames[0], 'wb') as concept_file:
+                    with open(shard_filenames[1], 'wb') as mapping_file:
+                        writer = OclJsonLinesWriter(
+                            concept_file, mapping_file=mapping_file, indent=self.indent)
+                        self.export_concepts(
+                            self.iter_concept_records(concept_results, concept_ids), writer)
+                        writer.close()
+        except Exception:
+            if not ready:
+                ready_queue.put((shard_num, False))
+            result_queue.put((shard_num, None, traceback.format_exc()))
+            return
+        result_queue.put((shard_num, dict(
+            (counter_name, getattr(self, counter_name)) for counter_name in self.EXPORT_COUNTERS), None))
+
+    def open_output_file(self, filename):
+        """
+        Returns a file opened for writing the export, or stdout if no filename specified, that
+        compresses the export if requested by --compression or the file extension
+        """
+        try:
+            return open_output_file(filename, compression=self.compression)
+        except Exception as e:
+            raise CommandError(str(e))
+
+    def iter_concept_records(self, concept_results, concept_ids=None):
+        """
+        Generator that yields a ConceptRecord for each concept in concept_results, or only for
+        those in concept_ids, a sorted list, if specified, in concept_id order. Concepts are loaded into a ConceptDictionary in chunks of 'chunk_size' concepts,
+        or all at once with 'in_memory', with one query per table for each chunk, so the number
+        of queries depends on the number of chunks rather than the number of concepts.
+
+        Chunks are paginated by concept_id (keyset pagination): each chunk is the next
+        'chunk_size' concepts after the last concept_id of the previous one. Neither the
+        concepts nor their IDs are ever all fetched at once, so memory use stays constant, and
+        unlike OFFSET pagination each page is found using the primary key index. A list of
+        concept_ids is paged through instead, in chunks short enough to be listed in the IN
+        query of each chunk.
+        """
+        dictionary = ConceptDictionary(concepts=self.do_concept, mappings=self.do_mapping)
+        if self.in_memory:
+            dictionary.load(concept_results)
+            if concept_ids is None:
+                for concept in dictionary:
+                    yield concept
+            else:
+                for concept_id in concept_ids:
+                    yield dictionary.get(concept_id)
+            return
+        if concept_ids is not None:
+            chunk_size = min(self.chunk_size or 1, ConceptDictionary.MAX_QUERY_CONCEPT_IDS)
+            for start in xrange(0, len(concept_ids), chunk_size):
+                dictionary.load(concept_results.filter(
+                    concept_id__in=concept_ids[start:start + chunk_size]))
+                self.concept_urls.clear()
+                for concept in dictionary:
+                    yield concept
+            return
+        chunk_size = self.chunk_size or 1
+        concept_results = concept_results.order_by('concept_id')
+        last_concept_id = None
+        while True:
+            page = concept_results
+            if last_concept_id is not None:
+                page = page.filter(concept_id__gt=last_concept_id)
+            dictionary.load(page[:chunk_size])
+            self.concept_urls.clear()
+            for concept in dictionary:
+                last_concept_id = concept.concept_id
+                yield concept
+            if len(dictionary) < chunk_size:
+                break
 
     def export_concept(self, concept):
         """
         Export one concept as OCL-formatted dictionary.
 
-        :param concept: Concept to export from OpenMRS database.
+        :param concept: ConceptRecord of the concept to export from OpenMRS database.
         :returns: OCL-formatted dictionary for the concept.
 
         Note:
@@ -420,8 +1183,8 @@ class Command(BaseCommand):
         extras = {}
         data = {}
         data['id'] = self.apply_gold_mappings(concept.concept_id)
-        data['concept_class'] = concept.concept_class.name
-        data['datatype'] = concept.datatype.name
+        data['concept_class'] = concept.concept_class
+        data['datatype'] = concept.datatype
         data['external_id'] = concept.uuid
         data['retired'] = concept.retired
         if concept.is_set:
@@ -436,23 +1199,22 @@ class Command(BaseCommand):
 
         # Concept Names
         names = []
-        for concept_name in concept.conceptname_set.all():
-            if not concept_name.voided:
-                # Replace obsolete Indonesian locale of "in" to "id"
-                locale = 'id' if concept_name.locale == 'in' else concept_name.locale
-                names.append({
-                    'name': concept_name.name,
-                    'name_type': concept_name.concept_name_type if concept_name.concept_name_type else '',
-                    'locale': locale,
-                    'locale_preferred': concept_name.locale_preferred,
-                    'external_id': concept_name.uuid,
-                })
+        for concept_name in concept.names:
+            # Replace obsolete Indonesian locale of "in" to "id"
+            locale = 'id' if concept_name.locale == 'in' else concept_name.locale
+            names.append({
+                'name': concept_name.name,
+                'name_type': concept_name.name_type if concept_name.name_type else '',
+                'locale': locale,
+                'locale_preferred': concept_name.locale_preferred,
+                'external_id': concept_name.uuid,
+            })
         data['names'] = names
 
         # Concept Descriptions
         # NOTE: OMRS does not have description_type or locale_preferred -- omitted for now
         descriptions = []
-        for concept_description in concept.conceptdescription_set.all():
+        for concept_description in concept.descriptions:
             if concept_description.description:
                 descriptions.append({
                     'description': concept_description.description,
@@ -462,7 +1224,8 @@ class Command(BaseCommand):
         data['descriptions'] = descriptions
 
         # If the concept is of numeric type, map concept's numeric type data as extras
-        for numeric_metadata in concept.conceptnumeric_set.all():
+        numeric_metadata = concept.numeric
+        if numeric_metadata is not None:
             extras_dict = {}
             add_f(extras_dict, 'hi_absolute', numeric_metadata.hi_absolute)
             add_f(extras_dict, 'hi_critical', numeric_metadata.hi_critical)
@@ -477,8 +1240,7 @@ class Command(BaseCommand):
             extras.update(extras_dict)
 
         # If the concept is complex, map hander as extra
-        if hasattr(concept, 'complex_handler'):
-            add_f(extras, 'handler', concept.complex_handler.handler)
+        add_f(extras, 'handler', concept.handler)
 
         data['extras'] = extras
 
@@ -496,35 +1258,35 @@ class Command(BaseCommand):
         # Skip any codes that aren't numeric
         if type(concept_id) != int and not unicode(concept_id).isnumeric():
             return str(concept_id)
-        if not self.gold_mappings_dict:
-            self.gold_mappings_dict = {}
-            gold_mappings = ConceptReferenceMap.objects.filter(
-                concept_reference_term__concept_source__name=self.org_id,
-                map_type__name=OclOpenmrsHelper.MAP_TYPE_SAME_AS,
-                concept_reference_term__code__regex=r'^[0-9]+$')
-            for mapping in gold_mappings:
-                mapped_concept_id = str(mapping.concept.concept_id)
-                gold_mapping_code = str(mapping.concept_reference_term.code)
-                if mapped_concept_id in self.gold_mappings_dict:
-                    raise RuntimeError(("Concepts can only have one gold mapping. "
-                        "Concept '%s' has gold mapping to '%s' and '%s'") % 
-                        (mapped_concept_id,
-                        self.gold_mappings_dict[mapped_concept_id],
-                        gold_mapping_code))
-                if gold_mapping_code in self.gold_mappings_dict.values():
-                    raise RuntimeError(("Gold mappings must be unique. The gold "
-                        "mapping '%s' is assigned to concepts '%s' and '%s'.") %
-                        (gold_mapping_code,
-                        ', '.join([k for k, v in self.gold_mappings_dict.items()
-                            if v == gold_mapping_code]),
-                        mapped_concept_id))
-                self.gold_mappings_dict[mapped_concept_id] = gold_mapping_code
-        local_concept_id = str(concept_id)
-        if not local_concept_id in self.gold_mappings_dict:
-            raise RuntimeError("No gold mapping found for concept '%s'" %
-                local_concept_id)
-        return self.gold_mappings_dict[local_concept_id]
+        if self.gold_mapping_index is None:
+            self.gold_mapping_index = GoldMappingIndex(self.org_id)
+            self.gold_mapping_index.raise_errors()
+        return self.gold_mapping_index.get_gold_id(concept_id)
 
+    def load_gold_mappings(self, concept_results, concept_ids=None):
+        """
+        Builds the gold mapping index before the export starts and checks that every concept
+        being exported (those in concept_results, or in concept_ids if specified), and every
+        answer and set member that it references, has a unique gold mapping. RuntimeError raised
+        listing all of the problems found.
+        """
+        if concept_ids is not None:
+            concept_ids = set(concept_ids)
+        else:
+            concept_ids = set(concept_results.values_list('concept_id', flat=True))
+        required_concept_ids = set(concept_ids)
+        if self.do_mapping:
+            for question_id, answer_id in ConceptAnswer.objects.values_list(
+                    'question_concept_id', 'answer_concept_id'):
+                if question_id in concept_ids:
+                    required_concept_ids.add(answer_id)
+            for set_owner_id, set_member_id in ConceptSet.objects.values_list(
+                    'concept_set_owner_id', 'concept_id'):
+                if set_owner_id in concept_ids:
+                    required_concept_ids.add(set_member_id)
+        self.gold_mapping_index = GoldMappingIndex(
+            self.org_id, required_concept_ids=required_concept_ids)
+        self.gold_mapping_index.raise_errors()
 
     def export_all_mappings_for_concept(self, concept, export_qanda=True, export_set_members=True):
         """
@@ -532,7 +1294,7 @@ class Command(BaseCommand):
 
         OCL stores all concept relationships as mappings, so OMRS mappings, Q-AND-A and
         CONCEPT-SETS are all handled here and exported as mapping JSON.
-        :param concept: Concept with the mappings to export from OpenMRS database.
+        :param concept: ConceptRecord with the mappings to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries for the concept.
         """
         maps = []
@@ -561,26 +1323,26 @@ class Command(BaseCommand):
         Generate OCL-formatted mappings for the concept, excluding set members and Q/A.
 
         Creates both internal and external mappings, based on the mapping definition.
-        :param concept: Concept with the mappings to export from OpenMRS database.
+        :param concept: ConceptRecord with the mappings to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries for the concept.
         """
         export_data = []
-        for ref_map in concept.conceptreferencemap_set.all():
+        for ref_map in concept.reference_maps:
             map_dict = None
 
             # Internal Mapping
-            if ref_map.concept_reference_term.concept_source.name == self.org_id:
+            if ref_map.source == self.org_id:
                 map_dict = self.generate_internal_mapping(
-                    map_type=ref_map.map_type.name,
+                    map_type=ref_map.map_type,
                     from_concept=concept,
-                    to_concept_code=ref_map.concept_reference_term.code,
+                    to_concept_code=ref_map.code,
                     external_id=ref_map.uuid)
                 self.cnt_internal_mappings_exported += 1
 
             # External Mapping
             else:
                 # Prepare to_source_id
-                omrs_to_source_id = ref_map.concept_reference_term.concept_source.name
+                omrs_to_source_id = ref_map.source
                 to_source_id = OclOpenmrsHelper.get_ocl_source_id_from_omrs_id(
                     omrs_to_source_id)
                 to_org_id = OclOpenmrsHelper.get_source_owner_id(
@@ -588,12 +1350,12 @@ class Command(BaseCommand):
 
                 # Generate the external mapping dictionary
                 map_dict = self.generate_external_mapping(
-                    map_type=ref_map.map_type.name,
+                    map_type=ref_map.map_type,
                     from_concept=concept,
                     to_org_id=to_org_id,
                     to_source_id=to_source_id,
-                    to_concept_code=ref_map.concept_reference_term.code,
-                    to_concept_name=ref_map.concept_reference_term.name,
+                    to_concept_code=ref_map.code,
+                    to_concept_name=ref_map.term_name,
                     external_id=ref_map.uuid)
 
                 self.cnt_external_mappings_exported += 1
@@ -607,24 +1369,31 @@ class Command(BaseCommand):
         """
         Generate OCL-formatted mappings for the linked answers in this concept.
         In OpenMRS, linked answers are always internal mappings.
-        :param concept: Concept with the linked answers to export from OpenMRS database.
+        :param concept: ConceptRecord with the linked answers to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries representing the linked answers.
         """
-        if not concept.question_answer.count():
+        if not concept.answers:
             return []
 
         # Increment number of concept questions prepared for export
         self.cnt_questions_exported += 1
 
-        # Export each of this concept's linked answers as an internal mapping
+        # Export each of this concept's linked answers as an internal mapping. Answers that are
+        # drugs have no answer concept and cannot be exported as a mapping to a concept.
         maps = []
-        for answer in concept.question_answer.all():
+        for answer_id, answer_concept_id, sort_weight, uuid in concept.answers:
+            if answer_concept_id is None:
+                if self.verbosity >= 2:
+                    print >> sys.stderr, 'Skipping answer %s of concept %s without an answer concept' % (
+                        answer_id, concept.concept_id)
+                self.cnt_skipped_drug_answers += 1
+                continue
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_Q_AND_A,
                 from_concept=concept,
-                to_concept_code=self.apply_gold_mappings(answer.answer_concept.concept_id),
-                external_id=answer.uuid,
-                sort_weight=answer.sort_weight)
+                to_concept_code=self.apply_gold_mappings(answer_concept_id),
+                external_id=uuid,
+                sort_weight=sort_weight)
             maps.append(map_dict)
             self.cnt_answers_exported += 1
 
@@ -634,10 +1403,10 @@ class Command(BaseCommand):
         """
         Generate OCL-formatted mappings for the set members in this concept.
         In OpenMRS, set members are always internal mappings.
-        :param concept: Concept with the set members to export from OpenMRS database.
+        :param concept: ConceptRecord with the set members to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries representing the set members.
         """
-        if not concept.conceptset_set.count():
+        if not concept.set_members:
             return []
 
         # Iterate number of concept sets prepared for export
@@ -645,27 +1414,51 @@ class Command(BaseCommand):
 
         # Export each of this concept's set members as an internal mapping
         maps = []
-        for set_member in concept.conceptset_set.all():
+        for set_member_id, member_concept_id, sort_weight, uuid in concept.set_members:
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET,
                 from_concept=concept,
-                to_concept_code=self.apply_gold_mappings(set_member.concept.concept_id),
-                external_id=set_member.uuid,
-                sort_weight=set_member.sort_weight)
+                to_concept_code=self.apply_gold_mappings(member_concept_id),
+                external_id=uuid,
+                sort_weight=sort_weight)
             maps.append(map_dict)
             self.cnt_set_members_exported += 1
 
         return maps
 
+    def get_concept_url(self, concept_code):
+        """
+        Returns the URL of a concept in the exported source, caching it by concept code. The
+        cache is cleared for each chunk of concepts, so it does not grow with the dictionary.
+        """
+        if concept_code not in self.concept_urls:
+            self.concept_urls[concept_code] = '%s%s/' % (self.concept_url_prefix, q(concept_code))
+        return self.concept_urls[concept_code]
+
+    def get_from_concept_url(self, from_concept):
+        """
+        Returns the URL of the concept whose mappings are being exported. The URL, including the
+        concept's gold mapping, is computed once for all of the concept's mappings.
+        """
+        if self.from_concept_url[0] != from_concept.concept_id:
+            self.from_concept_url = (from_concept.concept_id, self.get_concept_url(
+                self.apply_gold_mappings(from_concept.concept_id)))
+        return self.from_concept_url[1]
+
+    def get_source_url(self, org_id, source_id):
+        """ Returns the URL of an external source, caching it by owner and source ID """
+        if (org_id, source_id) not in self.source_urls:
+            self.source_urls[(org_id, source_id)] = '/orgs/%s/sources/%s/' % (
+                q(org_id), q(source_id))
+        return self.source_urls[(org_id, source_id)]
+
     def generate_internal_mapping(self, map_type=None, from_concept=None, to_concept_code=None,
                                   external_id=None, retired=False, sort_weight=None):
         """ Generate OCL-formatted dictionary for an internal mapping based on passed params. """
         map_dict = {}
         map_dict['map_type'] = map_type
-        map_dict['from_concept_url'] = '/orgs/%s/sources/%s/concepts/%s/' % (
-            q(self.org_id), q(self.source_id), q(self.apply_gold_mappings(from_concept.concept_id)))
-        map_dict['to_concept_url'] = '/orgs/%s/sources/%s/concepts/%s/' % (
-            q(self.org_id), q(self.source_id), q(to_concept_code))
+        map_dict['from_concept_url'] = self.get_from_concept_url(from_concept)
+        map_dict['to_concept_url'] = self.get_concept_url(to_concept_code)
         map_dict['retired'] = bool(retired)
         add_f(map_dict, 'external_id', external_id)
         if self.ocl_import_file_format == self.OCL_IMPORT_FILE_FORMAT_BULK:
@@ -684,10 +1477,8 @@ class Command(BaseCommand):
         """ Generate OCL-formatted dictionary for an external mapping based on passed params. """
         map_dict = {}
         map_dict['map_type'] = map_type
-        map_dict['from_concept_url'] = '/orgs/%s/sources/%s/concepts/%s/' % (
-            q(self.org_id), q(self.source_id), q(self.apply_gold_mappings(from_concept.concept_id)))
-        map_dict['to_source_url'] = '/orgs/%s/sources/%s/' % (
-            q(to_org_id), q(to_source_id))
+        map_dict['from_concept_url'] = self.get_from_concept_url(from_concept)
+        map_dict['to_source_url'] = self.get_source_url(to_org_id, to_source_id)
         map_dict['to_concept_code'] = to_concept_code
         map_dict['retired'] = bool(retired)
         add_f(map_dict, 'to_concept_name', to_concept_name)
@@ -700,6 +1491,114 @@ class Command(BaseCommand):
         return map_dict
 
 
+class OclJsonLinesWriter(object):
+    """
+    Writes OCL-formatted resources as JSON lines as soon as they are generated. Concepts are
+    written to output_file and mappings to mapping_file. If mapping_file is not provided, mappings
+    are written to a temporary spool file and appended to output_file when the writer is closed,
+    so that all concepts precede all mappings in the output.
+    """
+
+    def __init__(self, output_file, mapping_file=None, indent=None):
+        self.output_file = output_file
+        self.indent = indent
+        # A single encoder serializes every resource exactly like json.dumps, without building
+        # the encoder's arguments again for each call
+        self.dumps = json.JSONEncoder(indent=indent).encode
+        self.spool_file = None
+        if mapping_file is None:
+            self.spool_file = mapping_file = tempfile.TemporaryFile()
+        self.mapping_file = mapping_file
+
+    def write_concept(self, resource):
+        """ Serialize a concept dictionary and flush it to the output file """
+        self.output_file.write(self.dumps(resource) + '\n')
+        self.output_file.flush()
+
+    def write_mappings(self, resources):
+        """ Serialize a list of mapping dictionaries to the mapping or spool file """
+        for resource in resources:
+            self.mapping_file.write(self.dumps(resource) + '\n')
+        self.mapping_file.flush()
+
+    def close(self):
+        """ Append spooled mappings, if any, to the output file and discard the spool file """
+        if self.spool_file:
+            self.spool_file.seek(0)
+            shutil.copyfileobj(self.spool_file, self.output_file)
+            self.spool_file.close()
+        else:
+            self.mapping_file.flush()
+        self.output_file.flush()
+
+
+class GoldMappingIndex(object):
+    """
+    Index of "gold" mappings, which are SAME-AS mappings from a concept to a numeric code in the
+    dictionary's own source that give the official ID for the concept. The index is built in a
+    single pass with hash maps in both directions and records every concept with more than one
+    gold mapping, every gold code assigned to more than one concept and every required concept
+    without a gold mapping.
+    """
+
+    def __init__(self, org_id, required_concept_ids=None):
+        self.gold_ids = {}
+        self.local_ids = {}
+        self.errors = []
+
+        # Group gold codes by concept and concepts by gold code
+        gold_codes_by_concept = {}
+        concepts_by_gold_code = {}
+        gold_mappings = ConceptReferenceMap.objects.filter(
+            concept_reference_term__concept_source__name=org_id,
+            map_type__name=OclOpenmrsHelper.MAP_TYPE_SAME_AS,
+            concept_reference_term__code__regex=r'^[0-9]+$').order_by('concept_map_id')
+        for mapped_concept_id, gold_mapping_code in gold_mappings.values_list(
+                'concept_id', 'concept_reference_term__code'):
+            mapped_concept_id = str(mapped_concept_id)
+            gold_mapping_code = str(gold_mapping_code)
+            gold_codes_by_concept.setdefault(mapped_concept_id, []).append(gold_mapping_code)
+            concepts_by_gold_code.setdefault(gold_mapping_code, []).append(mapped_concept_id)
+
+        # Build the forward and reverse indexes and collect all conflicts
+        for mapped_concept_id, gold_mapping_codes in sorted(
+                gold_codes_by_concept.items(), key=lambda item: int(item[0])):
+            if len(gold_mapping_codes) > 1:
+                self.errors.append(
+                    "Concepts can only have one gold mapping. Concept '%s' has gold mapping to %s" %
+                    (mapped_concept_id, ' and '.join("'%s'" % code for code in gold_mapping_codes)))
+            self.gold_ids[mapped_concept_id] = gold_mapping_codes[0]
+        for gold_mapping_code, mapped_concept_ids in sorted(
+                concepts_by_gold_code.items(), key=lambda item: int(item[0])):
+            if len(mapped_concept_ids) > 1:
+                self.errors.append(
+                    "Gold mappings must be unique. The gold mapping '%s' is assigned to concepts %s" %
+                    (gold_mapping_code, ', '.join("'%s'" % c_id for c_id in mapped_concept_ids)))
+            self.local_ids[gold_mapping_code] = mapped_concept_ids[0]
+        for concept_id in sorted(required_concept_ids or []):
+            if str(concept_id) not in self.gold_ids:
+                self.errors.append("No gold mapping found for concept '%s'" % concept_id)
+
+    def raise_errors(self):
+        """ Raise RuntimeError listing every gold mapping error found, if any """
+        if self.errors:
+            raise RuntimeError('%s gold mapping error(s) found:\n%s' % (
+                len(self.errors), '\n'.join(self.errors)))
+
+    def get_gold_id(self, concept_id):
+        """ Returns the gold ID for a local concept ID """
+        local_concept_id = str(concept_id)
+        if local_concept_id not in self.gold_ids:
+            raise RuntimeError("No gold mapping found for concept '%s'" % local_concept_id)
+        return self.gold_ids[local_concept_id]
+
+    def get_local_id(self, gold_id):
+        """ Returns the local concept ID for a gold ID """
+        if str(gold_id) not in self.local_ids:
+            raise RuntimeError("No concept found for gold mapping '%s'" % gold_id)
+        return self.local_ids[str(gold_id)]
+
+
 # HELPER METHODS
 
 def add_f(dictionary, key, value):
@@ -0,0 +1,381 @@
+"""
+Command to generate a synthetic OpenMRS v1.11 concept dictionary for testing and benchmarking.
+
+The dictionary is written to the database configured in settings.py, so it may be loaded into a
+local MariaDB/MySQL database or, by setting the OMRS_SQLITE_DB environment variable, into a SQLite
+database file. Its size and shape are configurable and it is generated deterministically from
+--seed, so runs with the same options produce the same dictionary.
+
+Example usage:
+
+    OMRS_SQLITE_DB=local/synthetic.db python manage.py generate_dictionary --create_tables
+        --concepts=50000 --names_per_concept=4 --maps_per_concept=3
+
+Every concept has a fully specified English name, a SAME-AS mapping to its own ID in the
+dictionary's source (--source_name, e.g. CIEL) and --maps_per_concept mappings to other sources.
+A share of the concepts are coded questions with answers, concept sets with members, or numeric
+concepts (see the --*_ratio options).
+
+"""
+from optparse import make_option
+import datetime
+import random
+import uuid
+from django.core.management import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from omrs.models import (
+    Concept, ConceptAnswer, ConceptClass, ConceptComplex, ConceptDatatype, ConceptDescription,
+    ConceptMapType, ConceptName, ConceptNumeric, ConceptReferenceMap, ConceptReferenceSource,
+    ConceptReferenceTerm, ConceptSet)
+
+
+class Command(BaseCommand):
+    """ Generate a synthetic OpenMRS concept dictionary """
+
+    # Tables written by this command, in the order they must be loaded to satisfy foreign keys.
+    # No complex concepts are generated, but extract_db reads the concept_complex table.
+    MODELS = [
+        ConceptDatatype, ConceptClass, ConceptMapType, ConceptReferenceSource, Concept,
+        ConceptReferenceTerm, ConceptName, ConceptDescription, ConceptNumeric, ConceptComplex,
+        ConceptReferenceMap, ConceptAnswer, ConceptSet,
+    ]
+
+    # Reference data, as (ID, name) pairs, taken from a standard OpenMRS dictionary
+    DATATYPE_NUMERIC = 1
+    DATATYPE_CODED = 2
+    DATATYPE_TEXT = 3
+    DATATYPE_NA = 4
+    DATATYPES = [
+        (DATATYPE_NUMERIC, 'Numeric'), (DATATYPE_CODED, 'Coded'), (DATATYPE_TEXT, 'Text'),
+        (DATATYPE_NA, 'N/A'),
+    ]
+    CLASS_TEST = 1
+    CLASS_DIAGNOSIS = 4
+    CLASS_FINDING = 5
+    CLASS_QUESTION = 7
+    CLASS_CONVSET = 10
+    CLASS_MISC = 11
+    CLASSES = [
+        (CLASS_TEST, 'Test'), (CLASS_DIAGNOSIS, 'Diagnosis'), (CLASS_FINDING, 'Finding'),
+        (CLASS_QUESTION, 'Question'), (CLASS_CONVSET, 'ConvSet'), (CLASS_MISC, 'Misc'),
+    ]
+    MAP_TYPE_SAME_AS = 1
+    MAP_TYPES = [(MAP_TYPE_SAME_AS, 'SAME-AS'), (2, 'NARROWER-THAN'), (3, 'BROADER-THAN')]
+
+    # External sources referenced by mappings -- all exist in OclOpenmrsHelper.SOURCE_DIRECTORY
+    EXTERNAL_SOURCES = ['SNOMED CT', 'ICD-10-WHO', 'LOINC', 'PIH', 'AMPATH']
+
+    # Locales of the names after the fully specified and short English names
+    SYNONYM_LOCALES = ['en', 'fr', 'es', 'sw', 'ht']
+
+    # Kinds of concepts, which determine their datatype, class and related rows
+    KIND_PLAIN = 0
+    KIND_QUESTION = 1
+    KIND_SET = 2
+    KIND_NUMERIC = 3
+
+    DEFAULT_BATCH_SIZE = 1000
+    DATE_CREATED = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    help = 'Generate a synthetic OpenMRS concept dictionary in the configured database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--concepts',
+                    action='store',
+                    dest='num_concepts',
+                    default=10000,
+                    help='Number of concepts to generate. Default is 10000.'),
+        make_option('--first_concept_id',
+                    action='store',
+                    dest='first_concept_id',
+                    default=1,
+                    help='ID of the first concept; concept IDs are consecutive. Default is 1.'),
+        make_option('--names_per_concept',
+                    action='store',
+                    dest='names_per_concept',
+                    default=3,
+                    help='Number of names per concept. Default is 3.'),
+        make_option('--descriptions_per_concept',
+                    action='store',
+                    dest='descriptions_per_concept',
+                    default=1,
+                    help='Number of descriptions per concept. Default is 1.'),
+        make_option('--maps_per_concept',
+                    action='store',
+                    dest='maps_per_concept',
+                    default=2,
+                    help=('Number of reference maps to external sources per concept, in addition '
+                          'to the SAME-AS map to the dictionary\'s own source. Default is 2.')),
+        make_option('--question_ratio',
+                    action='store',
+                    dest='question_ratio',
+                    default=0.1,
+                    help='Share of concepts that are coded questions. Default is 0.1.'),
+        make_option('--answers_per_question',
+                    action='store',
+                    dest='answers_per_question',
+                    default=5,
+                    help='Number of answers per coded question. Default is 5.'),
+        make_option('--set_ratio',
+                    action='store',
+                    dest='set_ratio',
+                    default=0.05,
+                    help='Share of concepts that are concept sets. Default is 0.05.'),
+        make_option('--members_per_set',
+                    action='store',
+                    dest='members_per_set',
+                    default=8,
+                    help='Number of members per concept set. Default is 8.'),
+        make_option('--numeric_ratio',
+                    action='store',
+                    dest='numeric_ratio',
+                    default=0.1,
+                    help='Share of concepts that are numeric. Default is 0.1.'),
+        make_option('--retired_ratio',
+                    action='store',
+                    dest='retired_ratio',
+                    default=0.02,
+                    help='Share of concepts that are retired. Default is 0.02.'),
+        make_option('--source_name',
+                    action='store',
+                    dest='source_name',
+                    default='CIEL',
+                    help='Name of the dictionary\'s own reference source. Default is CIEL.'),
+        make_option('--seed',
+                    action='store',
+                    dest='seed',
+                    default=1,
+                    help='Random seed. Default is 1.'),
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    default=DEFAULT_BATCH_SIZE,
+                    help='Number of rows of each table queued for insertion at a time. Default is %s.' % DEFAULT_BATCH_SIZE),
+        make_option('--create_tables',
+                    action='store_true',
+                    dest='create_tables',
+                    default=False,
+                    help='Create any of the concept dictionary tables that do not exist yet.'),
+        make_option('--flush',
+                    action='store_true',
+                    dest='flush',
+                    default=False,
+                    help='Delete all rows from the concept dictionary tables first.'),
+    )
+
+    def handle(self, *args, **options):
+        # Handle command line arguments
+        self.num_concepts = int(options['num_concepts'])
+        self.first_concept_id = int(options['first_concept_id'])
+        self.names_per_concept = int(options['names_per_concept'])
+        self.descriptions_per_concept = int(options['descriptions_per_concept'])
+        self.maps_per_concept = int(options['maps_per_concept'])
+        self.question_ratio = float(options['question_ratio'])
+        self.answers_per_question = int(options['answers_per_question'])
+        self.set_ratio = float(options['set_ratio'])
+        self.members_per_set = int(options['members_per_set'])
+        self.numeric_ratio = float(options['numeric_ratio'])
+        self.retired_ratio = float(options['retired_ratio'])
+        self.source_name = options['source_name']
+        self.batch_size = int(options['batch_size'])
+        self.verbosity = int(options['verbosity'])
+        self.random = random.Random(int(options['seed']))
+        if self.num_concepts < 1 or self.names_per_concept < 1:
+            raise CommandError('--concepts and --names_per_concept must be at least 1')
+        if self.question_ratio + self.set_ratio + self.numeric_ratio > 1:
+            raise CommandError('--question_ratio, --set_ratio and --numeric_ratio must not add up to more than 1')
+
+        if options['create_tables']:
+            self.create_tables()
+        with transaction.atomic():
+            if options['flush']:
+                self.flush_tables()
+            elif Concept.objects.exists():
+                raise CommandError('The database already contains concepts; use --flush to replace them')
+            self.row_counts = dict((model, 0) for model in self.MODELS)
+            self.pending_rows = dict((model, []) for model in self.MODELS)
+            self.generate_dictionary()
+            self.flush_rows()
+
+        if self.verbosity:
+            for model in self.MODELS:
+                print '%s: %d rows' % (model._meta.db_table, self.row_counts[model])
+
+    def create_tables(self):
+        """ Creates the tables of the models in MODELS that do not exist yet """
+        existing_tables = set(connection.introspection.table_names())
+        known_models = set()
+        cursor = connection.cursor()
+        for model in self.MODELS:
+            if model._meta.db_table in existing_tables:
+                known_models.add(model)
+                continue
+            # The OpenMRS models are unmanaged, so Django only generates their SQL if asked to manage them
+            model._meta.managed = True
+            try:
+                statements, _ = connection.creation.sql_create_model(model, no_style(), known_models)
+            finally:
+                model._meta.managed = False
+            for statement in statements:
+                cursor.execute(statement)
+            if self.verbosity:
+                print 'Created table %s' % model._meta.db_table
+
+    def flush_tables(self):
+        """ Deletes all rows from the tables of the models in MODELS, dependent tables first """
+        cursor = connection.cursor()
+        for model in reversed(self.MODELS):
+            cursor.execute('DELETE FROM %s' % connection.ops.quote_name(model._meta.db_table))
+
+    def add_row(self, row):
+        """ Queues a model instance for bulk insertion, inserting all queued rows once enough are queued """
+        pending_rows = self.pending_rows[type(row)]
+        pending_rows.append(row)
+        if len(pending_rows) >= self.batch_size:
+            self.flush_rows()
+
+    def flush_rows(self):
+        """ Inserts all queued rows, in dependency order """
+        for model in self.MODELS:
+            pending_rows = self.pending_rows[model]
+            if pending_rows:
+                model.objects.bulk_create(pending_rows)
+                self.row_counts[model] += len(pending_rows)
+                self.pending_rows[model] = []
+
+    def get_uuid(self):
+        """ Returns a random UUID generated from the seeded random number generator """
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def generate_dictionary(self):
+        """
+        Generates the reference data and the concepts, then the rows that refer to concepts. All
+        concepts are inserted before any of their names, mappings, answers or set members, because
+        answers and set members may refer to any concept.
+        """
+        self.generate_reference_data()
+        concept_kinds = bytearray(self.num_concepts)
+        for num in range(self.num_concepts):
+            concept_kinds[num] = self.generate_concept(self.first_concept_id + num)
+        self.flush_rows()
+        self.term_id = self.map_id = self.name_id = self.description_id = 0
+        self.answer_id = self.set_member_id = 0
+        for num in range(self.num_concepts):
+            self.generate_concept_details(self.first_concept_id + num, concept_kinds[num])
+            if self.verbosity >= 2 and (num + 1) % 10000 == 0:
+                print '%d of %d concepts generated' % (num + 1, self.num_concepts)
+
+    def generate_reference_data(self):
+        """ Generates the datatypes, classes, map types and reference sources """
+        for datatype_id, name in self.DATATYPES:
+            self.add_row(ConceptDatatype(
+                concept_datatype_id=datatype_id, name=name, description=name, creator=1,
+                date_created=self.DATE_CREATED, retired=0, uuid=self.get_uuid()))
+        for class_id, name in self.CLASSES:
+            self.add_row(ConceptClass(
+                concept_class_id=class_id, name=name, description=name, creator=1,
+                date_created=self.DATE_CREATED, retired=0, uuid=self.get_uuid()))
+        for map_type_id, name in self.MAP_TYPES:
+            self.add_row(ConceptMapType(
+                concept_map_type_id=map_type_id, name=name, description='', creator=1,
+                date_created=self.DATE_CREATED, is_hidden=0, retired=0, uuid=self.get_uuid()))
+        self.source_ids = {}
+        for source_id, name in enumerate([self.source_name] + self.EXTERNAL_SOURCES, 1):
+            self.source_ids[name] = source_id
+            self.add_row(ConceptReferenceSource(
+                concept_source_id=source_id, name=name, description=name, hl7_code='SRC%d' % source_id,
+                creator=1, date_created=self.DATE_CREATED, retired=0, uuid=self.get_uuid()))
+
+    def generate_concept(self, concept_id):
+        """ Generates a concept and returns its kind """
+        share = self.random.random()
+        if share < self.question_ratio:
+            kind, datatype_id, class_id = self.KIND_QUESTION, self.DATATYPE_CODED, self.CLASS_QUESTION
+        elif share < self.question_ratio + self.set_ratio:
+            kind, datatype_id, class_id = self.KIND_SET, self.DATATYPE_NA, self.CLASS_CONVSET
+        elif share < self.question_ratio + self.set_ratio + self.numeric_ratio:
+            kind, datatype_id, class_id = self.KIND_NUMERIC, self.DATATYPE_NUMERIC, self.CLASS_TEST
+        else:
+            kind = self.KIND_PLAIN
+            datatype_id = self.random.choice([self.DATATYPE_NA, self.DATATYPE_TEXT])
+            class_id = self.random.choice([self.CLASS_DIAGNOSIS, self.CLASS_FINDING, self.CLASS_MISC])
+        self.add_row(Concept(
+            concept_id=concept_id, retired=self.random.random() < self.retired_ratio,
+            datatype_id=datatype_id, concept_class_id=class_id, is_set=int(kind == self.KIND_SET),
+            creator=1, date_created=self.DATE_CREATED, uuid=self.get_uuid()))
+        return kind
+
+    def generate_concept_details(self, concept_id, kind):
+        """ Generates the names, descriptions, mappings and answers or set members of a concept """
+        for num in range(self.names_per_concept):
+            if num == 0:
+                name_type, locale = 'FULLY_SPECIFIED', 'en'
+            elif num == 1:
+                name_type, locale = 'SHORT', 'en'
+            else:
+                name_type, locale = '', self.SYNONYM_LOCALES[num % len(self.SYNONYM_LOCALES)]
+            self.name_id += 1
+            self.add_row(ConceptName(
+                concept_name_id=self.name_id, concept_id=concept_id,
+                name=u'Concept %d name %d' % (concept_id, num + 1), locale=locale, creator=1,
+                date_created=self.DATE_CREATED, voided=False, uuid=self.get_uuid(),
+                concept_name_type=name_type, locale_preferred=(num == 0)))
+        for num in range(self.descriptions_per_concept):
+            self.description_id += 1
+            self.add_row(ConceptDescription(
+                concept_description_id=self.description_id, concept_id=concept_id,
+                description=u'Description %d of concept %d' % (num + 1, concept_id), locale='en',
+                creator=1, date_created=self.DATE_CREATED, uuid=self.get_uuid()))
+        if kind == self.KIND_NUMERIC:
+            self.add_row(ConceptNumeric(
+                concept_id=concept_id, hi_absolute=1000.0, hi_normal=100.0, low_normal=10.0,
+                low_absolute=0.0, units='mg/dl', allow_decimal=self.random.random() < 0.5,
+                display_precision=1))
+
+        # Reference maps -- a SAME-AS map to the concept's own ID, then maps to external sources
+        self.add_reference_map(concept_id, self.source_name, str(concept_id), self.MAP_TYPE_SAME_AS)
+        for num in range(self.maps_per_concept):
+            self.add_reference_map(
+                concept_id, self.random.choice(self.EXTERNAL_SOURCES), 'C%d.%d' % (concept_id, num + 1),
+                self.random.choice(self.MAP_TYPES)[0])
+
+        # Answers and set members are drawn from all concepts, excluding the concept itself
+        if kind == self.KIND_QUESTION:
+            for sort_weight, answer_concept_id in enumerate(
+                    self.get_related_concept_ids(concept_id, self.answers_per_question), 1):
+                self.answer_id += 1
+                self.add_row(ConceptAnswer(
+                    concept_answer_id=self.answer_id, question_concept_id=concept_id,
+                    answer_concept_id=answer_concept_id, creator=1, date_created=self.DATE_CREATED,
+                    uuid=self.get_uuid(), sort_weight=float(sort_weight)))
+        elif kind == self.KIND_SET:
+            for sort_weight, member_concept_id in enumerate(
+                    self.get_related_concept_ids(concept_id, self.members_per_set), 1):
+                self.set_member_id += 1
+                self.add_row(ConceptSet(
+                    concept_set_id=self.set_member_id, concept_id=member_concept_id,
+                    concept_set_owner_id=concept_id, creator=1, date_created=self.DATE_CREATED,
+                    uuid=self.get_uuid(), sort_weight=float(sort_weight)))
+
+    def add_reference_map(self, concept_id, source_name, code, map_type_id):
+        """ Generates a reference term and a reference map from the concept to it """
+        self.term_id += 1
+        self.add_row(ConceptReferenceTerm(
+            concept_reference_term_id=self.term_id, concept_source_id=self.source_ids[source_name],
+            code=code, name='', creator=1, date_created=self.DATE_CREATED, retired=0,
+            uuid=self.get_uuid()))
+        self.map_id += 1
+        self.add_row(ConceptReferenceMap(
+            concept_map_id=self.map_id, concept_id=concept_id, concept_reference_term_id=self.term_id,
+            map_type_id=map_type_id, creator=1, date_created=self.DATE_CREATED, uuid=self.get_uuid()))
+
+    def get_related_concept_ids(self, concept_id, count):
+        """ Returns up to count distinct random concept IDs other than concept_id """
+        count = min(count, self.num_concepts - 1)
+        related_concept_ids = set()
+        while len(related_concept_ids) < count:
+            related_concept_id = self.first_concept_id + self.random.randrange(self.num_concepts)
+            if related_concept_id != concept_id:
+                related_concept_ids.add(related_concept_id)
+        return sorted(related_concept_ids)
@@ -1,7 +1,22 @@
 from optparse import make_option
+import datetime
+import glob
 import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from django.core.management import BaseCommand, CommandError
-from omrs.management.commands import OclOpenmrsHelper
+from omrs.management.commands import (
+    OclOpenmrsHelper, open_input_file, get_input_compression, COMPRESSION_NONE)
+from omrs.profiling import CommandProfiler
+import jsonschema
+import requests
+import ocldev.oclconstants
 import ocldev.oclvalidator
 import ocldev.oclfleximporter
 
@@ -9,13 +24,50 @@ import ocldev.oclfleximporter
 class Command(BaseCommand):
     """ Import and validate an import file """
 
+    # Number of lines validated together by a worker process
+    DEFAULT_CHUNK_SIZE = 5000
+
+    # Maximum number of validation errors displayed
+    MAX_ERRORS_DISPLAYED = 100
+
+    # Polling of bulk import tasks -- the delay doubles after each poll up to the maximum
+    POLL_INITIAL_DELAY_SECONDS = ocldev.oclfleximporter.OclBulkImporter.OCL_BULK_IMPORT_MINIMUM_DELAY_SECONDS
+    POLL_MAX_DELAY_SECONDS = 300
+    POLL_BACKOFF_FACTOR = 2
+    POLL_TIMEOUT_SECONDS = 60
+
+    # Fields of a pending bulk import task's status that may describe its progress
+    TASK_PROGRESS_KEYS = ['summary', 'details', 'progress']
+
+    # Import phases -- files with mappings are imported after all other files have finished
+    PHASE_CONCEPTS = 'concepts'
+    PHASE_MAPPINGS = 'mappings'
+    PHASES = [PHASE_CONCEPTS, PHASE_MAPPINGS]
+    DEFAULT_MAX_CONCURRENT_IMPORTS = 4
+
+    # Suffixes of the results and state files written by this command
+    RESULTS_FILE_SUFFIX = '.results.json'
+    STATE_FILE_SUFFIX = 'import-state.json'
+
     help = 'Import and validate an OCL-formatted import file.'
     option_list = BaseCommand.option_list + (
         make_option('--filename',
                     action='store',
                     dest='ocl_import_filename',
                     default=None,
-                    help='OCL import filename'),
+                    help='OCL import filename, or a glob pattern (e.g. "parts/*.json") to import several files'),
+        make_option('--manifest',
+                    action='store',
+                    dest='manifest_filename',
+                    default=None,
+                    help=('JSON file listing the files to import, either as a list or as '
+                          '{"concepts": [...], "mappings": [...]}; paths are relative to the manifest')),
+        make_option('--max_concurrent_imports',
+                    action='store',
+                    dest='max_concurrent_imports',
+                    default=DEFAULT_MAX_CONCURRENT_IMPORTS,
+                    help=('Maximum number of files imported at the same time when importing several '
+                          'files (default %s)' % DEFAULT_MAX_CONCURRENT_IMPORTS)),
         make_option('--validate-only',
                     action='store_true',
                     dest='validate_only',
@@ -31,6 +83,54 @@ class Command(BaseCommand):
                     dest='ocl_api_token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of processes used to validate the import file (default: number of CPUs)'),
+        make_option('--chunk_size',
+                    action='store',
+                    dest='chunk_size',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help='Number of lines validated at a time by each process (default %s)' % DEFAULT_CHUNK_SIZE),
+        make_option('--wait',
+                    action='store_true',
+                    dest='wait',
+                    default=False,
+                    help='Wait for the bulk import to finish and save its results'),
+        make_option('--max_wait',
+                    action='store',
+                    dest='max_wait',
+                    default=0,
+                    help='Maximum number of seconds to wait for the bulk import, or 0 for no limit'),
+        make_option('--results_file',
+                    action='store',
+                    dest='results_filename',
+                    default=None,
+                    help=('File to save the bulk import results to when importing a single file '
+                          '(default: FILENAME.results.json)')),
+        make_option('--state_file',
+                    action='store',
+                    dest='state_filename',
+                    default=None,
+                    help=('File that records submitted bulk import tasks, so that an interrupted '
+                          'session reattaches to its tasks (default: FILENAME.import-state.json, '
+                          'MANIFEST.import-state.json or import-state.json next to the files)')),
+        make_option('--resubmit',
+                    action='store_true',
+                    dest='resubmit',
+                    default=False,
+                    help='Submit the files even if the state file already has tasks for them'),
+        make_option('--profile',
+                    action='store_true',
+                    dest='profile',
+                    default=False,
+                    help='Display the wall time of validating and importing and the peak memory use'),
+        make_option('--profile_output',
+                    action='store',
+                    dest='profile_output_filename',
+                    default=None,
+                    help='Also profile the command with cProfile and write the stats to this file'),
     )
 
     def handle(self, *args, **options):
@@ -39,37 +139,377 @@ class Command(BaseCommand):
         # Validate command line arguments
         if options['verbosity']:
             print options
-        if not options['ocl_import_filename']:
+        if not options['ocl_import_filename'] and not options['manifest_filename']:
             raise CommandError('Missing required argument "filename"')
         if not options['validate_only']:
             if options['ocl_api_env'] not in OclOpenmrsHelper.OCL_API_URL:
                 raise CommandError('Invalid "env" option provided: %s' % options['ocl_api_env'])
             if not options['ocl_api_token']:
                 raise CommandError('"token" required to process import. None provided')
+        self.ocl_api_token = options['ocl_api_token']
+        self.ocl_api_url_root = OclOpenmrsHelper.OCL_API_URL.get(options['ocl_api_env'])
+        self.profiler = CommandProfiler(
+            enabled=options['profile'], cprofile_filename=options['profile_output_filename'])
+        self.profiler.start()
+
+        # Determine the files to import
+        parts = self.get_import_parts(options['ocl_import_filename'], options['manifest_filename'])
+        if len(parts) == 1:
+            parts[0]['results_filename'] = options['results_filename'] or parts[0]['results_filename']
+        elif options['results_filename']:
+            raise CommandError('"results_file" can only be used when importing a single file')
+        if options['state_filename']:
+            self.state_filename = options['state_filename']
+        elif options['manifest_filename']:
+            self.state_filename = '%s.%s' % (options['manifest_filename'], self.STATE_FILE_SUFFIX)
+        elif len(parts) == 1:
+            self.state_filename = '%s.%s' % (parts[0]['filename'], self.STATE_FILE_SUFFIX)
+        else:
+            self.state_filename = os.path.join(
+                os.path.dirname(parts[0]['filename']), self.STATE_FILE_SUFFIX)
+        self.state_lock = threading.Lock()
 
-        # Load the file -- must be OCL-formatted JSON
-        input_list = []
-        with open(options['ocl_import_filename']) as json_lines_input_file:
-            for raw_json_line in json_lines_input_file:
-                input_list.append(json.loads(raw_json_line))
-        print '%s resources loaded from \"%s\"' % (len(input_list), options['ocl_import_filename'])
+        # Reattach to tasks already submitted for the files and validate the other files
+        tasks = {}
+        num_errors = 0
+        for part in parts:
+            task = None
+            if not options['validate_only'] and not options['resubmit']:
+                task = self.get_submitted_task(part['filename'])
+            if task:
+                tasks[part['filename']] = task
+                part['phase'] = task.get('phase', part['phase'] or self.PHASE_MAPPINGS)
+                continue
 
-        # Validate resources
-        print 'Validating...'
-        ocldev.oclvalidator.OclJsonValidator.validate(input_list)
+            # Validate resources -- the file must be OCL-formatted JSON lines
+            print 'Validating...'
+            with self.profiler.phase('validate'):
+                type_counts, part_num_errors = self.validate_file(
+                    part['filename'], int(options['workers']), int(options['chunk_size']))
+            print '%s resources loaded from \"%s\"' % (sum(type_counts.values()), part['filename'])
+            num_errors += part_num_errors
+            if not part['phase']:
+                if type_counts.get(ocldev.oclconstants.OclConstants.RESOURCE_TYPE_MAPPING):
+                    part['phase'] = self.PHASE_MAPPINGS
+                else:
+                    part['phase'] = self.PHASE_CONCEPTS
+        if num_errors:
+            raise CommandError('%s invalid resources in "%s"' % (
+                num_errors, options['ocl_import_filename'] or options['manifest_filename']))
 
         # Run the import
         if options['validate_only']:
             print 'Skipping import due to settings...'
+            self.profiler.print_summary()
+            return
+        for phase in self.PHASES:
+            phase_parts = [part for part in parts if part['phase'] == phase]
+            if not phase_parts:
+                continue
+            if len(parts) > 1:
+                print '\nImporting %s %s file(s)...' % (len(phase_parts), phase)
+            with self.profiler.phase('import %s' % phase):
+                self.import_parts(phase_parts, tasks, options['wait'] or len(parts) > 1,
+                                  int(options['max_concurrent_imports']), int(options['max_wait']))
+        self.profiler.print_summary()
+
+    def get_import_parts(self, filename_pattern, manifest_filename):
+        """
+        Returns a list of dictionaries describing each file to import. The files are either
+        listed in a manifest, optionally grouped into "concepts" and "mappings", or are the file
+        named by filename_pattern if it exists, or else the files matching it as a glob pattern,
+        ignoring any results and state files written by previous imports. The phase of a file
+        that is not grouped is determined when it is validated.
+        """
+        filenames = []
+        if manifest_filename:
+            with open(manifest_filename, 'rb') as manifest_file:
+                manifest = json.load(manifest_file)
+            manifest_dir = os.path.dirname(manifest_filename)
+            if isinstance(manifest, dict):
+                for phase in self.PHASES:
+                    for filename in manifest.get(phase, []):
+                        filenames.append((os.path.join(manifest_dir, filename), phase))
+            else:
+                for filename in manifest:
+                    filenames.append((os.path.join(manifest_dir, filename), None))
+        elif os.path.exists(filename_pattern):
+            # An existing file is used as-is, even if its name contains glob characters
+            filenames = [(filename_pattern, None)]
+        else:
+            filenames = [(filename, None) for filename in sorted(glob.glob(filename_pattern))
+                         if not filename.endswith((self.RESULTS_FILE_SUFFIX, self.STATE_FILE_SUFFIX))]
+        if not filenames:
+            raise CommandError('No files to import found in "%s"' % (
+                manifest_filename or filename_pattern))
+        return [{
+            'filename': filename,
+            'phase': phase,
+            'results_filename': filename + self.RESULTS_FILE_SUFFIX,
+        } for filename, phase in filenames]
+
+    def import_parts(self, parts, tasks, wait, max_concurrent_imports, max_wait=0):
+        """
+        Submits each file that does not have a task yet and, if wait is set, waits for its task
+        to finish. Up to max_concurrent_imports files are imported at the same time.
+        """
+        def import_part(part):
+            task = tasks.get(part['filename'])
+            if task and task.get('finished'):
+                return task
+            if not task:
+                task = self.submit_import(part['filename'], part['phase'])
+                tasks[part['filename']] = task
+            if wait:
+                self.wait_for_import(part['filename'], task, part['results_filename'], max_wait)
+            return task
+        pool = ThreadPool(max(1, min(max_concurrent_imports, len(parts))))
+        try:
+            pool.map(import_part, parts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_submitted_task(self, filename):
+        """
+        Returns the task recorded in the state file for a file if it was submitted to the same
+        OCL environment and is either unfinished or finished without the file changing since.
+        Otherwise returns None, and the file will be submitted again.
+        """
+        task = self.load_state().get(os.path.abspath(filename))
+        if not task or task['api_url_root'] != self.ocl_api_url_root:
+            return None
+        if task.get('finished'):
+            if task.get('file_signature') != self.get_file_signature(filename):
+                return None
+            print 'Skipping "%s", already imported by bulk import task %s (see "%s")' % (
+                filename, task['task_id'], self.state_filename)
         else:
-            ocl_api_url_root = OclOpenmrsHelper.OCL_API_URL[options['ocl_api_env']]
-            print 'Submitting bulk import to "%s"...' % ocl_api_url_root
+            print 'Reattaching to bulk import task %s for "%s" submitted %s (see "%s")' % (
+                task['task_id'], filename, time.ctime(task['submitted']), self.state_filename)
+        return task
+
+    @staticmethod
+    def get_file_signature(filename):
+        """ Returns the size and modification time of a file, to detect whether it has changed """
+        file_stat = os.stat(filename)
+        return [file_stat.st_size, file_stat.st_mtime]
+
+    def submit_import(self, filename, phase=None):
+        """ Submits a file to the OCL bulk import API and records the task in the state file """
+        print 'Submitting bulk import of "%s" to "%s"...' % (filename, self.ocl_api_url_root)
+        if get_input_compression(filename) == COMPRESSION_NONE:
             import_request = ocldev.oclfleximporter.OclBulkImporter.post(
-                file_path=options['ocl_import_filename'],
-                api_url_root=ocl_api_url_root,
-                api_token=options['ocl_api_token'])
-            import_request.raise_for_status()
-            import_response = import_request.json()
-            task_id = import_response['task']
-            print 'Bulk Import Task ID: %s' % task_id
-            print 'Request status at: %s/manage/bulkimport/?task=%s' % (ocl_api_url_root, task_id)
+                file_path=filename,
+                api_url_root=self.ocl_api_url_root,
+                api_token=self.ocl_api_token)
+        else:
+            # The bulk import API only accepts uncompressed JSON lines
+            with tempfile.NamedTemporaryFile(suffix='.json') as decompressed_file:
+                with open_input_file(filename) as compressed_file:
+                    shutil.copyfileobj(compressed_file, decompressed_file)
+                decompressed_file.flush()
+                import_request = ocldev.oclfleximporter.OclBulkImporter.post(
+                    file_path=decompressed_file.name,
+                    api_url_root=self.ocl_api_url_root,
+                    api_token=self.ocl_api_token)
+        import_request.raise_for_status()
+        import_response = import_request.json()
+        task_id = import_response['task']
+        print 'Bulk Import Task ID: %s' % task_id
+        print 'Request status at: %s/manage/bulkimport/?task=%s' % (self.ocl_api_url_root, task_id)
+        task = {
+            'task_id': task_id,
+            'api_url_root': self.ocl_api_url_root,
+            'phase': phase,
+            'file_signature': self.get_file_signature(filename),
+            'submitted': time.time(),
+            'state': ocldev.oclfleximporter.OclBulkImporter.OCL_BULK_IMPORT_STATUS_PENDING,
+        }
+        self.save_task(filename, task)
+        return task
+
+    def wait_for_import(self, filename, task, results_filename, max_wait=0):
+        """
+        Polls a bulk import task until it finishes, doubling the delay between requests up to
+        POLL_MAX_DELAY_SECONDS, and displays its progress. Failed requests are retried on the same
+        schedule. The results are saved to results_filename and the task's state is recorded in
+        the state file after each poll. Returns the OclImportResults of the task.
+        """
+        url = task['api_url_root'] + ocldev.oclfleximporter.OclBulkImporter.OCL_BULK_IMPORT_API_ENDPOINT
+        session = requests.Session()
+        session.headers.update({'Authorization': 'Token ' + self.ocl_api_token})
+        start_time = time.time()
+        delay_seconds = self.POLL_INITIAL_DELAY_SECONDS
+        try:
+            while True:
+                try:
+                    response = session.get(url, params={'task': task['task_id'], 'result': 'json'},
+                                           timeout=self.POLL_TIMEOUT_SECONDS)
+                    response.raise_for_status()
+                    results_json = response.json()
+                except requests.HTTPError as e:
+                    if e.response.status_code < 500 and e.response.status_code != 429:
+                        raise CommandError('Unable to get status of bulk import task %s: %s' % (
+                            task['task_id'], e))
+                    print 'WARNING: Unable to get status of bulk import task %s: %s' % (task['task_id'], e)
+                    results_json = None
+                except (requests.RequestException, ValueError) as e:
+                    print 'WARNING: Unable to get status of bulk import task %s: %s' % (task['task_id'], e)
+                    results_json = None
+                if isinstance(results_json, dict):
+                    state = results_json.get('state')
+                    if state not in ocldev.oclfleximporter.OclBulkImporter.OCL_BULK_IMPORT_STATUSES:
+                        return self.save_results(filename, task, results_json, results_filename)
+                    task['state'] = state
+                    self.save_task(filename, task)
+                    self.print_progress(task, results_json)
+                if max_wait and time.time() - start_time + delay_seconds > max_wait:
+                    raise CommandError(
+                        'Bulk import task %s did not finish within %s seconds. Run the command '
+                        'again to reattach to it.' % (task['task_id'], max_wait))
+                time.sleep(delay_seconds)
+                delay_seconds = min(delay_seconds * self.POLL_BACKOFF_FACTOR, self.POLL_MAX_DELAY_SECONDS)
+        finally:
+            session.close()
+
+    def print_progress(self, task, results_json):
+        """
+        Displays the state of a pending bulk import task, with its progress and throughput if
+        the status includes a count such as "1500/30000"
+        """
+        elapsed_seconds = time.time() - task['submitted']
+        message = 'Bulk import task %s %s after %s' % (
+            task['task_id'], task['state'], datetime.timedelta(seconds=int(elapsed_seconds)))
+        progress = ' '.join(unicode(results_json[key]) for key in self.TASK_PROGRESS_KEYS
+                            if results_json.get(key))
+        if progress:
+            message += ': %s' % progress
+            match = re.search(r'(\d+)\s*/\s*(\d+)', progress)
+            if match and elapsed_seconds > 0:
+                message += ' (%.1f resources/sec)' % (int(match.group(1)) / elapsed_seconds)
+        print message
+
+    def save_results(self, filename, task, results_json, results_filename):
+        """ Saves the results of a finished bulk import task and displays a summary """
+        import_results = ocldev.oclfleximporter.OclImportResults.load_from_json(results_json)
+        with open(results_filename, 'wb') as results_file:
+            results_file.write(import_results.to_json())
+        task['state'] = results_json.get('state', 'SUCCESS')
+        task['finished'] = time.time()
+        task['results_file'] = results_filename
+        self.save_task(filename, task)
+        elapsed_seconds = task['finished'] - task['submitted']
+        print 'Bulk import task %s finished after %s' % (
+            task['task_id'], datetime.timedelta(seconds=int(elapsed_seconds)))
+        print import_results.get_detailed_summary()
+        if elapsed_seconds > 0:
+            print '%.1f resources/sec' % (import_results.count / elapsed_seconds)
+        if import_results.has_error_status_code():
+            print 'WARNING: Some resources were not imported successfully'
+        print 'Results saved to "%s"' % results_filename
+        return import_results
+
+    def load_state(self):
+        """ Returns the tasks recorded in the state file, keyed by the absolute path of their file """
+        if not os.path.exists(self.state_filename):
+            return {}
+        with open(self.state_filename, 'rb') as state_file:
+            return json.load(state_file).get('tasks', {})
+
+    def save_task(self, filename, task):
+        """ Records the task submitted for a file in the state file """
+        with self.state_lock:
+            tasks = self.load_state()
+            tasks[os.path.abspath(filename)] = task
+            temp_filename = '%s.tmp' % self.state_filename
+            with open(temp_filename, 'wb') as state_file:
+                json.dump({'tasks': tasks}, state_file, indent=2, sort_keys=True)
+            os.rename(temp_filename, self.state_filename)
+
+    def validate_file(self, filename, workers, chunk_size):
+        """
+        Validates a JSON lines import file in chunks of chunk_size lines, using a pool of worker
+        processes if workers is more than 1. Only a few chunks per worker are read ahead, so
+        memory use does not depend on the size of the file. Errors are displayed with their line
+        numbers. Returns a tuple of a dictionary of the number of resources of each type and the
+        number of errors.
+        """
+        type_counts = {}
+        num_errors = 0
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        pending = []
+        try:
+            for chunk in self.iter_chunks(filename, chunk_size):
+                if pool:
+                    pending.append(pool.apply_async(validate_chunk, (chunk,)))
+                    if len(pending) < workers * 2:
+                        continue
+                    chunk_results = pending.pop(0).get()
+                else:
+                    chunk_results = validate_chunk(chunk)
+                num_errors = self.add_chunk_results(chunk_results, type_counts, num_errors)
+            for result in pending:
+                num_errors = self.add_chunk_results(result.get(), type_counts, num_errors)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        if num_errors > self.MAX_ERRORS_DISPLAYED:
+            print '... %s more errors' % (num_errors - self.MAX_ERRORS_DISPLAYED)
+        return type_counts, num_errors
+
+    def add_chunk_results(self, chunk_results, type_counts, num_errors):
+        """
+        Displays the errors of a validated chunk, adds its resource counts to type_counts and
+        returns the new total number of errors
+        """
+        chunk_type_counts, chunk_errors = chunk_results
+        for resource_type, count in chunk_type_counts.items():
+            type_counts[resource_type] = type_counts.get(resource_type, 0) + count
+        for line_number, error in chunk_errors:
+            if num_errors < self.MAX_ERRORS_DISPLAYED:
+                print 'Line %s: %s' % (line_number, error)
+            num_errors += 1
+        return num_errors
+
+    @staticmethod
+    def iter_chunks(filename, chunk_size):
+        """ Generator that yields (first line number, lines) for each chunk_size lines of a file """
+        with open_input_file(filename) as json_lines_input_file:
+            lines = []
+            first_line_number = 1
+            for line_number, raw_json_line in enumerate(json_lines_input_file, 1):
+                lines.append(raw_json_line)
+                if len(lines) >= chunk_size:
+                    yield first_line_number, lines
+                    lines = []
+                    first_line_number = line_number + 1
+            if lines:
+                yield first_line_number, lines
+
+
+def validate_chunk(chunk):
+    """
+    Validates the JSON resource on each line of a chunk of an import file. Runs in a worker
+    process. Returns a tuple of a dictionary of the number of resources of each type and a list
+    of (line number, error).
+    """
+    first_line_number, lines = chunk
+    type_counts = {}
+    errors = []
+    for line_number, raw_json_line in enumerate(lines, first_line_number):
+        if not raw_json_line.strip():
+            continue
+        resource_type = None
+        try:
+            resource = json.loads(raw_json_line)
+            if isinstance(resource, dict):
+                resource_type = resource.get('type')
+            ocldev.oclvalidator.OclJsonValidator.validate_resource(resource)
+        except jsonschema.ValidationError as e:
+            errors.append((line_number, e.message))
+        except Exception as e:
+            errors.append((line_number, str(e)))
+        type_counts[resource_type] = type_counts.get(resource_type, 0) + 1
+    return type_counts, errors
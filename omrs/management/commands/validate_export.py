@@ -1,14 +1,32 @@
 """
 Command to validate an OCL source version export against an OpenMRS dictionary stored in Mysql.
 
-TODO: Implement "deep" comparison for both concepts and mappings -- start with checking only active status
+The export file may be an OCL source version export (a JSON object with 'concepts' and 'mappings'
+lists) or the JSON lines generated by extract_db, and may be gzip or zstd compressed. The file is
+parsed incrementally, one resource at a time, and concepts and mappings are validated in a single
+pass through the file, so it does not need to fit into memory or be decoded more than once.
+
+The MySQL dictionary is loaded once, with one query per table, into the compact in-memory model in
+omrs/dictionary.py, and concepts and mappings are then validated against it in memory.
+
+Concepts in both OCL and MySQL are also compared "deeply": a fingerprint of each concept's class,
+datatype, retired status, names, descriptions and numeric extras is compared, and a field-level diff
+is reported for the concepts whose fingerprints differ.
+
+TODO: Implement "deep" comparison for mappings -- start with checking only active status
 
 """
+import hashlib
 import json
-from django.core.management import BaseCommand
+import os
+import re
+import urllib
+from collections import OrderedDict
+from django.core.management import BaseCommand, CommandError
 from optparse import make_option
-from omrs.models import (Concept, ConceptReferenceMap, ConceptAnswer, ConceptSet)
-from omrs.management.commands import OclOpenmrsHelper
+from omrs.dictionary import ConceptDictionary
+from omrs.management.commands import OclOpenmrsHelper, open_input_file
+from omrs.profiling import CommandProfiler
 
 
 class Command(BaseCommand):
@@ -20,6 +38,24 @@ class Command(BaseCommand):
     MISSING_IN_OCL = 1
     MISSING_IN_MYSQL = 2
 
+    # Concept fields covered by the deep comparison, in the order they are reported
+    CONCEPT_COMPARISON_FIELDS = ['concept_class', 'datatype', 'retired', 'names', 'descriptions',
+                                 'numeric']
+    NUMERIC_EXTRAS = [
+        ('hi_absolute', float),
+        ('hi_critical', float),
+        ('hi_normal', float),
+        ('low_absolute', float),
+        ('low_critical', float),
+        ('low_normal', float),
+        ('units', unicode),
+        ('allow_decimal', bool),
+        ('display_precision', int),
+    ]
+
+    # Number of discrepancies of each type displayed and included in the report by default
+    DEFAULT_MAX_SAMPLES = 20
+
     # Command attributes
     help = 'Validate an OCL export against an OpenMRS dictionary stored in Mysql.'
     option_list = BaseCommand.option_list + (
@@ -33,6 +69,41 @@ class Command(BaseCommand):
                     dest='ignore_retired_mappings',
                     default=False,
                     help='Retired mappings in OCL are not included in the comparison if set to True'),
+        make_option('--skip_deep_comparison',
+                    action='store_true',
+                    dest='skip_deep_comparison',
+                    default=False,
+                    help='Only compare concept IDs, not the fields of each concept'),
+        make_option('--source_directory',
+                    action='store',
+                    dest='source_directory_filename',
+                    default=None,
+                    help=('JSON or CSV file of OpenMRS-to-OCL source definitions to use instead '
+                          'of the built-in SOURCE_DIRECTORY')),
+        make_option('--report',
+                    action='store',
+                    dest='report_filename',
+                    default=None,
+                    help=('Write a JSON report of counts and discrepancies to this file; the full '
+                          'list of each type of discrepancy is written to a JSON lines file '
+                          'next to it')),
+        make_option('--max_samples',
+                    action='store',
+                    dest='max_samples',
+                    default=DEFAULT_MAX_SAMPLES,
+                    help=('Maximum number of discrepancies of each type to display and include '
+                          'in the report, or 0 for all (default %s)' % DEFAULT_MAX_SAMPLES)),
+        make_option('--profile',
+                    action='store_true',
+                    dest='profile',
+                    default=False,
+                    help=('Display the wall time and SQL queries of each phase of the validation '
+                          'and the peak memory use')),
+        make_option('--profile_output',
+                    action='store',
+                    dest='profile_output_filename',
+                    default=None,
+                    help='Also profile the validation with cProfile and write the stats to this file'),
     )
 
 
@@ -47,129 +118,342 @@ class Command(BaseCommand):
         # Get command line arguments
         self.ocl_export_filename = options['ocl_export_filename']
         self.ignore_retired_mappings = options['ignore_retired_mappings']
+        self.skip_deep_comparison = options['skip_deep_comparison']
         self.verbosity = int(options['verbosity'])
 
+        # Create the directory of the report, if needed, before validating rather than after
+        if options['report_filename']:
+            report_dir = os.path.dirname(os.path.abspath(options['report_filename']))
+            if not os.path.isdir(report_dir):
+                try:
+                    os.makedirs(report_dir)
+                except OSError as e:
+                    raise CommandError('Unable to create report directory "%s": %s' % (report_dir, e))
+        self.report = ValidationReport(report_filename=options['report_filename'],
+                                       max_samples=int(options['max_samples']))
+        self.profiler = CommandProfiler(
+            enabled=options['profile'], cprofile_filename=options['profile_output_filename'])
+        self.profiler.start()
+
         # Option debug output
         if self.verbosity >= 2:
             print 'COMMAND LINE OPTIONS:\n', options
 
-        # Load the OCL export file into memory
-        # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
-        export_text = open(self.ocl_export_filename).read()
-        loaded_json = json.loads(export_text)
-        export_text = None
-        if 'concepts' not in loaded_json:
-            loaded_json['concepts'] = []
-        if 'mappings' not in loaded_json:
-            loaded_json['mappings'] = []
+        # Load the source directory, if specified, and flag duplicate entries
+        if options['source_directory_filename']:
+            for warning in OclOpenmrsHelper.load_source_directory(
+                    options['source_directory_filename']):
+                print 'WARNING: %s' % warning
 
-        # Validate the concepts and mappings in the file
-        self.validate_export(loaded_json)
+        # Open the OCL export file -- concepts and mappings are streamed from it as needed
+        export_file = OclExportFile(self.ocl_export_filename)
+        if self.verbosity >= 2:
+            print 'Reading "%s" as %s' % (self.ocl_export_filename, export_file.format)
 
-    def validate_export(self, data):
-        self.validate_concepts(data)
-        self.validate_mappings(data)
+        # Validate the concepts and mappings in the file
+        self.validate_export(export_file)
 
-    def validate_concepts(self, data):
+        # Write the report
+        if self.report.report_filename:
+            with self.profiler.phase('write report'):
+                self.report.write(export=self.ocl_export_filename, format=export_file.format)
+            print '\nReport written to "%s"' % self.report.report_filename
+        self.profiler.print_summary()
 
-        # Create an array of concept IDs that are in the mysql db
-        print '\nCONCEPT COUNT COMPARISON:'
-        id_comparison = {
+    def validate_export(self, data):
+        """
+        Validates the concepts and mappings of the export in a single pass through the file, then
+        prints the count comparisons and summaries of the discrepancies found
+        """
+        with self.profiler.phase('load MySQL dictionary'):
+            self.dictionary = ConceptDictionary(concepts=not self.skip_deep_comparison).load()
+        with self.profiler.phase('index MySQL mappings'):
+            self.start_concept_validation()
+            self.index_mysql_mappings()
+        print '\nVALIDATING CONCEPTS AND MAPPINGS:'
+        for resource_type, resource in self.profiler.iter_phase('read export', data.iter_resources()):
+            if resource_type == OclExportFile.CONCEPT:
+                with self.profiler.phase('validate concepts'):
+                    self.validate_concept(resource)
+            else:
+                with self.profiler.phase('validate mappings'):
+                    self.validate_mapping(resource)
+        with self.profiler.phase('validate concepts'):
+            self.summarize_concepts()
+        with self.profiler.phase('validate mappings'):
+            self.summarize_mappings()
+
+    def start_concept_validation(self):
+        """ Prepares the MySQL concept IDs and fingerprints that OCL concepts are compared with """
+        # Concept IDs in MySQL not yet found in OCL, and the number of times each concept ID
+        # missing in MySQL occurs in OCL
+        self.concept_comparison = {
             self.MISSING_IN_OCL:{},
             self.MISSING_IN_MYSQL:{},
         }
-        for c_mysql in Concept.objects.raw('SELECT concept_id FROM concept'):
-            id_comparison[self.MISSING_IN_OCL][str(c_mysql.concept_id)] = 0
-        count_mysql = len(id_comparison[self.MISSING_IN_OCL])
-
+        for c_mysql in self.dictionary:
+            self.concept_comparison[self.MISSING_IN_OCL][str(c_mysql.concept_id)] = 0
+        self.cnt_mysql_concepts = len(self.concept_comparison[self.MISSING_IN_OCL])
+        self.cnt_ocl_concepts = 0
+        self.missing_concept_samples = []
+
+        # Fingerprint the concepts in MySQL for the deep comparison
+        self.mysql_fingerprints = {}
+        if not self.skip_deep_comparison:
+            for c_mysql in self.dictionary:
+                self.mysql_fingerprints[str(c_mysql.concept_id)] = self.get_fingerprint(
+                    self.get_mysql_concept_fields(c_mysql))
+        self.mismatched_concepts = {}
+
+    def validate_concept(self, c_ocl):
+        """ Compares an OCL concept with the MySQL dictionary """
+        # Display progress
+        self.cnt_ocl_concepts += 1
+        cnt = self.cnt_ocl_concepts
+        if (cnt % 1000) == 1:
+            print 'Validating concepts %s to %s...' % (cnt, cnt - 1 + 1000)
+
+        # Do the comparison
+        missing_in_ocl = self.concept_comparison[self.MISSING_IN_OCL]
+        missing_in_mysql = self.concept_comparison[self.MISSING_IN_MYSQL]
+        if c_ocl['id'] in missing_in_ocl:
+            del missing_in_ocl[c_ocl['id']]
+            if c_ocl['id'] in self.mysql_fingerprints:
+                ocl_fields = self.get_concept_fields(c_ocl)
+                if self.get_fingerprint(ocl_fields) != self.mysql_fingerprints[c_ocl['id']]:
+                    self.mismatched_concepts[c_ocl['id']] = ocl_fields
+        else:
+            # A concept ID in MySQL that is not in missing_in_ocl is repeated in the export, and
+            # its first occurrence is counted too
+            if c_ocl['id'] not in missing_in_mysql and self.get_concept_id(c_ocl['id']) in self.dictionary:
+                missing_in_mysql[c_ocl['id']] = 1
+            missing_in_mysql[c_ocl['id']] = missing_in_mysql.get(c_ocl['id'], 0) + 1
+            if self.report.in_sample(len(self.missing_concept_samples)):
+                self.missing_concept_samples.append(c_ocl)
+            if self.verbosity >= 2: print 'Concept %s exists in OCL but is missing in Mysql: %s' % (c_ocl['id'], c_ocl)
+
+    def summarize_concepts(self):
+        """ Prints and reports the concept count comparison and discrepancies """
         # Perform count comparison
-        count_ocl = len(data['concepts'])
+        print '\nCONCEPT COUNT COMPARISON:'
+        count_ocl = self.cnt_ocl_concepts
+        count_mysql = self.cnt_mysql_concepts
+        self.report.add_count('concepts', ocl=count_ocl, mysql=count_mysql)
         if count_ocl == count_mysql:
             print 'Concept count comparison: OCL %s == MYSQL %s\n' % (count_ocl, count_mysql)
         else:
             print 'Concept count comparison: OCL %s != MYSQL %s\n' % (count_ocl, count_mysql)
 
-        # Perform an ID comparison
-        print '\nVALIDATING CONCEPTS:'
-        cnt = 0
-        for c_ocl in data['concepts']:
-            # Display progress bar
-            cnt += 1
-            if (cnt % 1000) == 1:
-                print 'Validating %s to %s of %s concepts...' % (cnt, cnt - 1 + 1000, count_ocl)
-
-            # Do the comparison
-            if c_ocl['id'] in id_comparison[self.MISSING_IN_OCL]:
-                del id_comparison[self.MISSING_IN_OCL][c_ocl['id']]
-            else:
-                id_comparison[self.MISSING_IN_MYSQL][c_ocl['id']] = 0
-                if self.verbosity >= 2: print 'Concept %s exists in OCL but is missing in Mysql: %s' % (c_ocl['id'], c_ocl)
-
         # Output summary of results
+        id_comparison = self.concept_comparison
         print '\n\nCONCEPT VALIDATION SUMMARY:'
         print '\n%s concept IDs missing in OCL:\n' % len(id_comparison[self.MISSING_IN_OCL])
-        print id_comparison[self.MISSING_IN_OCL]
+        self.report.add_all('concepts_missing_in_ocl', sorted(id_comparison[self.MISSING_IN_OCL], key=int))
+        self.report.print_sample('concepts_missing_in_ocl')
         print '\n%s concept IDs missing in MySQL:\n' % len(id_comparison[self.MISSING_IN_MYSQL])
-        print id_comparison[self.MISSING_IN_MYSQL]
+        self.report.add_all('concepts_missing_in_mysql', sorted(id_comparison[self.MISSING_IN_MYSQL]))
+        self.report.print_sample('concepts_missing_in_mysql')
 
         # For IDs missing in MySQL, check if they are duplicated in the export
-        missing_ids = id_comparison[self.MISSING_IN_MYSQL].copy()
+        missing_ids = id_comparison[self.MISSING_IN_MYSQL]
         if missing_ids:
-            for c_ocl in data['concepts']:
-                if c_ocl['id'] in missing_ids:
-                    missing_ids[c_ocl['id']] += 1
-                    print c_ocl
+            for c_ocl in self.missing_concept_samples:
+                print c_ocl
             print '\nChecking for duplicate IDs in export:\n'
-            num_duplicates = 0
-            for c_id in missing_ids:
-                if missing_ids[c_id]:
-                    print '%s: %s duplicates found in export file\n' % (c_id, missing_ids[c_id])
-                    num_duplicates += 1
-            if not num_duplicates:
+            self.report.add_all('duplicate_concept_ids', [
+                {'id': c_id, 'count': missing_ids[c_id]}
+                for c_id in sorted(missing_ids) if missing_ids[c_id] > 1])
+            if self.report.get_count('duplicate_concept_ids'):
+                for duplicate in self.report.get_sample('duplicate_concept_ids'):
+                    print '%s: %s duplicates found in export file\n' % (duplicate['id'], duplicate['count'])
+                self.report.print_remainder('duplicate_concept_ids')
+            else:
                 print 'No duplicates found in export file\n'
 
         # Perform deep comparison
-        print '\nSkipping deep comparison of concepts...\n'
+        if self.skip_deep_comparison:
+            print '\nSkipping deep comparison of concepts...\n'
+            return
+        print '\n\nDEEP CONCEPT COMPARISON:'
+        print '\n%s of %s concepts in both OCL and MySQL have different fields:\n' % (
+            len(self.mismatched_concepts),
+            len(self.mysql_fingerprints) - len(id_comparison[self.MISSING_IN_OCL]))
+        mismatched_ids = sorted(int(concept_id) for concept_id in self.mismatched_concepts)
+        for concept_id in mismatched_ids:
+            mysql_fields = self.get_mysql_concept_fields(self.dictionary.get(concept_id))
+            ocl_fields = self.mismatched_concepts[str(concept_id)]
+            differences = self.diff_concept_fields(ocl_fields, mysql_fields)
+            if self.report.in_sample(self.report.get_count('concept_field_differences')):
+                for field, ocl_value, mysql_value in differences:
+                    print 'Concept %s %s: OCL %s != MYSQL %s' % (concept_id, field, ocl_value, mysql_value)
+            self.report.add('concept_field_differences', {
+                'id': str(concept_id),
+                'fields': dict((field, {'ocl': ocl_value, 'mysql': mysql_value})
+                               for field, ocl_value, mysql_value in differences),
+            })
+        self.report.print_remainder('concept_field_differences')
+
+    @classmethod
+    def get_mysql_concept_fields(cls, concept):
+        """
+        Returns the deep comparison fields of a MySQL concept, a ConceptRecord, in the same form
+        as get_concept_fields(). The concept is converted the same way as extract_db exports it.
+        """
+        extras = {}
+        if concept.numeric is not None:
+            for key, value_type in cls.NUMERIC_EXTRAS:
+                extras[key] = getattr(concept.numeric, key)
+        return cls.get_concept_fields({
+            'concept_class': concept.concept_class,
+            'datatype': concept.datatype,
+            'retired': concept.retired,
+            'names': [{
+                'name': name.name,
+                'name_type': name.name_type if name.name_type else '',
+                'locale': 'id' if name.locale == 'in' else name.locale,
+                'locale_preferred': name.locale_preferred,
+            } for name in concept.names],
+            'descriptions': [{
+                'description': description.description,
+                'locale': description.locale,
+            } for description in concept.descriptions if description.description],
+            'extras': extras,
+        })
+
+    @classmethod
+    def get_concept_fields(cls, concept):
+        """
+        Returns the deep comparison fields of an OCL-formatted concept in a canonical form, so
+        that concepts with the same content have equal fields regardless of the order of their
+        names and descriptions or the types used for numeric extras.
+        """
+        extras = concept.get('extras') or {}
+        numeric = []
+        for key, value_type in cls.NUMERIC_EXTRAS:
+            value = extras.get(key)
+            if value is not None:
+                try:
+                    value = value_type(value)
+                except (TypeError, ValueError):
+                    pass
+                numeric.append((key, value))
+        return {
+            'concept_class': concept.get('concept_class'),
+            'datatype': concept.get('datatype'),
+            'retired': bool(concept.get('retired')),
+            'names': sorted(
+                (name.get('name'), name.get('locale'), name.get('name_type') or '',
+                 bool(name.get('locale_preferred')))
+                for name in concept.get('names') or []),
+            'descriptions': sorted(
+                (description.get('description'), description.get('locale'))
+                for description in concept.get('descriptions') or []),
+            'numeric': numeric,
+        }
 
-        return
+    @staticmethod
+    def get_fingerprint(fields):
+        """ Returns a digest of concept fields returned by get_concept_fields() """
+        return hashlib.sha1(json.dumps(fields, sort_keys=True)).digest()
 
-    def validate_mappings(self, data):
+    @classmethod
+    def diff_concept_fields(cls, ocl_fields, mysql_fields):
+        """
+        Returns a list of (field, OCL value, MySQL value) for each field that differs. For names,
+        descriptions and numeric extras only the entries missing on the other side are returned.
         """
-        OpenMRS has 3 different objects that get stored as mappings in OCL: Reference Maps,
-        Q-and-A, and Concept Sets. This script iterates through each of these sets of objects
-        and compares against the records in OCL.
+        differences = []
+        for field in cls.CONCEPT_COMPARISON_FIELDS:
+            ocl_value = ocl_fields[field]
+            mysql_value = mysql_fields[field]
+            if ocl_value == mysql_value:
+                continue
+            if isinstance(ocl_value, list):
+                ocl_value, mysql_value = (
+                    [entry for entry in ocl_value if entry not in mysql_value],
+                    [entry for entry in mysql_value if entry not in ocl_value])
+            differences.append((field, ocl_value, mysql_value))
+        return differences
+
+    def validate_mapping(self, m_ocl):
+        """
+        Counts an OCL mapping and matches it against the MySQL mappings. OpenMRS has 3 different
+        objects that get stored as mappings in OCL: Reference Maps, Q-and-A, and Concept Sets.
         """
+        # Count the mapping -- retired mappings are skipped entirely if the flag is set
+        map_type = str(m_ocl['map_type'])
+        retired = m_ocl['retired']
+        if retired:
+            self.cnt_ocl_retired_maps += 1
+            if self.ignore_retired_mappings:
+                return
+        if map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
+            self.cnt_ocl_qanda += 1
+        elif map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
+            self.cnt_ocl_conceptset += 1
+        elif m_ocl['to_source_name'] == 'CIEL':
+            # Reference maps to CIEL are left out of the reference map count, as in MySQL
+            self.cnt_ocl_ciel_maps += 1
+        else:
+            self.cnt_ocl_mapref += 1
 
-        # Count objects in OCL
-        print '\nMAPPING COUNT COMPARISON:'
-        cnt_ocl_mapref = cnt_ocl_qanda = cnt_ocl_conceptset = cnt_ocl_retired_maps = 0
-        for m_ocl in data['mappings']:
-            map_type = str(m_ocl['map_type'])
-            retired = m_ocl['retired']
-            if retired:
-                cnt_ocl_retired_maps += 1
-            if (retired and not self.ignore_retired_mappings) or not retired:
-                if map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
-                    cnt_ocl_qanda += 1
-                elif map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
-                    cnt_ocl_conceptset += 1
-                else:
-                    cnt_ocl_mapref += 1
-        cnt_ocl_total = cnt_ocl_mapref + cnt_ocl_qanda + cnt_ocl_conceptset
-        cnt_ocl_total_with_retired = (cnt_ocl_total + cnt_ocl_retired_maps) if self.ignore_retired_mappings else cnt_ocl_total
+        # Display progress info
+        cnt = self.cnt_ocl_mapref + self.cnt_ocl_qanda + self.cnt_ocl_conceptset + self.cnt_ocl_ciel_maps
+        if (cnt % 1000) == 1: print 'Validating mappings %s to %s...' % (cnt, cnt - 1 + 1000)
 
-        # Count objects in MySQL
-        cnt_mysql_mapref = ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL').count()
-        cnt_mysql_qanda = ConceptAnswer.objects.count()
-        cnt_mysql_conceptset = ConceptSet.objects.count()
+        # Determine the type of comparison to perform, compare, and handle results
+        if map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
+            mysql_matching_qanda_id = self.validate_qanda(m_ocl)
+            if mysql_matching_qanda_id:
+                self.qanda_comparison[self.MISSING_IN_OCL].discard(mysql_matching_qanda_id)
+            else:
+                self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
+        elif map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
+            mysql_matching_conceptset_id = self.validate_concept_set(m_ocl)
+            if mysql_matching_conceptset_id:
+                self.conceptset_comparison[self.MISSING_IN_OCL].discard(mysql_matching_conceptset_id)
+            else:
+                self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
+        else:
+            mysql_matching_refmap_id = self.validate_reference_map(m_ocl)
+            if mysql_matching_refmap_id:
+                self.refmap_comparison[self.MISSING_IN_OCL].discard(mysql_matching_refmap_id)
+            else:
+                self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
+
+    def summarize_mappings(self):
+        """ Prints and reports the mapping count comparisons and discrepancies """
+        cnt_ocl_mapref = self.cnt_ocl_mapref
+        cnt_ocl_qanda = self.cnt_ocl_qanda
+        cnt_ocl_conceptset = self.cnt_ocl_conceptset
+        cnt_ocl_retired_maps = self.cnt_ocl_retired_maps
+        cnt_ocl_ciel_maps = self.cnt_ocl_ciel_maps
+        cnt_ocl_total = cnt_ocl_mapref + cnt_ocl_qanda + cnt_ocl_conceptset
+        cnt_ocl_total_with_retired = cnt_ocl_total + cnt_ocl_ciel_maps
+        if self.ignore_retired_mappings:
+            cnt_ocl_total_with_retired += cnt_ocl_retired_maps
+        cnt_mysql_mapref = self.cnt_mysql_mapref
+        cnt_mysql_qanda = self.cnt_mysql_qanda
+        cnt_mysql_conceptset = self.cnt_mysql_conceptset
         cnt_mysql_total = cnt_mysql_mapref + cnt_mysql_qanda + cnt_mysql_conceptset
+        self.report.add_count('mappings', ocl=cnt_ocl_total, mysql=cnt_mysql_total)
+        self.report.add_count('reference_maps', ocl=cnt_ocl_mapref, mysql=cnt_mysql_mapref)
+        self.report.add_count('qanda', ocl=cnt_ocl_qanda, mysql=cnt_mysql_qanda)
+        self.report.add_count('concept_sets', ocl=cnt_ocl_conceptset, mysql=cnt_mysql_conceptset)
+        self.report.add_count('retired_mappings', ocl=cnt_ocl_retired_maps)
+        self.report.add_count('ciel_reference_maps', ocl=cnt_ocl_ciel_maps)
 
         # Count comparison
+        print '\nMAPPING COUNT COMPARISON:'
         print '%s total mappings in OCL Export file, including %s retired mappings.' % (cnt_ocl_total_with_retired, cnt_ocl_retired_maps)
         if self.ignore_retired_mappings:
             print '%s active mappings used in the comparison ("ignore_retired_mappings" flag set)' % cnt_ocl_total
         else:
             print 'Both active and inactive mappings used in the comparison (set "ignore_retired_mappings" flag to exclude retired mappings)'
+        print '%s reference maps to CIEL are matched but not counted in the comparison' % cnt_ocl_ciel_maps
         if cnt_ocl_total == cnt_mysql_total:
             print 'Count comparison of all mappings: OCL %s == MYSQL %s' % (cnt_ocl_total, cnt_mysql_total)
         else:
@@ -187,119 +471,416 @@ class Command(BaseCommand):
         else:
             print 'Count comparison of Concept Sets: OCL %s != MYSQL %s' % (cnt_ocl_conceptset, cnt_mysql_conceptset)
 
-        # Create an array of key comparison data from mappings in Mysql
-        self.qanda_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-        self.conceptset_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-        self.refmap_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-
-        # Populate "missing_in_ocl" arrays with everything from omrs
-        for refmap_mysql in ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL'):
-            self.refmap_comparison[self.MISSING_IN_OCL].append(refmap_mysql.concept_map_id)
-        for qanda_mysql in ConceptAnswer.objects.raw('SELECT concept_answer_id FROM concept_answer'):
-            self.qanda_comparison[self.MISSING_IN_OCL].append(qanda_mysql.concept_answer_id)
-        for conceptset_mysql in ConceptSet.objects.raw('select concept_set_id from concept_set'):
-            self.conceptset_comparison[self.MISSING_IN_OCL].append(conceptset_mysql.concept_set_id)
-
-        # Iterate through OCL data and directly compare
-        print '\nVALIDATING MAPPINGS:'
-        cnt = 0
-        for m_ocl in data['mappings']:
-
-            # Skip retired mappings entirely if flag is set
-            if self.ignore_retired_mappings and m_ocl['retired']:
-                continue
-
-            # Display progress info
-            cnt += 1
-            if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
-
-            # Determine the type of comparison to perform, compare, and handle results
-            ocl_map_type = str(m_ocl['map_type'])
-            if ocl_map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_qanda_id = self.validate_qanda(m_ocl)
-                if mysql_matching_qanda_id:
-                    self.qanda_comparison[self.MISSING_IN_OCL].remove(mysql_matching_qanda_id)
-                else:
-                    self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
-            elif ocl_map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_conceptset_id = self.validate_concept_set(m_ocl)
-                if mysql_matching_conceptset_id:
-                    self.conceptset_comparison[self.MISSING_IN_OCL].remove(mysql_matching_conceptset_id)
-                else:
-                    self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
-            else:
-                mysql_matching_refmap_id = self.validate_reference_map(m_ocl)
-                if mysql_matching_refmap_id:
-                    self.refmap_comparison[self.MISSING_IN_OCL].remove(mysql_matching_refmap_id)
-                else:
-                    self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
-
         # Display results of comparison
         print '\n\nMAPPING VALIDATION SUMMARY:'
         print '%s Q/A mapping(s) missing in OCL Export:\n' % len(self.qanda_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_OCL]
+        self.report.add_all('qanda_missing_in_ocl', sorted(self.qanda_comparison[self.MISSING_IN_OCL]))
+        if self.verbosity >= 1: self.report.print_sample('qanda_missing_in_ocl')
         print '\n%s Q/A mapping(s) missing in MySQL:\n' % len(self.qanda_comparison[self.MISSING_IN_MYSQL])
-        if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_MYSQL]
+        self.report.add_all('qanda_missing_in_mysql', self.qanda_comparison[self.MISSING_IN_MYSQL])
+        if self.verbosity >= 1: self.report.print_sample('qanda_missing_in_mysql')
         print '\n%s Concept Set(s) mappings missing in OCL Export:\n' % len(self.conceptset_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_OCL]
+        self.report.add_all('concept_set_missing_in_ocl', sorted(self.conceptset_comparison[self.MISSING_IN_OCL]))
+        if self.verbosity >= 1: self.report.print_sample('concept_set_missing_in_ocl')
         print '\n%s Concept Set(s) mappings missing in MySQL:\n' % len(self.conceptset_comparison[self.MISSING_IN_MYSQL])
-        if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_MYSQL]
+        self.report.add_all('concept_set_missing_in_mysql', self.conceptset_comparison[self.MISSING_IN_MYSQL])
+        if self.verbosity >= 1: self.report.print_sample('concept_set_missing_in_mysql')
         print '\n%s Reference Map(s) missing in OCL Export:\n' % len(self.refmap_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_OCL]
+        self.report.add_all('reference_map_missing_in_ocl', sorted(self.refmap_comparison[self.MISSING_IN_OCL]))
+        if self.verbosity >= 1: self.report.print_sample('reference_map_missing_in_ocl')
         print '\n%s Reference Map(s) missing in MySQL:\n' % len(self.refmap_comparison[self.MISSING_IN_MYSQL])
-        if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_MYSQL]
+        self.report.add_all('reference_map_missing_in_mysql', self.refmap_comparison[self.MISSING_IN_MYSQL])
+        if self.verbosity >= 1: self.report.print_sample('reference_map_missing_in_mysql')
+
+    def index_mysql_mappings(self):
+        """
+        Indexes the keys of all reference maps, Q-AND-A and concept sets in the MySQL dictionary.
+        OCL mappings are then matched by key with dictionary lookups instead of a query per
+        mapping. The "missing in OCL" sets start with every MySQL ID and matches are
+        discarded from them; reference maps to CIEL are matched but not compared, and answers that
+        are drugs are skipped as extract_db does not export them.
+        """
+        self.refmap_index = {}
+        self.qanda_index = {}
+        self.conceptset_index = {}
+        self.refmap_comparison = {
+            self.MISSING_IN_OCL:set(),
+            self.MISSING_IN_MYSQL:[],
+        }
+        self.qanda_comparison = {
+            self.MISSING_IN_OCL:set(),
+            self.MISSING_IN_MYSQL:[],
+        }
+        self.conceptset_comparison = {
+            self.MISSING_IN_OCL:set(),
+            self.MISSING_IN_MYSQL:[],
+        }
+        for concept in self.dictionary:
+            for ref_map in concept.reference_maps:
+                key = (concept.concept_id, ref_map.map_type, ref_map.source, ref_map.code)
+                self.refmap_index.setdefault(key, []).append(ref_map.concept_map_id)
+                if ref_map.source != 'CIEL':
+                    self.refmap_comparison[self.MISSING_IN_OCL].add(ref_map.concept_map_id)
+            for concept_answer_id, answer_concept_id, sort_weight, uuid in concept.answers:
+                if answer_concept_id is None:
+                    # Drug answers are not exported by extract_db
+                    continue
+                key = (concept.concept_id, answer_concept_id)
+                self.qanda_index.setdefault(key, []).append(concept_answer_id)
+                self.qanda_comparison[self.MISSING_IN_OCL].add(concept_answer_id)
+            for concept_set_id, set_member_id, sort_weight, uuid in concept.set_members:
+                key = (concept.concept_id, set_member_id)
+                self.conceptset_index.setdefault(key, []).append(concept_set_id)
+                self.conceptset_comparison[self.MISSING_IN_OCL].add(concept_set_id)
+
+        # Count the MySQL mappings, and prepare to count the OCL mappings as they are validated
+        self.cnt_mysql_mapref = len(self.refmap_comparison[self.MISSING_IN_OCL])
+        self.cnt_mysql_qanda = len(self.qanda_comparison[self.MISSING_IN_OCL])
+        self.cnt_mysql_conceptset = len(self.conceptset_comparison[self.MISSING_IN_OCL])
+        self.cnt_ocl_mapref = self.cnt_ocl_qanda = self.cnt_ocl_conceptset = 0
+        self.cnt_ocl_retired_maps = self.cnt_ocl_ciel_maps = 0
+
+    @staticmethod
+    def get_concept_id(concept_code):
+        """ Returns an OCL concept code as an OpenMRS concept ID, or None if it is not numeric """
+        try:
+            return int(concept_code)
+        except (TypeError, ValueError):
+            return None
 
     def validate_reference_map(self, m_ocl):
-        map_type = m_ocl['map_type']
-        from_concept_id = m_ocl['from_concept_code']
-        to_concept_code = m_ocl['to_concept_code']
         to_source_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name'])
-        try:
-            m_omrs = ConceptReferenceMap.objects.get(map_type__name=map_type,
-                                                     concept_reference_term__code=to_concept_code,
-                                                     concept_id=from_concept_id,
-                                                     concept_reference_term__concept_source__name=to_source_name)
-            return m_omrs.concept_map_id
-        except ConceptReferenceMap.DoesNotExist:
+        key = (self.get_concept_id(m_ocl['from_concept_code']), m_ocl['map_type'],
+               to_source_name, m_ocl['to_concept_code'])
+        mysql_ids = self.refmap_index.get(key)
+        if not mysql_ids:
             return False
-        except ConceptReferenceMap.MultipleObjectsReturned:
+        if len(mysql_ids) > 1:
             print 'Multiple objects returned from MySQL for reference mapping: %s\n' % m_ocl
             return False
+        return mysql_ids[0]
 
     def validate_qanda(self, m_ocl):
-        question_concept_id = m_ocl['from_concept_code']
-        answer_concept_id = m_ocl['to_concept_code']
-        try:
-            qa_omrs = ConceptAnswer.objects.get(question_concept_id=question_concept_id,
-                                                answer_concept_id=answer_concept_id)
-            return qa_omrs.concept_answer_id
-        except ConceptAnswer.DoesNotExist:
+        key = (self.get_concept_id(m_ocl['from_concept_code']),
+               self.get_concept_id(m_ocl['to_concept_code']))
+        mysql_ids = self.qanda_index.get(key)
+        if not mysql_ids:
             return False
-        except ConceptAnswer.MultipleObjectsReturned:
+        if len(mysql_ids) > 1:
             print 'Multiple objects returned for qanda: %s\n' % m_ocl
             return False
+        return mysql_ids[0]
 
     def validate_concept_set(self, m_ocl):
-        set_owner_id = m_ocl['from_concept_code']
-        set_member_id = m_ocl['to_concept_code']
-        try:
-            cs_omrs = ConceptSet.objects.get(concept_set_owner_id=set_owner_id,
-                                             concept_id=set_member_id)
-            return cs_omrs.concept_set_id
-        except ConceptSet.DoesNotExist:
+        key = (self.get_concept_id(m_ocl['from_concept_code']),
+               self.get_concept_id(m_ocl['to_concept_code']))
+        mysql_ids = self.conceptset_index.get(key)
+        if not mysql_ids:
             return False
-        except ConceptSet.MultipleObjectsReturned:
+        if len(mysql_ids) > 1:
             print 'Multiple objects returned for concept set: %s\n' % m_ocl
             return False
+        return mysql_ids[0]
+
+
+class JsonStreamReader(object):
+    """
+    Incrementally decodes JSON from a file, reading only as much of the file as is needed to
+    decode the next value. Large arrays and objects can be walked one element at a time with
+    iter_array() and iter_object().
+    """
+
+    READ_SIZE = 64 * 1024
+
+    # Largest JSON value that is read into the buffer before a value that can't be decoded is
+    # reported as invalid, rather than reading the rest of the file to look for its end
+    MAX_VALUE_SIZE = 16 * 1024 * 1024
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Reads the next block of the file into the buffer; returns False at end of file """
+        data = self.input_file.read(self.READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Returns the next non-whitespace character without consuming it, or '' at end of file """
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        """ Consumes the next non-whitespace character, which must be char """
+        next_char = self.peek()
+        if next_char != char:
+            raise ValueError('Expected "%s" but found "%s" in JSON input' % (char, next_char))
+        self.pos += 1
+
+    def read_value(self):
+        """ Decodes and returns the next complete JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if len(self.buffer) - self.pos > self.MAX_VALUE_SIZE or not self.fill():
+                    raise
+                continue
+            # A value that ends with the buffer, such as a number, may continue in the file
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        """ Yields the elements of the JSON array at the current position one at a time """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            next_char = self.peek()
+            self.pos += 1
+            if next_char == ']':
+                return
+            if next_char != ',':
+                raise ValueError('Expected "," or "]" but found "%s" in JSON input' % next_char)
+
+    def iter_object(self):
+        """
+        Yields the keys of the JSON object at the current position one at a time. The value of
+        each key must be consumed, e.g. with read_value() or skip_value(), before the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            next_char = self.peek()
+            self.pos += 1
+            if next_char == '}':
+                return
+            if next_char != ',':
+                raise ValueError('Expected "," or "}" but found "%s" in JSON input' % next_char)
+
+    def skip_value(self):
+        """ Consumes the next JSON value without keeping large arrays or objects in memory """
+        next_char = self.peek()
+        if next_char == '[':
+            for value in self.iter_array():
+                pass
+        elif next_char == '{':
+            for key in self.iter_object():
+                self.skip_value()
+        else:
+            self.read_value()
+
+
+class OclExportFile(object):
+    """
+    Streams the concepts and mappings in an OCL export file in a single pass. Reads either an OCL source version
+    export, a JSON object with 'concepts' and 'mappings' lists, or a sequence of JSON resources
+    as generated by extract_db. Mappings generated by extract_db are given the fields of an OCL
+    export mapping (e.g. from_concept_code, to_source_name) based on their URLs.
+    """
+
+    FORMAT_OCL_EXPORT = 'OCL export'
+    FORMAT_JSON_LINES = 'JSON lines'
+
+    # Types of resources yielded by iter_resources()
+    CONCEPT = 'concept'
+    MAPPING = 'mapping'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.format = self.detect_format()
+
+    def detect_format(self):
+        """ An OCL export is a single object with a 'concepts' or 'mappings' list """
+        with open_input_file(self.filename) as input_file:
+            reader = JsonStreamReader(input_file)
+            if reader.peek() != '{':
+                return self.FORMAT_JSON_LINES
+            for key in reader.iter_object():
+                if key in ('concepts', 'mappings') and reader.peek() == '[':
+                    return self.FORMAT_OCL_EXPORT
+                reader.skip_value()
+        return self.FORMAT_JSON_LINES
+
+    def iter_resources(self):
+        """
+        Yields a tuple of (CONCEPT or MAPPING, resource) for each concept and mapping in the
+        export file, in the order they are stored, so the file is read and decoded only once
+        """
+        with open_input_file(self.filename) as input_file:
+            reader = JsonStreamReader(input_file)
+            if self.format == self.FORMAT_OCL_EXPORT:
+                for key in reader.iter_object():
+                    if key == 'concepts':
+                        for resource in reader.iter_array():
+                            yield self.CONCEPT, resource
+                    elif key == 'mappings':
+                        for resource in reader.iter_array():
+                            yield self.MAPPING, resource
+                    else:
+                        reader.skip_value()
+            else:
+                while reader.peek():
+                    resource = reader.read_value()
+                    if resource.get('type') == 'Mapping' or 'map_type' in resource:
+                        yield self.MAPPING, self.normalize_mapping(resource)
+                    elif resource.get('type') == 'Concept' or 'concept_class' in resource:
+                        yield self.CONCEPT, resource
+
+    @classmethod
+    def normalize_mapping(cls, mapping):
+        """ Adds OCL export fields to a mapping generated by extract_db, based on its URLs """
+        from_concept = cls.parse_ocl_url(mapping.get('from_concept_url'))
+        to_concept = cls.parse_ocl_url(mapping.get('to_concept_url') or mapping.get('to_source_url'))
+        mapping.setdefault('from_concept_code', from_concept.get('concepts'))
+        mapping.setdefault('to_concept_code', to_concept.get('concepts'))
+        mapping.setdefault('to_source_name', to_concept.get('sources'))
+        mapping.setdefault('id', mapping.get('external_id'))
+        mapping.setdefault('retired', False)
+        return mapping
+
+    @staticmethod
+    def parse_ocl_url(url):
+        """ Returns a dict of URL segments, e.g. '/orgs/CIEL/sources/CIEL/' to {'orgs': 'CIEL', ...} """
+        segments = [urllib.unquote_plus(segment) for segment in (url or '').strip('/').split('/')]
+        return dict(zip(segments[0::2], segments[1::2]))
+
+
+class ValidationReport(object):
+    """
+    Collects the counts and discrepancies found by validate_export. Only a sample of each type
+    of discrepancy is kept to display and include in the JSON report. If a report file is used,
+    each discrepancy is also appended to a JSON lines file for its type as it is found.
+
+    The report is "valid" if there are no discrepancies and the OCL and MySQL counts of every
+    type of resource match ("counts_match"); CI should check "valid".
+    """
+
+    # Types of discrepancies, in the order they are reported. Every type is included in the
+    # report, even if validate_export does not check it in a run, so the schema does not change.
+    CATEGORIES = [
+        'concepts_missing_in_ocl',
+        'concepts_missing_in_mysql',
+        'duplicate_concept_ids',
+        'concept_field_differences',
+        'qanda_missing_in_ocl',
+        'qanda_missing_in_mysql',
+        'concept_set_missing_in_ocl',
+        'concept_set_missing_in_mysql',
+        'reference_map_missing_in_ocl',
+        'reference_map_missing_in_mysql',
+    ]
+
+    def __init__(self, report_filename=None, max_samples=0):
+        self.report_filename = report_filename
+        self.max_samples = max_samples
+        self.counts = OrderedDict()
+        self.discrepancies = OrderedDict()
+        self.discrepancy_files = {}
+        for category in self.CATEGORIES:
+            self.get_discrepancies(category)
+
+    def add_count(self, name, **counts):
+        """ Records the OCL and MySQL counts of a type of resource """
+        self.counts[name] = counts
+
+    def get_discrepancies(self, category):
+        if category not in self.discrepancies:
+            self.discrepancies[category] = OrderedDict([('count', 0), ('sample', [])])
+            if self.report_filename:
+                filename = '%s.%s.jsonl' % (os.path.splitext(self.report_filename)[0], category)
+                self.discrepancies[category]['file'] = filename
+                self.discrepancy_files[category] = open(filename, 'w')
+        return self.discrepancies[category]
+
+    def add(self, category, item):
+        """ Records one discrepancy of the specified category """
+        discrepancies = self.get_discrepancies(category)
+        if self.in_sample(discrepancies['count']):
+            discrepancies['sample'].append(item)
+        discrepancies['count'] += 1
+        if category in self.discrepancy_files:
+            self.discrepancy_files[category].write(json.dumps(item) + '\n')
+
+    def add_all(self, category, items):
+        """ Records each of items as a discrepancy, and the category even if there are none """
+        self.get_discrepancies(category)
+        for item in items:
+            self.add(category, item)
+
+    def in_sample(self, index):
+        """ Returns True if the item at index is within the number of items to display """
+        return not self.max_samples or index < self.max_samples
+
+    def counts_match(self):
+        """ Returns True if the OCL and MySQL counts of every type of resource counted in both match """
+        return all(counts['ocl'] == counts['mysql'] for counts in self.counts.values()
+                   if 'ocl' in counts and 'mysql' in counts)
+
+    def is_valid(self):
+        """ Returns True if the counts match and there are no discrepancies """
+        return self.counts_match() and not any(
+            discrepancies['count'] for discrepancies in self.discrepancies.values())
+
+    def get_count(self, category):
+        return self.discrepancies[category]['count'] if category in self.discrepancies else 0
+
+    def get_sample(self, category):
+        return self.discrepancies[category]['sample'] if category in self.discrepancies else []
+
+    def print_sample(self, category):
+        """ Prints the sample of the category and the number of discrepancies not displayed """
+        print self.get_sample(category)
+        self.print_remainder(category)
+
+    def print_remainder(self, category):
+        remainder = self.get_count(category) - len(self.get_sample(category))
+        if remainder > 0:
+            if category in self.discrepancy_files:
+                print '... and %s more in "%s"' % (
+                    remainder, self.discrepancies[category]['file'])
+            else:
+                print '... and %s more (use --report to save the full list)' % remainder
+
+    def write(self, **attributes):
+        """
+        Closes the discrepancy files and writes the JSON report. The report is written one
+        section at a time rather than built as a single string.
+        """
+        for discrepancy_file in self.discrepancy_files.values():
+            discrepancy_file.close()
+        with open(self.report_filename, 'w') as report_file:
+            report_file.write('{\n')
+            for key, value in sorted(attributes.items()):
+                report_file.write('  %s: %s,\n' % (json.dumps(key), json.dumps(value)))
+            report_file.write('  "valid": %s,\n' % json.dumps(self.is_valid()))
+            report_file.write('  "counts_match": %s,\n' % json.dumps(self.counts_match()))
+            report_file.write('  "counts": %s,\n' % json.dumps(self.counts))
+            report_file.write('  "discrepancies": {')
+            for i, (category, discrepancies) in enumerate(self.discrepancies.items()):
+                report_file.write('%s\n    %s: %s' % (
+                    ',' if i else '', json.dumps(category), json.dumps(discrepancies)))
+            report_file.write('\n  }\n}\n')
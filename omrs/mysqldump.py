@@ -0,0 +1,275 @@
+"""
+Streaming reader for mysqldump files of an OpenMRS database.
+
+The dump is read one statement at a time, so it never has to fit into memory. It may be a plain
+.sql file, a gzip or zstd compressed file or a .zip archive containing the .sql file. Statements
+can be filtered by table. The rows of INSERT statements are parsed into Python values, and the
+concept dictionary tables can be loaded straight into a SQLite database without a MySQL server.
+"""
+import operator
+import os
+import re
+import zipfile
+from omrs.management.commands import open_input_file, get_input_compression, COMPRESSION_NONE
+from omrs.models import (
+    Concept, ConceptAnswer, ConceptClass, ConceptComplex, ConceptDatatype, ConceptDescription,
+    ConceptMapType, ConceptName, ConceptNumeric, ConceptReferenceMap, ConceptReferenceSource,
+    ConceptReferenceTerm, ConceptSet)
+
+
+# Concept dictionary tables read by extract_db and validate_export
+DICTIONARY_MODELS = [
+    ConceptDatatype, ConceptClass, ConceptMapType, ConceptReferenceSource, Concept,
+    ConceptReferenceTerm, ConceptName, ConceptDescription, ConceptNumeric, ConceptComplex,
+    ConceptReferenceMap, ConceptAnswer, ConceptSet,
+]
+
+# Statements that refer to a table, e.g. "INSERT INTO `concept` VALUES ..." or
+# "/*!40000 ALTER TABLE `concept` DISABLE KEYS */", with the table name
+TABLE_STATEMENT_RE = re.compile(
+    r'(?:/\*!\d*\s*)?(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|'
+    r'DROP\s+TABLE(?:\s+IF\s+EXISTS)?|LOCK\s+TABLES|ALTER\s+TABLE)\s+`?([\w$]+)`?', re.IGNORECASE)
+INSERT_RE = re.compile(
+    r'(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO)\s+`?[\w$]+`?\s*(?:\(([^)]*)\))?\s*VALUES\s*',
+    re.IGNORECASE)
+COLUMN_DEFINITION_RE = re.compile(r'\s*`([^`]+)`\s')
+DELIMITER_RE = re.compile(r'DELIMITER\s+(\S+)', re.IGNORECASE)
+
+# A value in the VALUES list of an INSERT statement, preceded by "(" if it is the first value of a
+# row and followed by ")" if it is the last one. Rows are separated by "," and the statement ends
+# with ";".
+VALUE_RE = re.compile(r"""[\s,;]*(\()?\s*(?:
+    '((?:[^'\\]|\\.|'')*)'                   # 2: string
+    |(NULL)                                  # 3: NULL
+    |(-?[0-9]+)(?=\s*[,)])                   # 4: integer
+    |(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)         # 5: decimal or float
+    |0x([0-9A-Fa-f]*)                        # 6: hexadecimal
+    |_binary\s*'((?:[^'\\]|\\.|'')*)'        # 7: binary string
+    )\s*(?:,|(\)))""", re.VERBOSE | re.DOTALL)
+STRING_ESCAPE_RE = re.compile(r"\\(.)|''", re.DOTALL)
+STRING_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+
+def open_dump(filename):
+    """
+    Returns a file object for reading a mysqldump file. A .zip archive is read from its first
+    .sql member (or its only member), skipping __MACOSX metadata, without extracting it to disk.
+    gzip and zstd files are decompressed on the fly.
+    """
+    if zipfile.is_zipfile(filename):
+        archive = zipfile.ZipFile(filename)
+        return archive.open(get_zip_dump_member(archive, filename))
+    return open_input_file(filename)
+
+
+def get_dump_size(filename):
+    """
+    Returns the uncompressed size in bytes of a mysqldump file opened with open_dump, or None if
+    it is not known without reading the whole file (gzip and zstd files)
+    """
+    if zipfile.is_zipfile(filename):
+        archive = zipfile.ZipFile(filename)
+        return archive.getinfo(get_zip_dump_member(archive, filename)).file_size
+    if get_input_compression(filename) != COMPRESSION_NONE:
+        return None
+    return os.path.getsize(filename)
+
+
+def get_zip_dump_member(archive, filename):
+    """ Returns the name of the mysqldump file in a .zip archive """
+    members = [member for member in archive.namelist()
+               if not member.startswith('__MACOSX') and not member.endswith('/')]
+    sql_members = [member for member in members if member.lower().endswith('.sql')]
+    if not sql_members and len(members) != 1:
+        raise Exception('No .sql file found in "%s"' % filename)
+    return (sql_members or members)[0]
+
+
+class MysqldumpReader(object):
+    """
+    Reads the statements of a mysqldump file one at a time. Comments are skipped, and the
+    session settings of the dump (e.g. "/*!40101 SET NAMES utf8 */") are returned as statements
+    without a table. The number of bytes of the (uncompressed) dump read so far is available as
+    bytes_read for progress reporting.
+    """
+
+    def __init__(self, dump_file):
+        self.dump_file = dump_file
+        self.bytes_read = 0
+
+    def iter_statements(self, include_table=None):
+        """
+        Generator that yields (table name or None, statement) for each statement in the dump,
+        without its terminating delimiter. If include_table is specified, statements that refer to
+        a table for which include_table(table) is false are skipped, and only their first line is
+        read into memory.
+        """
+        delimiter = ';'
+        lines = []
+        table = None
+        skip = False
+        for line in self.dump_file:
+            self.bytes_read += len(line)
+            if not lines:
+                stripped_line = line.strip()
+                if not stripped_line or stripped_line.startswith('--') or (
+                        stripped_line.startswith('/*') and not stripped_line.startswith('/*!')):
+                    continue
+                match = DELIMITER_RE.match(stripped_line)
+                if match:
+                    delimiter = match.group(1)
+                    continue
+                match = TABLE_STATEMENT_RE.match(stripped_line)
+                table = match.group(1) if match else None
+                skip = include_table is not None and table is not None and not include_table(table)
+            if not skip:
+                lines.append(line)
+            elif not lines:
+                lines.append('')
+            if line.rstrip().endswith(delimiter):
+                if not skip:
+                    yield table, ''.join(lines).rstrip()[:-len(delimiter)]
+                lines = []
+        if lines and not skip:
+            yield table, ''.join(lines)
+
+    @staticmethod
+    def get_create_table_columns(statement):
+        """ Returns the column names of a CREATE TABLE statement, in order """
+        columns = []
+        for line in statement.splitlines()[1:]:
+            match = COLUMN_DEFINITION_RE.match(line)
+            if match:
+                columns.append(match.group(1))
+        return columns
+
+    @staticmethod
+    def get_insert_columns(statement):
+        """ Returns the column names listed in an INSERT statement, or None if not listed """
+        match = INSERT_RE.match(statement.lstrip())
+        if not match:
+            raise Exception('Not an INSERT statement: %s' % statement[:100])
+        if match.group(1) is None:
+            return None
+        return [column.strip().strip('`') for column in match.group(1).split(',')]
+
+    @staticmethod
+    def iter_insert_rows(statement):
+        """
+        Generator that yields a tuple of the values of each row of an INSERT statement. Strings
+        are returned as unicode, numbers as int or float and NULL as None.
+        """
+        statement = statement.lstrip()
+        match = INSERT_RE.match(statement)
+        if not match:
+            raise Exception('Not an INSERT statement: %s' % statement[:100])
+        position = match.end()
+        row = None
+        for match in VALUE_RE.finditer(statement, position):
+            start, string, null, integer, number, hexadecimal, binary, end = match.groups()
+            if match.start() != position or (start is None) != (row is not None):
+                break
+            if start is not None:
+                row = []
+            if string is not None:
+                row.append(unescape_string(string).decode('utf-8'))
+            elif integer is not None:
+                row.append(int(integer))
+            elif null is not None:
+                row.append(None)
+            elif number is not None:
+                row.append(float(number))
+            elif hexadecimal is not None:
+                row.append(hexadecimal.decode('hex'))
+            else:
+                row.append(unescape_string(binary))
+            position = match.end()
+            if end is not None:
+                yield tuple(row)
+                row = None
+        if row is not None or statement[position:].strip() not in ('', ';'):
+            raise Exception('Unable to parse value at offset %s of INSERT statement: %s' % (
+                position, statement[position:position + 100]))
+
+
+def unescape_string(value):
+    """ Returns a string value from an INSERT statement with its escape sequences replaced """
+    if '\\' not in value and "''" not in value:
+        return value
+    return STRING_ESCAPE_RE.sub(
+        lambda match: STRING_ESCAPES.get(match.group(1), match.group(1)) if match.group(1) else "'",
+        value)
+
+
+def load_dictionary_tables(dump_file, connection, progress_callback=None):
+    """
+    Loads the concept dictionary tables (DICTIONARY_MODELS) of a mysqldump file into a SQLite
+    database through a Django database connection, without a MySQL server. The tables are
+    created from the Django models, so that Django reads them back the same way as from MySQL,
+    and only the columns defined by the models are loaded. progress_callback, if specified, is
+    called with the number of bytes read after each statement. Returns a dictionary of the number
+    of rows loaded into each table.
+    """
+    models = dict((model._meta.db_table, model) for model in DICTIONARY_MODELS)
+    reader = MysqldumpReader(dump_file)
+    dump_columns = {}
+    row_counts = dict((table, 0) for table in models)
+    cursor = connection.cursor()
+    for model in DICTIONARY_MODELS:
+        create_dictionary_table(model, connection, cursor)
+    for table, statement in reader.iter_statements(include_table=models.__contains__):
+        if table is None:
+            continue
+        stripped_statement = statement.lstrip()
+        if stripped_statement[:6].upper() == 'CREATE':
+            dump_columns[table] = MysqldumpReader.get_create_table_columns(stripped_statement)
+        elif stripped_statement[:6].upper() in ('INSERT', 'REPLAC'):
+            model_columns = [field.column for field in models[table]._meta.local_fields]
+            columns = MysqldumpReader.get_insert_columns(stripped_statement) or dump_columns.get(table)
+            if columns is None:
+                # Data-only dumps have no CREATE TABLE statements -- assume the model's column order
+                columns = model_columns
+            loaded_columns = [column for column in model_columns if column in columns]
+            get_values = operator.itemgetter(*[columns.index(column) for column in loaded_columns])
+            if len(loaded_columns) == 1:
+                rows = ((get_values(row),) for row in MysqldumpReader.iter_insert_rows(stripped_statement))
+            else:
+                rows = (get_values(row) for row in MysqldumpReader.iter_insert_rows(stripped_statement))
+            rows = list(rows)
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                connection.ops.quote_name(table),
+                ', '.join(connection.ops.quote_name(column) for column in loaded_columns),
+                ', '.join(['%s'] * len(loaded_columns))), rows)
+            row_counts[table] += len(rows)
+        if progress_callback:
+            progress_callback(reader.bytes_read)
+    for model in DICTIONARY_MODELS:
+        create_dictionary_indexes(model, connection, cursor)
+    return row_counts
+
+
+def create_dictionary_table(model, connection, cursor):
+    """
+    Creates the table of a concept dictionary model with the column types Django expects. Unlike
+    the tables Django would create, columns are nullable, so that dumps of other OpenMRS versions
+    with fewer columns can still be loaded.
+    """
+    quote_name = connection.ops.quote_name
+    column_definitions = []
+    for field in model._meta.local_fields:
+        column_definitions.append('%s %s%s' % (
+            quote_name(field.column), field.db_type(connection),
+            ' PRIMARY KEY' if field.primary_key else ''))
+    cursor.execute('DROP TABLE IF EXISTS %s' % quote_name(model._meta.db_table))
+    cursor.execute('CREATE TABLE %s (%s)' % (
+        quote_name(model._meta.db_table), ', '.join(column_definitions)))
+
+
+def create_dictionary_indexes(model, connection, cursor):
+    """ Indexes the foreign key columns of a concept dictionary table once it is loaded """
+    quote_name = connection.ops.quote_name
+    for field in model._meta.local_fields:
+        if field.rel and not field.primary_key:
+            cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                quote_name('%s_%s' % (model._meta.db_table, field.column)),
+                quote_name(model._meta.db_table), quote_name(field.column)))
@@ -0,0 +1,262 @@
+"""
+Helpers for measuring the management commands: SQL query counts and times, and peak memory use.
+"""
+from collections import OrderedDict
+import cProfile
+import resource
+import sys
+import time
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+class QueryCounter(object):
+    """
+    Counts the SQL queries executed on a database connection and their total time, by wrapping
+    every cursor the connection creates while the counter is running. Usable as a context manager:
+
+        with QueryCounter() as query_counter:
+            ...
+        print query_counter.count, query_counter.seconds
+
+    Queries run in other processes (e.g. extract_db --workers) are not counted.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.count = 0
+        self.seconds = 0.0
+        self.previous_cursor = None
+
+    def start(self):
+        """
+        Starts counting queries. Counters may be nested: the cursor method of a counter that is
+        already running is wrapped, so that its queries are counted by both counters.
+        """
+        self.previous_cursor = self.connection.__dict__.get('cursor')
+        original_cursor = self.connection.cursor
+
+        def cursor():
+            return CountingCursorWrapper(original_cursor(), self)
+
+        self.connection.cursor = cursor
+
+    def stop(self):
+        """
+        Stops counting queries and restores the cursor method the connection had when the
+        counter was started: the connection's own, or that of an enclosing counter
+        """
+        if self.previous_cursor is not None:
+            self.connection.cursor = self.previous_cursor
+        elif 'cursor' in self.connection.__dict__:
+            del self.connection.cursor
+
+    def add_query(self, seconds, count=1):
+        """ Records count queries that took a total of seconds """
+        self.count += count
+        self.seconds += seconds
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class CountingCursorWrapper(object):
+    """ Database cursor wrapper that reports each query it executes to a QueryCounter """
+
+    def __init__(self, cursor, query_counter):
+        self.cursor = cursor
+        self.query_counter = query_counter
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.query_counter.add_query(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.query_counter.add_query(time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def get_peak_rss_bytes(children=False):
+    """
+    Returns the peak resident set size of this process, or of its largest terminated child
+    process if children is True, in bytes. ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+class CommandProfiler(object):
+    """
+    Records the wall time, number of SQL queries and query time of each phase of a management
+    command, the peak memory use and, optionally, a cProfile dump. Phases may be nested; time and
+    queries are charged to the innermost phase, and anything outside a phase to OTHER_PHASE.
+    A disabled profiler records nothing and its phases cost next to nothing, so commands can
+    always wrap their work in phases:
+
+        with self.profiler.phase('build concepts'):
+            ...
+        for resource in self.profiler.iter_phase('read export', resources):
+            ...
+    """
+
+    OTHER_PHASE = 'other'
+
+    def __init__(self, enabled=False, cprofile_filename=None):
+        self.enabled = enabled or bool(cprofile_filename)
+        self.cprofile_filename = cprofile_filename
+        self.query_counter = QueryCounter()
+        self.cprofile = None
+        self.running = False
+        self.phases = OrderedDict()
+        self.phase_stack = []
+        self.start_time = self.stop_time = None
+
+    def start(self):
+        """ Starts profiling, if enabled """
+        if not self.enabled:
+            return
+        self.running = True
+        self.start_time = self.phase_start_time = time.time()
+        self.phase_start_queries = (0, 0.0)
+        self.phase_stack = [self.OTHER_PHASE]
+        self.query_counter.start()
+        if self.cprofile_filename:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        """ Stops profiling and writes the cProfile dump, if requested """
+        if not self.running:
+            return
+        self.running = False
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_filename)
+        self.charge_phase(self.phase_stack[-1])
+        self.query_counter.stop()
+        self.stop_time = time.time()
+
+    def cancel(self):
+        """ Stops profiling without recording or writing anything, e.g. in a forked worker process """
+        if not self.running:
+            return
+        self.running = False
+        if self.cprofile:
+            self.cprofile.disable()
+        self.query_counter.stop()
+
+    def charge_phase(self, name, calls=0):
+        """ Charges the time and queries since the last phase change to the named phase """
+        now = time.time()
+        queries = (self.query_counter.count, self.query_counter.seconds)
+        phase = self.phases.setdefault(name, [0, 0.0, 0, 0.0])
+        phase[0] += calls
+        phase[1] += now - self.phase_start_time
+        phase[2] += queries[0] - self.phase_start_queries[0]
+        phase[3] += queries[1] - self.phase_start_queries[1]
+        self.phase_start_time = now
+        self.phase_start_queries = queries
+
+    def enter_phase(self, name):
+        self.charge_phase(self.phase_stack[-1])
+        self.phase_stack.append(name)
+
+    def exit_phase(self, calls=1):
+        self.charge_phase(self.phase_stack.pop(), calls=calls)
+
+    def phase(self, name):
+        """ Returns a context manager that charges the work done inside it to the named phase """
+        if not self.running:
+            return NULL_PHASE
+        return ProfilerPhase(self, name)
+
+    def iter_phase(self, name, iterable):
+        """ Returns an iterator over iterable that charges the work to get each item to the named phase """
+        if not self.running:
+            return iterable
+        return self._iter_phase(name, iterable)
+
+    def _iter_phase(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            self.enter_phase(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.exit_phase(calls=0)
+                return
+            except Exception:
+                self.exit_phase()
+                raise
+            self.exit_phase()
+            yield item
+
+    def print_summary(self, output_file=None):
+        """ Stops profiling, if still running, and outputs the profile of each phase """
+        if not self.enabled:
+            return
+        self.stop()
+        output_file = output_file or sys.stdout
+        output_file.write('------------------------------------------------------\n')
+        output_file.write('PROFILE\n')
+        output_file.write('------------------------------------------------------\n')
+        output_file.write('%-28s %9s %10s %9s %10s\n' % ('Phase', 'Calls', 'Seconds', 'Queries', 'Query sec'))
+        # Phases are listed in the order they were first entered, followed by the time outside them
+        for name, (calls, seconds, queries, query_seconds) in sorted(
+                self.phases.items(), key=lambda item: item[0] == self.OTHER_PHASE):
+            output_file.write('%-28s %9d %10.3f %9d %10.3f\n' % (
+                name[:28], calls, seconds, queries, query_seconds))
+        output_file.write('%-28s %9s %10.3f %9d %10.3f\n' % (
+            'Total', '', self.stop_time - self.start_time, self.query_counter.count,
+            self.query_counter.seconds))
+        output_file.write('Peak RSS: %.1f MB\n' % (get_peak_rss_bytes() / 1048576.0))
+        children_peak_rss = get_peak_rss_bytes(children=True)
+        if children_peak_rss:
+            output_file.write('Peak RSS of child processes: %.1f MB\n' % (children_peak_rss / 1048576.0))
+        if self.cprofile_filename:
+            output_file.write('cProfile stats written to "%s"\n' % self.cprofile_filename)
+        output_file.write('------------------------------------------------------\n')
+
+
+class ProfilerPhase(object):
+    """ Context manager that charges the work done inside it to a phase of a CommandProfiler """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter_phase(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.exit_phase()
+
+
+class NullPhase(object):
+    """ Context manager used for the phases of a disabled CommandProfiler """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_PHASE = NullPhase()
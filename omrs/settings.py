@@ -21,6 +21,16 @@ DATABASES = {
     }
 }
 
+# Set OMRS_SQLITE_DB to use a SQLite database file instead, e.g. a synthetic dictionary created
+# with the generate_dictionary command
+if os.environ.get('OMRS_SQLITE_DB'):
+    DATABASES = {
+        'default': {
+            'NAME': os.environ['OMRS_SQLITE_DB'],
+            'ENGINE': 'django.db.backends.sqlite3',
+        }
+    }
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
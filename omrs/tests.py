@@ -0,0 +1,230 @@
+"""
+Tests of the import command against a local stub of the OCL bulk import API, and of
+validate_export against a synthetic dictionary.
+
+Run with:
+    python manage.py test omrs
+"""
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+from django.core.management import CommandError, call_command, load_command_class
+from django.test import SimpleTestCase, TransactionTestCase
+from omrs.management.commands import OclOpenmrsHelper
+
+
+class StubBulkImportServer(BaseHTTPServer.HTTPServer):
+    """
+    Stub of the OCL bulk import API. A POST submits a new task. Each GET returns the next
+    (status code, JSON) of get_responses, repeating the last one when none are left.
+    """
+
+    API_ENV = 'stub'
+    TASK_ID = 'stub-task-1'
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubBulkImportHandler)
+        self.api_url_root = 'http://127.0.0.1:%s' % self.server_port
+        self.posts = []
+        self.gets = []
+        self.get_responses = []
+
+    def next_get_response(self):
+        if len(self.get_responses) > 1:
+            return self.get_responses.pop(0)
+        return self.get_responses[0]
+
+
+class StubBulkImportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Records the requests made to a StubBulkImportServer and answers them """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posts.append((time.time(), self.path, self.headers.get('Authorization')))
+        self.send_json(200, {'task': self.server.TASK_ID})
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        self.server.gets.append((time.time(), query.get('task', [None])[0]))
+        self.send_json(*self.server.next_get_response())
+
+    def send_json(self, status_code, response_json):
+        body = json.dumps(response_json)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImportCommandTest(SimpleTestCase):
+    """ Submits, polls, interrupts and reattaches to bulk imports with the import command """
+
+    CONCEPT = {
+        'type': 'Concept', 'id': '1', 'owner': 'CIEL', 'owner_type': 'Organization', 'source': 'CIEL',
+        'concept_class': 'Misc', 'datatype': 'N/A', 'retired': False,
+        'names': [{'name': 'Test', 'locale': 'en', 'locale_preferred': True,
+                   'name_type': 'FULLY_SPECIFIED'}],
+    }
+    PENDING = (200, {'state': 'PENDING'})
+    STARTED = (200, {'state': 'STARTED', 'summary': 'Processed 1/2'})
+    UNAVAILABLE = (503, {'detail': 'Service unavailable'})
+    RESULTS = (200, {'count': 1, 'total_lines': 1, 'results': {
+        '/orgs/CIEL/sources/CIEL/': {'NEW': {'201': [{'message': 'Created', 'text': ''}]}}}})
+
+    # Short polling delays so that the tests run quickly
+    POLL_INITIAL_DELAY_SECONDS = 0.05
+    POLL_MAX_DELAY_SECONDS = 0.1
+
+    def setUp(self):
+        self.server = StubBulkImportServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        OclOpenmrsHelper.OCL_API_URL[self.server.API_ENV] = self.server.api_url_root
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'import.json')
+        with open(self.filename, 'wb') as import_file:
+            import_file.write(json.dumps(self.CONCEPT) + '\n')
+        self.results_filename = self.filename + '.results.json'
+        self.state_filename = self.filename + '.import-state.json'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        del OclOpenmrsHelper.OCL_API_URL[self.server.API_ENV]
+        shutil.rmtree(self.temp_dir)
+
+    def run_import(self, **options):
+        """ Runs the import command against the stub server with the given options """
+        command = load_command_class('omrs', 'import')
+        command.POLL_INITIAL_DELAY_SECONDS = self.POLL_INITIAL_DELAY_SECONDS
+        command.POLL_MAX_DELAY_SECONDS = self.POLL_MAX_DELAY_SECONDS
+        defaults = dict((option.dest, option.default) for option in command.option_list)
+        defaults.update({
+            'verbosity': 0,
+            'ocl_import_filename': self.filename,
+            'ocl_api_env': self.server.API_ENV,
+            'ocl_api_token': 'stub-token',
+            'workers': 1,
+        })
+        defaults.update(options)
+        return command.execute(**defaults)
+
+    def load_task(self):
+        with open(self.state_filename, 'rb') as state_file:
+            return json.load(state_file)['tasks'][os.path.abspath(self.filename)]
+
+    def test_submit_and_wait(self):
+        self.server.get_responses = [self.PENDING, self.UNAVAILABLE, self.STARTED, self.RESULTS]
+        self.run_import(wait=True)
+
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(self.server.posts[0][1], '/manage/bulkimport/')
+        self.assertEqual(self.server.posts[0][2], 'Token stub-token')
+        self.assertEqual([task_id for _, task_id in self.server.gets], [self.server.TASK_ID] * 4)
+
+        # The failed request is retried and the delay doubles up to the maximum
+        poll_times = [poll_time for poll_time, _ in self.server.gets]
+        delays = [later - earlier for earlier, later in zip(poll_times, poll_times[1:])]
+        for delay, minimum_delay in zip(delays, [0.05, 0.1, 0.1]):
+            self.assertGreaterEqual(delay, minimum_delay)
+
+        with open(self.results_filename, 'rb') as results_file:
+            self.assertEqual(json.load(results_file)['count'], 1)
+        task = self.load_task()
+        self.assertEqual(task['task_id'], self.server.TASK_ID)
+        self.assertEqual(task['state'], 'SUCCESS')
+        self.assertEqual(task['results_file'], self.results_filename)
+        self.assertTrue(task['finished'])
+
+    def test_submit_without_wait(self):
+        self.server.get_responses = [self.RESULTS]
+        self.run_import()
+
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(self.server.gets, [])
+        self.assertFalse(os.path.exists(self.results_filename))
+        self.assertEqual(self.load_task()['state'], 'PENDING')
+
+    def test_interrupt_and_reattach(self):
+        # The wait is interrupted while the task is still running
+        self.server.get_responses = [self.STARTED]
+        with self.assertRaises(CommandError):
+            self.run_import(wait=True, max_wait=1)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertFalse(os.path.exists(self.results_filename))
+        task = self.load_task()
+        self.assertEqual(task['state'], 'STARTED')
+        self.assertNotIn('finished', task)
+
+        # Running the command again reattaches to the task instead of submitting the file again
+        self.server.get_responses = [self.RESULTS]
+        self.run_import(wait=True)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(self.server.gets[-1][1], self.server.TASK_ID)
+        self.assertTrue(os.path.exists(self.results_filename))
+        self.assertTrue(self.load_task()['finished'])
+
+        # A finished task is skipped until the file changes
+        num_gets = len(self.server.gets)
+        self.run_import(wait=True)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(len(self.server.gets), num_gets)
+        with open(self.filename, 'ab') as import_file:
+            import_file.write('\n')
+        self.run_import(wait=True)
+        self.assertEqual(len(self.server.posts), 2)
+
+    def test_resubmit(self):
+        self.server.get_responses = [self.RESULTS]
+        self.run_import()
+        self.run_import(resubmit=True)
+        self.assertEqual(len(self.server.posts), 2)
+
+    def test_client_error(self):
+        self.server.get_responses = [(404, {'detail': 'Not found'})]
+        with self.assertRaises(CommandError):
+            self.run_import(wait=True)
+        self.assertEqual(len(self.server.gets), 1)
+        self.assertFalse(self.load_task().get('finished'))
+
+
+class ValidateExportTest(TransactionTestCase):
+    """ Validates the export of a synthetic dictionary against the same dictionary """
+
+    def setUp(self):
+        call_command('generate_dictionary', create_tables=True, num_concepts=200, verbosity=0)
+        self.temp_dir = tempfile.mkdtemp()
+        self.export_filename = os.path.join(self.temp_dir, 'export.json')
+        self.report_filename = os.path.join(self.temp_dir, 'report.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_clean_export_is_valid(self):
+        call_command('extract_db', concept=True, mapping=True, org_id='CIEL', source_id='CIEL',
+                     output_filename=self.export_filename, verbosity=0)
+        call_command('validate_export', ocl_export_filename=self.export_filename,
+                     report_filename=self.report_filename, verbosity=0)
+        with open(self.report_filename, 'rb') as report_file:
+            report = json.load(report_file)
+
+        for counts in report['counts'].values():
+            if 'mysql' in counts:
+                self.assertEqual(counts['ocl'], counts['mysql'])
+        for discrepancies in report['discrepancies'].values():
+            self.assertEqual(discrepancies['count'], 0)
+        self.assertTrue(report['counts_match'])
+        self.assertTrue(report['valid'])
+
+        # Reference maps to CIEL are left out of the comparison on both sides
+        self.assertTrue(report['counts']['ciel_reference_maps']['ocl'])
@@ -10,6 +10,7 @@
 #  OCL_ENV = demo, staging, or production (default 'staging')
 #  If FORCE_OLD_MODE=1 in environment, then output will be separate mapping & concepts
 #  If USE_GOLD_MAPPINGS=1 in environment, gold mappings will be required and used
+#  If FULL_SQL_IMPORT=1 in environment, all tables are loaded rather than only the concept tables
 # 
 # Loads the OpenMRS sql file into a database and then exports it to JSON
 
@@ -19,6 +20,7 @@ SOURCE_ID="${3:-CIEL}"
 OCL_ENV="${4:-staging}"
 FORCE_OLD_MODE="$FORCE_OLD_MODE"
 USE_GOLD_MAPPINGS="${USE_GOLD_MAPPINGS:-0}"
+FULL_SQL_IMPORT="$FULL_SQL_IMPORT"
 
 if [ -z "$SQL_FILE" ]
 then
@@ -53,6 +55,7 @@ export SOURCE_ID
 export OCL_ENV
 export FORCE_OLD_MODE
 export USE_GOLD_MAPPINGS
+export FULL_SQL_IMPORT
 docker compose up -d
 
 docker compose logs -f python &
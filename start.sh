@@ -1,11 +1,12 @@
 #!/bin/bash
 set -e
 
-if [ ${SQL_FILE: -4} == ".zip" ]
+# .zip and .gz dumps are decompressed on the fly by import_sql.py, without writing the dump to disk
+SQL_DUMP=$SQL_FILE
+
+# Strip .zip or .gz extension
+if [ ${SQL_FILE: -4} == ".zip" ] || [ ${SQL_FILE: -3} == ".gz" ]
 then
-  echo "Unzipping file..."
-  # Unzip into local subdirectory, ignoring __MACOSX folder
-  unzip -o $SQL_FILE -x __*/* -d local/
   SQL_FILE=${SQL_FILE%.*}
 fi
 
@@ -15,20 +16,25 @@ then
   SQL_FILE=${SQL_FILE%.*}
 fi
 
+# A dump given without a .sql, .zip or .gz extension is read from $SQL_FILE.sql
+if [ "$SQL_DUMP" == "$SQL_FILE" ]
+then
+  SQL_DUMP=$SQL_FILE.sql
+fi
+
 # Wait for database to be ready
 ./wait-for-it.sh db:3306 -t 30
 
 echo "Importing data..."
-python import_sql.py 
+python import_sql.py "$SQL_DUMP"
 
 echo "Checking sources..."
-python manage.py extract_db --check_sources --env=$OCL_ENV
+python manage.py extract_db --check_sources --env=$OCL_ENV --source_cache=local/check_sources_cache.json
 
 if [ "$FORCE_OLD_MODE" = 1 ]
 then
   echo "Exporting old style json files..."
-  python manage.py extract_db --org_id=${OCL_ORG} --source_id=${SOURCE_ID} -v0 --concepts --use_gold_mappings=${USE_GOLD_MAPPINGS:-0} > ${SQL_FILE:-openmrs}-concepts.json
-  python manage.py extract_db --org_id=${OCL_ORG} --source_id=${SOURCE_ID} -v0 --mappings --use_gold_mappings=${USE_GOLD_MAPPINGS:-0} > ${SQL_FILE:-openmrs}-mappings.json
+  python manage.py extract_db --org_id=${OCL_ORG} --source_id=${SOURCE_ID} -v0 --concepts-output=${SQL_FILE:-openmrs}-concepts.json --mappings-output=${SQL_FILE:-openmrs}-mappings.json --use_gold_mappings=${USE_GOLD_MAPPINGS:-0}
 else
   echo "Exporting ${OCL_ORG} ${SOURCE_ID} to json file..."
   python manage.py extract_db --org_id=${OCL_ORG} --source_id=${SOURCE_ID} -v0 --concepts --mappings --format=bulk --use_gold_mappings=${USE_GOLD_MAPPINGS:-0} > ${SQL_FILE:-openmrs}.json